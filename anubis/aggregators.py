@@ -19,9 +19,24 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import itertools
+import json
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, models
+from django.db.models.expressions import Exists, OuterRef
+from django.db.models.query import Q
+
+from anubis import idsets
+from anubis.cache import LRUCache
+from anubis.query import filter_by_ids
 from anubis.url import Boolean
 
 
+_not_numbers = itertools.count(1)
+
+
 class Aggregator:
     def __init__(self):
         pass
@@ -75,55 +90,504 @@ class Aggregator:
         raise RuntimeError()
 
 
+class ExpressionAggregator(Aggregator):
+    """Writes an expression back as text, in the syntax accepted in search
+    URLs. Arguments are always quoted, as the search interface does.
+    """
+
+    not_operator = "!"
+    and_operator = "/"
+    or_operator = "+"
+
+    @staticmethod
+    def need_parenthesis(outside, inside):
+        # the grammar only takes one "!" per term
+        if outside is Boolean.Not and inside is Boolean.Not:
+            return True
+
+        return Aggregator.need_parenthesis(outside, inside)
+
+    @staticmethod
+    def parenthesize(expression, need_parens):
+        return "({})".format(expression) if need_parens else expression
+
+    @staticmethod
+    def quote(arg):
+        arg = str(arg).replace("$", "$$").replace("\"", "$\"")
+
+        return "\"{}\"".format(arg)
+
+    def handle_base_expression(self, base_expression):
+        args = base_expression["args"] or [""]
+
+        return ",".join([base_expression["field"]] +
+                        [self.quote(arg) for arg in args])
+
+    def handle_not_expression(self, not_expression, need_parens):
+        return self.not_operator + self.parenthesize(not_expression,
+                                                     need_parens)
+
+    def handle_and_expression(self, left_expression, right_expression,
+                              left_parens, right_parens):
+        return self.parenthesize(left_expression, left_parens) + \
+            self.and_operator + \
+            self.parenthesize(right_expression, right_parens)
+
+    def handle_or_expression(self, left_expression, right_expression,
+                             left_parens, right_parens):
+        return self.parenthesize(left_expression, left_parens) + \
+            self.or_operator + \
+            self.parenthesize(right_expression, right_parens)
+
+
 class QuerySetAggregator(Aggregator):
-    def __init__(self, base_queryset, allowed_filters):
+    """Builds the queryset matching an expression.
+
+    With `compile_q` set, units whose filters implement
+    :meth:`anubis.filters.Filter.filter_q` are combined as :class:`Q` objects,
+    so every Q-compilable part of the tree ends up in a single `.filter()`
+    call. Only the remaining units (procedures, Elasticsearch, etc.) are
+    combined as querysets. Filters whose lookups span multi-valued relations
+    are combined as querysets too, as ANDing their conditions in one
+    `.filter()` would require a single related row to match both.
+
+    Use :meth:`aggregate` rather than traversing the expression directly, as
+    the traversal may result in a :class:`Q` object.
+
+    With `plan` set, :meth:`aggregate` evaluates the expression top-down
+    instead: the operands of each AND/OR are ordered by their filter's
+    :attr:`anubis.filters.Filter.cost` and by their estimated number of rows
+    (taken from `EXPLAIN` for cheap units and cached in
+    :attr:`estimate_cache`), an AND stops as soon as one of its operands is
+    known to be empty (checking the partial result before running expensive
+    filters) and an OR stops as soon as one of its operands matches
+    everything. The expression should be normalized beforehand, so that
+    chains of ANDs and ORs are flat.
+
+    Units repeated across the tree are evaluated only once per aggregator;
+    :attr:`unit_evaluations` and :attr:`saved_evaluations` count the
+    evaluations performed and avoided.
+    """
+
+    expensive_cost = 10
+    estimate_cache = LRUCache(1024)
+
+    def __init__(self, base_queryset, allowed_filters, compile_q=False,
+                 plan=False):
         super().__init__()
         self.base_queryset = base_queryset
         self.allowed_filters = allowed_filters
+        self.compile_q = compile_q
+        self.plan = plan
+        self.unit_values = {}
+        self.unit_evaluations = 0
+        self.saved_evaluations = 0
 
-    def handle_base_expression(self, base_expression):
+    def aggregate(self, expression):
+        if self.plan:
+            return self.as_queryset(self.evaluate(expression))
+
+        return self.as_queryset(expression.traverse(self))
+
+    def evaluate(self, expression):
+        if isinstance(expression, Boolean.Expr):
+            return self.handle_base_expression(expression)
+        elif isinstance(expression, Boolean.Not):
+            return self.evaluate_not(expression)
+        elif isinstance(expression, Boolean.And):
+            return self.evaluate_and(expression)
+
+        return self.evaluate_or(expression)
+
+    def evaluate_not(self, expression):
+        value = self.evaluate(expression.expr)
+
+        if self.is_empty(value):
+            return self.base_queryset
+        elif value is self.base_queryset:
+            return self.base_queryset.none()
+
+        return self.handle_not_expression(value, None)
+
+    def evaluate_and(self, expression):
+        operands = sorted(expression.operands,
+                          key=lambda op: (self.get_cost(op),
+                                          self.get_estimate(op)))
+        result = None
+
+        for operand in operands:
+            if result is not None and \
+                    self.get_cost(operand) >= self.expensive_cost and \
+                    not self.as_queryset(result).exists():
+                return self.base_queryset.none()
+
+            value = self.evaluate(operand)
+
+            if self.is_empty(value):
+                return self.base_queryset.none()
+            elif value is self.base_queryset:
+                continue
+
+            result = value if result is None else \
+                self.handle_and_expression(result, value, None, None)
+
+        return self.base_queryset if result is None else result
+
+    def evaluate_or(self, expression):
+        operands = sorted(expression.operands,
+                          key=lambda op: (self.get_cost(op),
+                                          -self.get_estimate(op)))
+        result = None
+
+        for operand in operands:
+            value = self.evaluate(operand)
+
+            if value is self.base_queryset:
+                return self.base_queryset
+            elif self.is_empty(value):
+                continue
+
+            result = value if result is None else \
+                self.handle_or_expression(result, value, None, None)
+
+        return self.base_queryset.none() if result is None else result
+
+    @staticmethod
+    def is_empty(value):
+        return not isinstance(value, Q) and value.query.is_empty()
+
+    def get_cost(self, expression):
+        if isinstance(expression, Boolean.Expr):
+            return self.allowed_filters[expression["field"]].cost
+
+        return max(self.get_cost(child) for child in expression.children())
+
+    def get_estimate(self, expression):
+        if not isinstance(expression, Boolean.Expr) or \
+                self.get_cost(expression) >= self.expensive_cost:
+            return float("inf")
+
+        key = self.make_estimate_key(expression)
+        estimate = self.estimate_cache.get(key)
+
+        if estimate is None:
+            estimate = self.estimate_unit(expression)
+            self.estimate_cache.set(key, estimate)
+
+        return estimate
+
+    def make_estimate_key(self, expression):
+        return (self.base_queryset.model._meta.label, expression["field"],
+                tuple(expression["args"]))
+
+    def estimate_unit(self, base_expression):
+        queryset = self.as_queryset(self.handle_base_expression(
+            base_expression))
+
+        return self.estimate_rows(queryset)
+
+    @staticmethod
+    def estimate_rows(queryset):
+        """Asks the database planner for the number of rows `queryset` is
+        expected to return.
+
+        Only PostgreSQL's `EXPLAIN` output is understood; on other databases
+        the estimate is infinite, so that operands keep their original order.
+        """
+        if queryset.query.is_empty():
+            return 0
+
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+
+        connection = connections[queryset.db]
+
+        if connection.vendor != "postgresql":
+            return float("inf")
+
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN (FORMAT JSON) {}".format(sql), params)
+            plan = cursor.fetchone()[0]
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        return plan[0]["Plan"]["Plan Rows"]
+
+    def as_queryset(self, expression):
+        if isinstance(expression, Q):
+            return self.base_queryset.filter(expression)
+
+        return expression
+
+    def get_unit_filter(self, base_expression):
         filter_ = self.allowed_filters[base_expression["field"]]
-        args = base_expression["args"]
-        args = filter_.validate(args)
+        args = filter_.validate(base_expression["args"])
+
+        return filter_, args
+
+    def filter_unit(self, base_expression):
+        filter_, args = self.get_unit_filter(base_expression)
+
         return filter_.filter_queryset(self.base_queryset, args)
 
+    def handle_base_expression(self, base_expression):
+        key = (base_expression["field"], tuple(base_expression["args"]))
+
+        try:
+            value = self.unit_values[key]
+        except KeyError:
+            value = self.evaluate_unit(base_expression)
+            self.unit_values[key] = value
+            self.unit_evaluations += 1
+        else:
+            self.saved_evaluations += 1
+
+        return value
+
+    def evaluate_unit(self, base_expression):
+        if not self.compile_q:
+            return self.filter_unit(base_expression)
+
+        filter_, args = self.get_unit_filter(base_expression)
+        condition = filter_.filter_q(args, self.base_queryset.model)
+
+        if condition is None:
+            return filter_.filter_queryset(self.base_queryset, args)
+
+        # an empty Q matches everything, but Django drops it when combining
+        if len(condition) == 0:
+            return self.base_queryset
+
+        return condition
+
     def handle_not_expression(self, not_expression, _):
-        return self.base_queryset.exclude(id__in=not_expression.values("id"))
+        if isinstance(not_expression, Q):
+            return ~not_expression
+
+        return self.exclude_queryset(not_expression)
+
+    def exclude_queryset(self, queryset):
+        """Excludes the records of `queryset` from the base queryset through
+        a correlated `NOT EXISTS`, which PostgreSQL plans as an anti-join
+        (unlike `NOT IN`, which also misbehaves with nulls).
+
+        Excluding an empty queryset (e.g., one built with `.none()`, which
+        can't be compiled to SQL) results in the base queryset.
+        """
+        if queryset.query.is_empty():
+            return self.base_queryset
+
+        try:
+            queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return self.base_queryset
+
+        # Django 1.11 can only filter on expressions through annotations,
+        # whose names must be unique for the results to be combined
+        name = "anubis_not_{}".format(next(_not_numbers))
+        subquery = queryset.order_by().filter(pk=OuterRef("pk"))
+
+        return self.base_queryset.annotate(**{name: ~Exists(subquery)}) \
+            .filter(**{name: True})
 
     def handle_and_expression(self, left_expression, right_expression, _, __):
+        left_is_q = isinstance(left_expression, Q)
+        right_is_q = isinstance(right_expression, Q)
+
+        if left_is_q and not right_is_q:
+            return right_expression.filter(left_expression)
+        elif right_is_q and not left_is_q:
+            return left_expression.filter(right_expression)
+
         return left_expression & right_expression
 
     def handle_or_expression(self, left_expression, right_expression, _, __):
+        if isinstance(left_expression, Q) != isinstance(right_expression, Q):
+            left_expression = self.as_queryset(left_expression)
+            right_expression = self.as_queryset(right_expression)
+
         return left_expression | right_expression
 
     def handle_impossible_case(self):
         return self.base_queryset
 
 class CachedQuerySetAggregator(QuerySetAggregator):
-    def __init__(self, cache, base_queryset, allowed_filters):
-        super().__init__(base_queryset, allowed_filters)
+    """Caches the ids matched by each unit.
+
+    Ids are stored compactly encoded (see :mod:`anubis.idsets`). Units whose
+    encoded ids would take more than :attr:`max_unit_bytes` aren't cached.
+    Models whose primary key isn't an integer (e.g., UUIDs) can't be encoded,
+    so their ids are stored as plain lists.
+    """
+
+    q_ids_max_size = 1000
+    max_unit_bytes = 1024 * 1024
+
+    def __init__(self, cache, base_queryset, allowed_filters,
+                 compile_q=False, plan=False, generation=None,
+                 timeout=DEFAULT_TIMEOUT):
+        super().__init__(base_queryset, allowed_filters, compile_q=compile_q,
+                         plan=plan)
 
         self.cache = cache
+        self.generation = generation
+        self.timeout = timeout
+
+    @property
+    def integer_ids(self):
+        """Whether the ids of the base queryset can be encoded as an
+        :class:`anubis.idsets.IdSet`.
+        """
+        pk = self.base_queryset.model._meta.pk
+
+        while pk.is_relation:
+            pk = pk.target_field
+
+        return isinstance(pk, (models.AutoField, models.IntegerField))
 
     def make_cache_key(self, expr):
         model_name = self.base_queryset.model._meta.model_name
-        keys = [model_name, expr["field"]] + expr["args"]
+        keys = [model_name, expr["field"]] + list(expr["args"])
         keys = [k.replace(":", r"\:") for k in keys]
 
+        if self.generation is not None:
+            keys.insert(0, self.generation)
+
         return ":".join(keys)
 
-    def handle_base_expression(self, base_expression):
-        unit_key = self.make_cache_key(base_expression)
+    def make_universe_key(self):
+        key = "{}:*".format(self.base_queryset.model._meta.model_name)
+
+        if self.generation is not None:
+            key = "{}:{}".format(self.generation, key)
 
-        cached_value = self.cache.get(unit_key, None)
+        return key
+
+    def get_cached_ids(self, base_expression, decode=idsets.decode):
+        cached_value = self.cache.get(self.make_cache_key(base_expression),
+                                      None)
 
         if cached_value is None:
-            queryset = super().handle_base_expression(base_expression)
-            self.cache.set(unit_key, queryset.values_list("id", flat=True))
+            return None
+
+        if not self.integer_ids:
+            return cached_value if isinstance(cached_value, list) else None
+
+        try:
+            return decode(cached_value)
+        except ValueError:
+            # written by an older version
+            return None
+
+    def fetch_ids(self, key, queryset):
+        ids = list(queryset.values_list("id", flat=True))
+
+        if self.integer_ids:
+            encoded = idsets.encode(ids, max_bytes=self.max_unit_bytes)
         else:
-            queryset = self.base_queryset.filter(id__in=cached_value)
+            encoded = ids
+
+        if encoded is not None:
+            self.cache.set(key, encoded, self.timeout)
+
+        return ids
+
+    def get_unit_id_set(self, base_expression):
+        """Gets the ids matched by a unit as an :class:`anubis.idsets.IdSet`,
+        evaluating and caching it if needed.
+        """
+        id_set = self.get_cached_ids(base_expression,
+                                     decode=idsets.IdSet.decode)
+
+        if id_set is None:
+            id_set = idsets.IdSet.from_ids(self.fetch_ids(
+                self.make_cache_key(base_expression),
+                self.filter_unit(base_expression)))
+
+        return id_set
+
+    def get_universe(self):
+        """Gets all the ids in the base queryset as an
+        :class:`anubis.idsets.IdSet`, evaluating and caching them if needed.
+        """
+        key = self.make_universe_key()
+        cached_value = self.cache.get(key, None)
+
+        if cached_value is not None:
+            try:
+                return idsets.IdSet.decode(cached_value)
+            except ValueError:
+                pass
+
+        return idsets.IdSet.from_ids(self.fetch_ids(key, self.base_queryset))
+
+    def estimate_unit(self, base_expression):
+        ids = self.get_cached_ids(base_expression)
+
+        if ids is not None:
+            return len(ids)
+
+        return super().estimate_unit(base_expression)
+
+    def evaluate_unit(self, base_expression):
+        ids = self.get_cached_ids(base_expression)
+
+        if ids is None:
+            ids = self.fetch_ids(self.make_cache_key(base_expression),
+                                 self.filter_unit(base_expression))
+
+        if self.compile_q and len(ids) <= self.q_ids_max_size:
+            return Q(id__in=ids)
+
+        return filter_by_ids(self.base_queryset, ids)
+
+class IdSetAggregator(Aggregator):
+    """Evaluates an expression in memory, over the id sets of its units.
+    Only works for models with integer primary keys (see
+    :attr:`CachedQuerySetAggregator.integer_ids`).
+
+    Args:
+        unit_aggregator (CachedQuerySetAggregator): Provides the ids matched
+            by each unit and the universe of ids, used for negations.
+    """
+
+    def __init__(self, unit_aggregator):
+        super().__init__()
+        self.unit_aggregator = unit_aggregator
+        self.unit_values = {}
+        self._universe = None
+
+    @property
+    def universe(self):
+        if self._universe is None:
+            self._universe = self.unit_aggregator.get_universe()
+
+        return self._universe
+
+    def handle_base_expression(self, base_expression):
+        key = (base_expression["field"], tuple(base_expression["args"]))
+
+        if key not in self.unit_values:
+            self.unit_values[key] = self.unit_aggregator.get_unit_id_set(
+                base_expression)
+
+        return self.unit_values[key]
+
+    def handle_not_expression(self, not_expression, _):
+        return self.universe - not_expression
+
+    def handle_and_expression(self, left_expression, right_expression, _, __):
+        return left_expression & right_expression
+
+    def handle_or_expression(self, left_expression, right_expression, _, __):
+        return left_expression | right_expression
+
+    def handle_impossible_case(self):
+        return self.universe
 
-        return queryset
 
 class ListAggregator(Aggregator):
     not_token = {
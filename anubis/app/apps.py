@@ -18,11 +18,19 @@
 # programa. Se não, consulte <http://www.gnu.org/licenses/>.
 
 
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
+from django.conf import settings
 
 class AnubisConfig(AppConfig):
     name = 'anubis.app'
     label = 'anubis'
     verbose_name = 'Anubis'
 
+    def ready(self):
+        from anubis.cache import track_generations, track_table_generations
 
+        table_models = getattr(settings, "ANUBIS_GENERATION_TABLE_MODELS", [])
+
+        track_generations()
+        track_table_generations(*[apps.get_model(label)
+                                  for label in table_models])
@@ -0,0 +1,239 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# warmcache.py - an admin command to warm up search caches.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module defines the warmcache command, which replays searches against a
+view so that :class:`anubis.views.CachedSearchMixin` and
+:class:`anubis.views.CachedUnitMixin` caches are filled before users need
+them.
+"""
+
+import pickle
+import re
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import Resolver404, resolve
+from django.db import connections
+from django.test import RequestFactory
+from django.utils.module_loading import import_string
+
+from anubis.url import Boolean
+from anubis.views.caching import CachedSearchMixin, CachedUnitMixin
+
+
+class Command(BaseCommand):
+    """Replays searches against a view, storing their states and units in the
+    view's caches, and reports how long each one took and how much it takes
+    in the cache.
+    """
+
+    help = ("Replays searches from a list of expressions or a request log, "
+            "filling the caches of a view.")
+
+    log_path_pattern = re.compile(r"(?:^|[\s\"])(/\S*)")
+
+    def add_arguments(self, parser):
+        parser.add_argument("view", help="Dotted path to the view class.")
+        parser.add_argument("source",
+                            help=("File with one expression per line, or a "
+                                  "request log with --log. Use - for "
+                                  "standard input."))
+        parser.add_argument("--log", action="store_true",
+                            help=("Read request paths from a log, replaying "
+                                  "the most frequent searches first."))
+        parser.add_argument("--limit", type=int, default=None,
+                            help="Replay at most this many searches.")
+        parser.add_argument("--kwarg", action="append", default=[],
+                            metavar="KEY=VALUE",
+                            help=("URL argument added to every search (e.g., "
+                                  "the model, page or sorting)."))
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of searches replayed concurrently.")
+        parser.add_argument("--api", action="store_true",
+                            help="Warm the API entries instead of the HTML "
+                                 "ones.")
+
+    def handle(self, *args, **options):
+        try:
+            view_class = import_string(options["view"])
+        except ImportError as error:
+            raise CommandError(str(error))
+
+        extra_kwargs = {}
+
+        for kwarg in options["kwarg"]:
+            key, sep, value = kwarg.partition("=")
+
+            if not sep:
+                raise CommandError("Invalid --kwarg: {}".format(kwarg))
+
+            extra_kwargs[key] = value
+
+        lines = self.read_lines(options["source"])
+
+        if options["log"]:
+            searches = self.searches_from_log(view_class, lines)
+        else:
+            searches = [{view_class.expression_parameter: line}
+                        for line in lines]
+
+        if options["limit"] is not None:
+            searches = searches[:options["limit"]]
+
+        searches = [dict(extra_kwargs, **search) for search in searches]
+
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            reports = executor.map(
+                lambda search: self.warm(view_class, search, options["api"]),
+                searches)
+
+            for report in reports:
+                self.stdout.write(self.format_report(report))
+
+    @staticmethod
+    def read_lines(source):
+        stream = sys.stdin if source == "-" else open(source)
+
+        try:
+            lines = [line.strip() for line in stream]
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        return [line for line in lines if line and not line.startswith("#")]
+
+    def searches_from_log(self, view_class, lines):
+        counter = Counter()
+
+        for line in lines:
+            match = self.log_path_pattern.search(line)
+
+            if match is None:
+                continue
+
+            try:
+                resolved = resolve(unquote(urlsplit(match.group(1)).path))
+            except Resolver404:
+                continue
+
+            resolved_class = getattr(resolved.func, "view_class", None) or \
+                getattr(resolved.func, "cls", None)
+
+            if resolved_class is not view_class or \
+                    view_class.expression_parameter not in resolved.kwargs:
+                continue
+
+            counter[tuple(sorted(resolved.kwargs.items()))] += 1
+
+        return [dict(search) for search, _ in counter.most_common()]
+
+    def warm(self, view_class, kwargs, api):
+        expression = kwargs[view_class.expression_parameter]
+        report = {"expression": expression, "error": None, "cached": False,
+                  "time": 0, "state_size": 0, "units": 0, "units_size": 0}
+
+        start = time.time()
+
+        try:
+            view = self.make_view(view_class, kwargs, api)
+
+            if isinstance(view, CachedSearchMixin) and view.is_cacheable:
+                _, report["cached"] = view._get_cached_state(
+                    view.get_search_cache(), view.get_cache_key())
+
+            state = view.get_shared_state()
+            warm_units = isinstance(view, CachedUnitMixin) and \
+                view.unit_cache is not None
+
+            if warm_units:
+                # a fresh cached state doesn't search again, which would
+                # leave expired units out of the cache
+                view.get_queryset_filter(view.model.objects.all())
+
+            report["time"] = time.time() - start
+            report["state_size"] = len(pickle.dumps(state))
+
+            if warm_units:
+                report["units"], report["units_size"] = \
+                    self.measure_units(view)
+        except Exception as error:
+            report["time"] = time.time() - start
+            report["error"] = "{}: {}".format(error.__class__.__name__, error)
+        finally:
+            connections.close_all()
+
+        return report
+
+    @staticmethod
+    def make_view(view_class, kwargs, api):
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+
+        view = view_class()
+        view.request = request
+        view.args = ()
+        view.kwargs = kwargs
+        view.format_kwarg = None
+        view.is_api = api
+
+        view._prepare_attributes()
+
+        return view
+
+    @staticmethod
+    def measure_units(view):
+        aggregator = view.get_unit_aggregator(view.model.objects.all())
+        keys = set()
+        stack = [view.canonical_expression]
+
+        while stack:
+            node = stack.pop()
+
+            if isinstance(node, Boolean.Expr):
+                keys.add(aggregator.make_cache_key(node))
+            else:
+                stack.extend(node.children())
+
+        size = 0
+
+        for key in keys:
+            value = aggregator.cache.get(key, None)
+
+            if isinstance(value, bytes):
+                size += len(value)
+
+        return len(keys), size
+
+    @staticmethod
+    def format_report(report):
+        if report["error"] is not None:
+            return "{expression}\tERROR ({time:.3f}s): {error}".format(
+                **report)
+
+        return ("{expression}\t{status}\t{time:.3f}s\tstate: {state_size} "
+                "bytes\tunits: {units} ({units_size} bytes)").format(
+                    status="fresh" if report["cached"] else "stored",
+                    **report)
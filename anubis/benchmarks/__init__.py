@@ -0,0 +1,31 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# __init__.py - performance benchmarks.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Anubis benchmarks. Each module is a script that prints its measurements::
+
+    python -m anubis.benchmarks.parser
+
+Benchmarks that only need Python run against the test settings
+(:mod:`anubis.tests.settings`). Those comparing SQL strategies need
+PostgreSQL: set `DJANGO_SETTINGS_MODULE=anubis.benchmarks.settings` and point
+the usual `PG*` environment variables at a scratch database, which they fill
+with generated users.
+"""
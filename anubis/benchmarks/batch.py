@@ -0,0 +1,89 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# batch.py - batch parsing against a per-expression loop.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Compares :meth:`anubis.url.BooleanBuilder.build_many` with building the same
+expressions one by one, as reporting jobs and cache warmers did. The
+expression cache is emptied before every run, so every expression is parsed.
+"""
+
+import random
+
+from anubis.benchmarks.common import measure, report, setup
+
+COUNTS = (100, 1000)
+
+
+def make_expressions(count):
+    generator = random.Random(count)
+    expressions = []
+
+    for index in range(count):
+        units = ["id,{}".format(generator.randrange(100000))
+                 for _ in range(generator.randint(1, 8))]
+        expressions.append("+".join(units))
+
+    # a few syntax errors, reported per expression
+    expressions[::50] = ["id,"] * len(expressions[::50])
+
+    return expressions
+
+
+def main():
+    setup()
+
+    from anubis.benchmarks.parser import available_engines
+    from anubis.url import BooleanBuilder
+
+    def clear_cache():
+        cache = BooleanBuilder.get_cache()
+
+        if cache is not None:
+            cache.clear()
+
+    def build_each(expressions, engine):
+        clear_cache()
+
+        for expression in expressions:
+            try:
+                BooleanBuilder(expression, engine=engine).build()
+            except ValueError:
+                pass
+
+    def build_many(expressions, engine):
+        clear_cache()
+        BooleanBuilder.build_many(expressions, engine=engine)
+
+    rows = []
+
+    for engine in available_engines(BooleanBuilder("")):
+        for count in COUNTS:
+            expressions = make_expressions(count)
+            each = measure(lambda: build_each(expressions, engine), repeat=3)
+            many = measure(lambda: build_many(expressions, engine), repeat=3)
+
+            rows.append([engine, count, count / each, count / many,
+                         each / many])
+
+    report("Batch parsing (expressions/s)",
+           ["engine", "expressions", "loop", "build_many", "speedup"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# common.py - helpers shared by the benchmarks.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import timeit
+
+import django
+
+
+def setup(settings_module="anubis.tests.settings"):
+    """Configures Django, creating the tables of an in-memory database if
+    needed.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+    django.setup()
+
+    from django.core.management import call_command
+
+    call_command("migrate", run_syncdb=True, verbosity=0)
+
+
+def measure(func, number=None, repeat=5):
+    """Times `func`, returning the best time of a single call, in seconds.
+
+    If `number` isn't given, it is chosen so that each of the `repeat` runs
+    takes at least 0.2 seconds.
+    """
+    timer = timeit.Timer(func)
+
+    if number is None:
+        number = 1
+
+        while timer.timeit(number) < 0.2:
+            number *= 10
+
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def uses_postgresql():
+    from django.db import connection
+
+    return connection.vendor == "postgresql"
+
+
+def require_postgresql():
+    if not uses_postgresql():
+        raise SystemExit("This benchmark needs PostgreSQL: set "
+                         "DJANGO_SETTINGS_MODULE=anubis.benchmarks.settings.")
+
+
+def populate(count=None, groups=20):
+    """Fills the user table with `count` generated users (taken from the
+    `ANUBIS_BENCHMARK_USERS` environment variable, 20000 by default), each
+    in a few of `groups` groups. Does nothing if enough users exist.
+    """
+    from django.contrib.auth.models import Group, User
+    from django.db import connection, transaction
+
+    if count is None:
+        count = int(os.environ.get("ANUBIS_BENCHMARK_USERS", 20000))
+
+    if User.objects.count() >= count:
+        return
+
+    with transaction.atomic():
+        User.objects.all().delete()
+        Group.objects.all().delete()
+
+        Group.objects.bulk_create(Group(name="group{}".format(index))
+                                  for index in range(groups))
+        User.objects.bulk_create(
+            (User(username="user{}".format(index),
+                  first_name="name{}".format(index % 100),
+                  is_staff=(index % 10 == 0),
+                  is_active=(index % 7 != 0))
+             for index in range(count)))
+
+        group_ids = list(Group.objects.order_by("id")
+                         .values_list("id", flat=True))
+        Membership = User.groups.through
+        Membership.objects.bulk_create(
+            (Membership(user_id=user_id,
+                        group_id=group_ids[(user_id + offset) % groups])
+             for user_id in User.objects.values_list("id", flat=True)
+             for offset in (0, user_id % 3 + 1)))
+
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("analyze auth_user; analyze auth_user_groups;")
+
+
+def make_filters():
+    """Filters over the generated users."""
+    from anubis.filters import QuerySetFilter
+
+    return {
+        "username": QuerySetFilter("username").field("username"),
+        "name": QuerySetFilter("first_name").field("name"),
+        "staff": QuerySetFilter("is_staff").field("staff"),
+        "active": QuerySetFilter("is_active").field("active"),
+        "group": QuerySetFilter("groups__name").field("group"),
+    }
+
+
+def explain_cost(queryset):
+    """Returns the total cost PostgreSQL's planner estimates for
+    `queryset`, or :const:`None` on other databases.
+    """
+    from django.db import connections
+
+    if not uses_postgresql():
+        return None
+
+    sql, params = queryset.query.sql_with_params()
+
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) {}".format(sql), params)
+        plan = cursor.fetchone()[0]
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return plan[0]["Plan"]["Total Cost"]
+
+
+def count_queries(func):
+    """Calls `func`, returning how many queries it ran."""
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as context:
+        func()
+
+    return len(context.captured_queries)
+
+
+def fetch_ids(queryset):
+    return list(queryset.values_list("id", flat=True))
+
+
+def report(title, header, rows):
+    """Prints `rows` as an aligned table."""
+    rows = [[format_cell(cell) for cell in row] for row in rows]
+    widths = [max(len(row[index]) for row in [header] + rows)
+              for index in range(len(header))]
+
+    print(title)
+
+    for row in [header] + rows:
+        # the first column names what is measured
+        print("  ".join([row[0].ljust(widths[0])] +
+                        [cell.rjust(width)
+                         for cell, width in zip(row[1:], widths[1:])]))
+
+    print()
+
+
+def format_cell(cell):
+    if cell is None:
+        return "-"
+    elif isinstance(cell, float):
+        return "{:.1f}".format(cell)
+
+    return str(cell)
+
+
+def usec(seconds):
+    return seconds * 1e6
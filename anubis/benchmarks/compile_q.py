@@ -0,0 +1,74 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# compile_q.py - folding units into a single Q against combining querysets.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Compares :class:`anubis.aggregators.QuerySetAggregator` with and without
+`compile_q` over generated users: queries run, size of the SQL, time to
+fetch the matching ids and, on PostgreSQL, the planner's estimated cost.
+"""
+
+from anubis.benchmarks.common import count_queries, explain_cost, \
+    fetch_ids, make_filters, measure, populate, report, setup
+
+EXPRESSIONS = [
+    "username,user1+username,user2+username,user3",
+    "staff,True/active,True/!name,name10",
+    "(name,name1+name,name2)/staff,False/!username,user100",
+    "group,group1/(name,name1+name,name2+name,name3)/!active,False",
+]
+
+
+def main():
+    setup()
+    populate()
+
+    from django.contrib.auth.models import User
+
+    from anubis.aggregators import QuerySetAggregator
+    from anubis.url import BooleanBuilder
+
+    rows = []
+
+    for text in EXPRESSIONS:
+        expression = BooleanBuilder(text).build().normalize()
+
+        for compile_q in (False, True):
+            aggregator = QuerySetAggregator(User.objects.all(),
+                                            make_filters(),
+                                            compile_q=compile_q)
+            queryset = aggregator.aggregate(expression)
+            sql, _ = queryset.query.sql_with_params()
+
+            rows.append([
+                text if not compile_q else "",
+                "Q" if compile_q else "querysets",
+                count_queries(lambda: fetch_ids(queryset)),
+                len(sql),
+                sql.count("JOIN"),
+                explain_cost(queryset),
+                measure(lambda: fetch_ids(queryset), repeat=3) * 1000,
+            ])
+
+    report("Q folding ({} users)".format(User.objects.count()),
+           ["expression", "mode", "queries", "SQL chars", "joins", "cost",
+            "ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# expressions.py - building and traversing boolean expressions.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures how long building and traversing :class:`anubis.url.Boolean` trees
+takes for OR chains of 10, 100 and 1000 units (e.g., pasted lists of ids).
+Trees are built both by the Python parser and from the JSON output of the
+Haskell parser, which flattens chains of the same operator into a list of
+operands.
+"""
+
+import json
+
+from anubis.benchmarks.common import measure, report, setup, usec
+
+SIZES = (10, 100, 1000)
+
+
+def make_text(units):
+    return "+".join("id,{}".format(index) for index in range(units))
+
+
+def make_json(units):
+    return json.dumps({
+        "tag": "Or",
+        "operands": [{"tag": "BooleanExpr",
+                      "contents": {"field": "id", "args": [str(index)]}}
+                     for index in range(units)],
+    })
+
+
+def count_units(base_expression=None, not_expression=None,
+                and_expression=None, or_expression=None, **kwargs):
+    if base_expression is not None:
+        return 1
+    elif not_expression is not None:
+        return not_expression
+
+    left, right = and_expression or or_expression
+
+    return left + right
+
+
+def main():
+    setup()
+
+    from anubis.url import Boolean, ExpressionParser
+
+    rows = []
+
+    for size in SIZES:
+        text = make_text(size)
+        json_text = make_json(size)
+        tree = ExpressionParser(text).parse()
+
+        rows.append([
+            size,
+            usec(measure(lambda: ExpressionParser(text).parse())),
+            usec(measure(
+                lambda: json.loads(json_text, object_hook=Boolean.build))),
+            usec(measure(lambda: tree.traverse(count_units))),
+            usec(measure(lambda: tree.normalize())),
+        ])
+
+    report("Boolean trees (usec)",
+           ["units", "parse", "from JSON", "traverse", "normalize"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# id_lookups.py - lookup strategies for id sets by size.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Compares the strategies of :func:`anubis.query.filter_by_ids` (a plain `IN`
+list, a single array parameter and an `unnest` of that array) over id sets
+of growing size: time to build and compile the query, time to fetch the
+matching ids and the planner's estimated cost. Needs PostgreSQL.
+"""
+
+import random
+
+from django.test.utils import override_settings
+
+from anubis.benchmarks.common import explain_cost, fetch_ids, measure, \
+    populate, report, require_postgresql, setup
+
+SIZES = (10, 100, 1000, 10000, 100000)
+
+# thresholds forcing each strategy
+STRATEGIES = [
+    ("IN", {"ANUBIS_ID_LIST_MAX_SIZE": max(SIZES),
+            "ANUBIS_ID_ARRAY_MAX_SIZE": max(SIZES)}),
+    ("= any", {"ANUBIS_ID_LIST_MAX_SIZE": 0,
+               "ANUBIS_ID_ARRAY_MAX_SIZE": max(SIZES)}),
+    ("unnest", {"ANUBIS_ID_LIST_MAX_SIZE": 0,
+                "ANUBIS_ID_ARRAY_MAX_SIZE": 0}),
+]
+
+
+def main():
+    setup("anubis.benchmarks.settings")
+    require_postgresql()
+    populate(max(SIZES))
+
+    from django.contrib.auth.models import User
+
+    from anubis.query import filter_by_ids
+
+    all_ids = list(User.objects.values_list("id", flat=True))
+    rows = []
+
+    for size in SIZES:
+        ids = random.Random(size).sample(all_ids, size)
+
+        for name, thresholds in STRATEGIES:
+            with override_settings(**thresholds):
+                def build():
+                    return filter_by_ids(User.objects.all(), ids) \
+                        .query.sql_with_params()
+
+                queryset = filter_by_ids(User.objects.all(), ids)
+
+                rows.append([
+                    size if name == STRATEGIES[0][0] else "",
+                    name,
+                    measure(build, repeat=3) * 1000,
+                    measure(lambda: fetch_ids(queryset), repeat=3) * 1000,
+                    explain_cost(queryset),
+                ])
+
+    report("Id set lookups",
+           ["ids", "strategy", "build ms", "fetch ms", "cost"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# negation.py - NOT EXISTS anti-joins against NOT IN subqueries.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Compares negations compiled to a correlated `NOT EXISTS` (what
+:class:`anubis.aggregators.QuerySetAggregator` does) with the `NOT IN`
+subquery it used to build, over generated users: time to fetch the matching
+ids and, on PostgreSQL, the planner's estimated cost.
+"""
+
+from anubis.benchmarks.common import explain_cost, fetch_ids, make_filters, \
+    measure, populate, report, setup
+
+EXPRESSIONS = [
+    "!staff,True",
+    "!active,True",
+    "!group,group1",
+    "name,name1/!group,group3",
+]
+
+
+def main():
+    setup()
+    populate()
+
+    from django.contrib.auth.models import User
+
+    from anubis.aggregators import QuerySetAggregator
+    from anubis.url import BooleanBuilder
+
+    class NotInAggregator(QuerySetAggregator):
+        def exclude_queryset(self, queryset):
+            return self.base_queryset.exclude(id__in=queryset.values("id"))
+
+    rows = []
+
+    for text in EXPRESSIONS:
+        expression = BooleanBuilder(text).build()
+
+        for mode, aggregator_class in (("NOT IN", NotInAggregator),
+                                       ("NOT EXISTS", QuerySetAggregator)):
+            aggregator = aggregator_class(User.objects.all(), make_filters())
+            queryset = aggregator.aggregate(expression)
+
+            rows.append([
+                text if aggregator_class is NotInAggregator else "",
+                mode,
+                len(fetch_ids(queryset)),
+                explain_cost(queryset),
+                measure(lambda: fetch_ids(queryset), repeat=3) * 1000,
+            ])
+
+    report("Negation ({} users)".format(User.objects.count()),
+           ["expression", "mode", "rows", "cost", "ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# parser.py - parse latency and throughput across threads.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures how long parsing a search expression takes with each available
+engine, and how many expressions per second a process parses as threads are
+added. The expression cache is bypassed, so every call really parses.
+
+Startup is the time a new process takes to parse its first expression,
+which includes loading the library and starting the GHC runtime for the
+Haskell engine.
+
+The resident Haskell library is also compared with loading the library and
+starting the GHC runtime for every call, then shutting both down, as Anubis
+used to. That path is measured in a forked child, as the runtime can't be
+started again in a process that keeps it resident.
+"""
+
+import ctypes
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from anubis.benchmarks.common import measure, report, setup, usec
+
+THREADS = (1, 2, 4, 8)
+SIZES = (1, 10, 100)
+CALLS = 2000
+STARTUP_RUNS = 5
+
+
+def make_expression(units):
+    return "+".join("id,{}".format(index) for index in range(units))
+
+
+def available_engines(builder):
+    engines = ["python"]
+
+    if os.path.exists(builder.parser_lib_path):
+        engines.insert(0, "haskell")
+
+    return engines
+
+
+def in_fresh_process(func, *args):
+    """Calls `func` in a forked child, which doesn't inherit the parser
+    library as long as this process hasn't loaded it yet.
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(func, *args).result()
+
+
+def per_call_parse(builder, text):
+    """Parses `text` loading the library and starting its runtime first,
+    then shutting both down.
+    """
+    from anubis.url import Boolean
+
+    library = ctypes.cdll.LoadLibrary(builder.parser_lib_path)
+
+    for name, (argtypes, restype) in builder.parser_exports.items():
+        getattr(library, name).argtypes = argtypes
+        getattr(library, name).restype = restype
+
+    library.hs_init(0, 0)
+
+    try:
+        json_bytestr = builder._call_parser(library, "parseUrl",
+                                            text.encode("utf-8"))
+
+        return json.loads(json_bytestr.decode("utf-8"),
+                          object_hook=Boolean.build)
+    finally:
+        library.hs_exit()
+
+        libdl = ctypes.CDLL("libdl.so.2")
+        libdl.dlclose.argtypes = [ctypes.c_void_p]
+        libdl.dlclose(library._handle)
+
+
+def measure_per_call(sizes):
+    from anubis.url import BooleanBuilder
+
+    builder = BooleanBuilder("")
+
+    return [measure(lambda: per_call_parse(builder, make_expression(size)))
+            for size in sizes]
+
+
+def first_parse(engine, text):
+    from anubis.url import BooleanBuilder
+
+    builder = BooleanBuilder("")
+    parse = getattr(builder, "parse_{}".format(engine))
+
+    start = time.perf_counter()
+    parse(text)
+
+    return time.perf_counter() - start
+
+
+def throughput(builder, engine, text, threads):
+    parse = getattr(builder, "parse_{}".format(engine))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        # warm up the threads (and the resident library)
+        list(executor.map(parse, [text] * threads))
+
+        start = time.perf_counter()
+        list(executor.map(parse, [text] * CALLS))
+
+        return CALLS / (time.perf_counter() - start)
+
+
+def main():
+    setup()
+
+    from anubis.url import BooleanBuilder
+
+    builder = BooleanBuilder("")
+    engines = available_engines(builder)
+
+    # before anything loads the library in this process
+    per_call = in_fresh_process(measure_per_call, SIZES) \
+        if "haskell" in engines else None
+
+    text = make_expression(10)
+    rows = [[engine, usec(min(in_fresh_process(first_parse, engine, text)
+                              for _ in range(STARTUP_RUNS)))]
+            for engine in engines]
+
+    report("Startup, 10 units", ["engine", "usec to first parse"], rows)
+
+    rows = []
+
+    for engine in engines:
+        parse = getattr(builder, "parse_{}".format(engine))
+
+        for size in SIZES:
+            text = make_expression(size)
+            rows.append([engine, size, usec(measure(lambda: parse(text)))])
+
+    report("Parse latency", ["engine", "units", "usec/parse"], rows)
+
+    if per_call is not None:
+        rows = []
+
+        for size, before in zip(SIZES, per_call):
+            text = make_expression(size)
+            after = measure(lambda: builder.parse_haskell(text))
+            rows.append([size, usec(before), usec(after), before / after])
+
+        report("Haskell library, per-call load vs. resident",
+               ["units", "per-call usec", "resident usec", "speedup"], rows)
+
+    rows = []
+    text = make_expression(10)
+
+    for engine in engines:
+        for threads in THREADS:
+            rows.append([engine, threads,
+                         throughput(builder, engine, text, threads)])
+
+    report("Throughput, 10 units", ["engine", "threads", "parses/s"], rows)
+
+
+if __name__ == "__main__":
+    main()
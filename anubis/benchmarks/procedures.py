@@ -0,0 +1,114 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# procedures.py - stored procedure filters inlined or fetched into Python.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Compares :meth:`anubis.query.ProcedureQuerySet.procedure` fetching the ids
+returned by a procedure into Python, then filtering by them, with the same
+procedure inlined as a subquery (`inline_procedures`): time to fetch the
+final ids and peak memory allocated by Python.
+
+It also times repeated small procedure calls with and without
+`prepare_procedures`. Needs PostgreSQL.
+"""
+
+import tracemalloc
+
+from anubis.benchmarks.common import fetch_ids, measure, populate, report, \
+    require_postgresql, setup, usec
+
+FUNCTIONS = """
+    create or replace function auth_user_bench_upto(bound integer)
+        returns setof auth_user as $$
+            select * from auth_user where id <= bound;
+        $$ language sql stable;
+
+    create or replace function auth_user_bench_staff(bound integer)
+        returns bigint as $$
+            select count(*) from auth_user where id <= bound and is_staff;
+        $$ language sql stable;
+"""
+
+BOUNDS = (1000, 10000, 100000)
+
+
+def peak_memory(func):
+    tracemalloc.start()
+
+    try:
+        func()
+
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    setup("anubis.benchmarks.settings")
+    require_postgresql()
+    populate(max(BOUNDS))
+
+    from django.contrib.auth.models import User
+    from django.db import connection
+
+    from anubis.query import ProcedureQuerySet
+
+    class InlineProcedureQuerySet(ProcedureQuerySet):
+        inline_procedures = True
+
+    class PreparedProcedureQuerySet(ProcedureQuerySet):
+        prepare_procedures = True
+
+    with connection.cursor() as cursor:
+        cursor.execute(FUNCTIONS)
+
+    rows = []
+
+    for bound in BOUNDS:
+        for queryset_class in (ProcedureQuerySet, InlineProcedureQuerySet):
+            def search():
+                return fetch_ids(queryset_class(model=User)
+                                 .procedure("bench_upto", bound)
+                                 .filter(is_active=True))
+
+            rows.append([
+                bound if queryset_class is ProcedureQuerySet else "",
+                "inline" if queryset_class.inline_procedures else "fetch",
+                measure(search, repeat=3) * 1000,
+                peak_memory(search) / 1024,
+            ])
+
+    report("Procedure filters", ["procedure rows", "mode", "ms", "peak KiB"],
+           rows)
+
+    rows = []
+
+    for queryset_class in (ProcedureQuerySet, PreparedProcedureQuerySet):
+        queryset = queryset_class(model=User)
+
+        rows.append([
+            "prepared" if queryset_class.prepare_procedures else "plain",
+            usec(measure(lambda: queryset.single_valued_procedure(
+                "bench_staff", 100))),
+        ])
+
+    report("Repeated small procedure calls", ["mode", "usec/call"], rows)
+
+
+if __name__ == "__main__":
+    main()
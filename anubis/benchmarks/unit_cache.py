@@ -0,0 +1,82 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# unit_cache.py - payload size and hit latency of cached units.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Compares how :class:`anubis.aggregators.CachedQuerySetAggregator` stores the
+ids matched by a unit - encoded by :mod:`anubis.idsets` - with the pickled
+`values_list` queryset it used to store: payload bytes and time to get the
+ids back on a cache hit, either as a list or as an :class:`IdSet` for
+in-memory evaluation.
+"""
+
+import pickle
+
+from anubis.benchmarks.common import make_filters, measure, populate, \
+    report, setup, usec
+
+UNITS = [
+    ("username", ["user5"]),
+    ("name", ["name1"]),
+    ("staff", ["True"]),
+    ("active", ["True"]),
+]
+
+
+def main():
+    setup()
+    populate()
+
+    from django.contrib.auth.models import User
+
+    from anubis import idsets
+    from anubis.aggregators import QuerySetAggregator
+    from anubis.url import Boolean
+
+    aggregator = QuerySetAggregator(User.objects.all(), make_filters())
+    rows = []
+
+    for field, args in UNITS:
+        queryset = aggregator.filter_unit(Boolean.unit(field, args)) \
+            .values_list("id", flat=True)
+        ids = list(queryset)
+
+        # the cache pickles what it stores; a pickled queryset carries its
+        # query along with its results
+        pickled = pickle.dumps(queryset, pickle.HIGHEST_PROTOCOL)
+        encoded = pickle.dumps(idsets.encode(ids), pickle.HIGHEST_PROTOCOL)
+
+        rows.append([
+            "{},{}".format(field, ",".join(args)),
+            len(ids),
+            len(pickled),
+            len(encoded),
+            usec(measure(lambda: list(pickle.loads(pickled)))),
+            usec(measure(lambda: idsets.decode(pickle.loads(encoded)))),
+            usec(measure(lambda: idsets.IdSet.decode(
+                pickle.loads(encoded)))),
+        ])
+
+    report("Cached units ({} users)".format(User.objects.count()),
+           ["unit", "ids", "queryset bytes", "encoded bytes",
+            "queryset hit usec", "encoded hit usec", "IdSet hit usec"],
+           rows)
+
+
+if __name__ == "__main__":
+    main()
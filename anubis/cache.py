@@ -0,0 +1,362 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# cache.py - process-local caches.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Process-local caching helpers, and per-model generation counters used to
+invalidate shared caches.
+"""
+
+import sys
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import connections, router, transaction
+from django.db.models.signals import post_delete, post_save
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class LRUCache:
+    """A thread-safe, size-bounded mapping that evicts the least recently used
+    entries first.
+
+    Args:
+        maxsize (int): Maximum number of entries kept.
+        ttl (Optional[float]): If given, entries expire this many seconds
+            after being set.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.time() + self.ttl
+
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self._data))
+
+    def values(self):
+        with self._lock:
+            return [value for _, value in self._data.values()]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class NearCache:
+    """An in-process :class:`LRUCache` with a short TTL in front of a shared
+    Django cache, sparing a network round trip for hot keys.
+
+    Keys are the same as in the shared cache, so entries whose keys include a
+    generation are invalidated in both tiers at once. Values found in the near
+    tier are the very objects stored, not copies, so they must not be
+    changed. :meth:`add`, used for locks, always goes to the shared cache.
+
+    Args:
+        alias (str): The alias of the shared Django cache.
+        maxsize (int): Maximum number of entries kept in process.
+        ttl (float): For how many seconds entries are kept in process.
+    """
+
+    def __init__(self, alias, maxsize, ttl):
+        self.alias = alias
+        self.near = LRUCache(maxsize, ttl=ttl)
+        self.shared_hits = 0
+        self.shared_misses = 0
+        self._lock = Lock()
+
+    @property
+    def cache(self):
+        # Django cache instances are per thread
+        return caches[self.alias]
+
+    @property
+    def default_timeout(self):
+        return self.cache.default_timeout
+
+    def get(self, key, default=None):
+        value = self.near.get(key, None)
+
+        if value is not None:
+            return value
+
+        value = self.cache.get(key, None)
+
+        with self._lock:
+            if value is None:
+                self.shared_misses += 1
+            else:
+                self.shared_hits += 1
+
+        if value is None:
+            return default
+
+        self.near.set(key, value)
+
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        self.cache.set(key, value, timeout)
+        self.near.set(key, value)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT):
+        return self.cache.add(key, value, timeout)
+
+    def delete(self, key):
+        self.near.delete(key)
+        self.cache.delete(key)
+
+    def info(self):
+        """Reports hits and misses per tier, and an estimate of the memory
+        taken by the near tier.
+
+        Returns:
+            dict: The statistics.
+        """
+        near = self.near.info()
+
+        with self._lock:
+            shared_hits, shared_misses = self.shared_hits, self.shared_misses
+
+        return {
+            "near": near._asdict(),
+            "near_bytes": sum(len(value) if isinstance(value, bytes)
+                              else sys.getsizeof(value)
+                              for value in self.near.values()),
+            "shared": {"hits": shared_hits, "misses": shared_misses},
+        }
+
+
+_near_caches = {}
+_near_caches_lock = Lock()
+
+
+def get_near_cache(alias, maxsize, ttl):
+    """Gets the process-wide :class:`NearCache` in front of `caches[alias]`.
+    """
+    with _near_caches_lock:
+        key = (alias, maxsize, ttl)
+
+        if key not in _near_caches:
+            _near_caches[key] = NearCache(alias, maxsize, ttl)
+
+        return _near_caches[key]
+
+
+class CacheMetrics:
+    """Thread-safe, process-local counters of cache events.
+
+    Args:
+        *events (str): The names of the events counted.
+    """
+
+    def __init__(self, *events):
+        self._counts = OrderedDict((event, 0) for event in events)
+        self._lock = Lock()
+
+    def incr(self, event):
+        with self._lock:
+            self._counts[event] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return OrderedDict(self._counts)
+
+    def clear(self):
+        with self._lock:
+            for event in self._counts:
+                self._counts[event] = 0
+
+
+GENERATION_TABLE = "anubis_generation"
+
+_table_generations = set()
+
+
+def get_generation_cache():
+    return caches[getattr(settings, "ANUBIS_GENERATION_CACHE", "default")]
+
+
+def generation_key(model):
+    # proxies share the generation of the model they're stored in
+    return "anubis:generation:{}".format(
+        model._meta.concrete_model._meta.label_lower)
+
+
+def get_generation(model):
+    """Gets the current generation of a model.
+
+    Every write to a model through the ORM (see :func:`track_generations`)
+    moves it to a new generation, so cache keys that include it become
+    unreachable as soon as the data they were built from changes.
+
+    Args:
+        model: The Django model.
+
+    Returns:
+        str: The generation.
+    """
+    cache = get_generation_cache()
+    key = generation_key(model)
+    generation = cache.get(key, None)
+
+    if generation is None:
+        # start from the clock, so that a counter lost by eviction doesn't
+        # restart at a value already used
+        cache.add(key, int(time.time() * 1000), None)
+        generation = cache.get(key, 0)
+
+    generation = str(generation)
+
+    if model._meta.concrete_model in _table_generations:
+        generation += ".{}".format(get_table_generation(model))
+
+    return generation
+
+
+def get_generations(models):
+    """Returns the current generations of `models`, joined into a single
+    cache key component.
+    """
+    return "-".join(get_generation(model) for model in models)
+
+
+def get_last_modified(model):
+    """Gets when a tracked model was last written to through the ORM, as a
+    Unix timestamp, or :const:`None` if that's unknown.
+
+    It is never known for models with a generation table (see
+    :func:`track_table_generations`), since their bulk writes bypass the
+    ORM.
+    """
+    if model._meta.concrete_model in _table_generations:
+        return None
+
+    return get_generation_cache().get(
+        "{}:modified".format(generation_key(model)), None)
+
+
+def bump_generation(model):
+    cache = get_generation_cache()
+    key = generation_key(model)
+
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, int(time.time() * 1000), None)
+
+    cache.set("{}:modified".format(key), int(time.time()), None)
+
+
+def get_table_generation(model):
+    """Reads the counter kept by the
+    :class:`anubis.operations.AddGenerationTrigger` of a model.
+    """
+    connection = connections[router.db_for_read(model)]
+
+    with connection.cursor() as cursor:
+        cursor.execute("select generation from {} where name = %s".format(
+            connection.ops.quote_name(GENERATION_TABLE)),
+                       [model._meta.db_table])
+        row = cursor.fetchone()
+
+    return 0 if row is None else row[0]
+
+
+def _bump_sender_generation(sender, **kwargs):
+    # bumping before the transaction commits would let a concurrent request
+    # cache the old data under the new generation
+    transaction.on_commit(lambda: bump_generation(sender),
+                          using=kwargs.get("using"))
+
+
+def track_generations():
+    """Bumps the generation of a model whenever one of its records is saved
+    or deleted through the ORM.
+
+    Every model is tracked, whether or not this process ever reads it, since
+    writes often happen in processes (e.g., the admin or management
+    commands) that never use the views caching it. This is called when the
+    Anubis app is ready.
+    """
+    post_save.connect(_bump_sender_generation,
+                      dispatch_uid="anubis_generation")
+    post_delete.connect(_bump_sender_generation,
+                        dispatch_uid="anubis_generation")
+
+
+def track_table_generations(*models):
+    """Includes in the generations of `models` the counters kept by their
+    :class:`anubis.operations.AddGenerationTrigger`, which catch bulk writes
+    that bypass the ORM signals. Models listed in the
+    `ANUBIS_GENERATION_TABLE_MODELS` setting are registered when the Anubis
+    app is ready.
+    """
+    _table_generations.update(model._meta.concrete_model for model in models)
@@ -19,7 +19,7 @@
 # este programa. Se não, consulte <http://www.gnu.org/licenses/>.
 
 from anubis.filters import Filter
-from anubis.query import ProcedureQuerySet
+from anubis.query import ProcedureQuerySet, filter_by_ids
 from django.conf import settings
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import NotFoundError
@@ -189,7 +189,7 @@ class ElasticQuerySet(ProcedureQuerySet):
         es_queryset = scan(es_server, **kwargs)
         data = {d["_id"]: d for d in es_queryset}
 
-        queryset = self.filter(id__in=data.keys())
+        queryset = filter_by_ids(self, data.keys())
 
         if save_score or save_highlights:
             for element in queryset:
@@ -202,6 +202,8 @@ class ElasticQuerySet(ProcedureQuerySet):
 
 
 class ElasticFilter(Filter):
+    cost = 100
+
     def __init__(self, es_field_name, **es_kwargs):
         self.kwargs = es_kwargs
         self.field_name = es_field_name
@@ -233,7 +235,7 @@ class ElasticFilter(Filter):
         pass
 
     def _filter_django_queryset(self, queryset, args, es_data):
-        return queryset.filter(id__in=es_data.keys())
+        return filter_by_ids(queryset, es_data.keys())
 
     def _build_kwargs(self, queryset, args):
         path = self.get_path(queryset)
@@ -333,7 +335,7 @@ class ElasticHasFTSFilter(ElasticFilter):
 
         fts_missing = have_empty_field | have_no_doc
 
-        return queryset.exclude(id__in=list(fts_missing))
+        return filter_by_ids(queryset, fts_missing, exclude=True)
 
     def should_import_results(self):
         return False
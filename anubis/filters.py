@@ -25,11 +25,21 @@ from django import forms
 from django.db.models.query import Q
 
 from anubis.forms import FilterForm, RangeForm
-from anubis.query import ProcedureQuerySet
+from anubis.query import ProcedureQuerySet, spans_multi_valued_relation
 
 
 class Filter:
+    """
+    Attributes:
+        cost (int): A rough hint of how expensive this filter is to run,
+            used to order units when planning an expression (see
+            :class:`anubis.aggregators.QuerySetAggregator`). Filters costing
+            at least :attr:`QuerySetAggregator.expensive_cost` are assumed to
+            hit the database or an external service when called.
+    """
+
     base_form = FilterForm
+    cost = 1
 
     def __init__(self, identifier):
         self.identifier = identifier
@@ -40,6 +50,25 @@ class Filter:
     def filter_queryset(self, queryset, args):
         raise NotImplementedError()
 
+    def filter_q(self, args, model):
+        """Optionally expresses this filter as a single :class:`Q` object.
+
+        Filters that can do so let :class:`anubis.aggregators.QuerySetAggregator`
+        fold a whole expression into a single `.filter()` call instead of
+        combining one queryset per unit. Filters whose lookups span
+        multi-valued relations shouldn't, since that would require a single
+        related row to match every condition of the expression.
+
+        Args:
+            args (list): The validated arguments.
+            model: The model being searched.
+
+        Returns:
+            Optional[django.db.models.Q]: The condition, or :const:`None` if
+            this filter must go through :meth:`filter_queryset`.
+        """
+        return None
+
     def identify(self, identifier):
         self.identifier = identifier
         return self
@@ -111,6 +140,7 @@ class ConversionFilter(Filter):
         self.description = base_filter.description
         self.fields = base_filter.fields
         self.field_keys = base_filter.field_keys
+        self.cost = base_filter.cost
 
     def filter_queryset(self, queryset, args):
         base_queryset = self.base_filter.filter_queryset(self.source_queryset(),
@@ -126,6 +156,8 @@ class ConversionFilter(Filter):
 
 
 class ProcedureFilter(Filter):
+    cost = 10
+
     def __init__(self, procedure_name):
         self.procedure_name = procedure_name
         super().__init__(procedure_name)
@@ -137,6 +169,8 @@ class ProcedureFilter(Filter):
 
 
 class ChoiceProcedureFilter(Filter):
+    cost = 10
+
     def __init__(self, identifier, choices=None):
         super().__init__(identifier)
 
@@ -200,6 +234,15 @@ class QuerySetFilter(Filter):
         self.suffix = suffix
 
     def filter_queryset(self, queryset, args):
+        return queryset.filter(self._make_q(args))
+
+    def filter_q(self, args, model):
+        if spans_multi_valued_relation(model, self.field_name):
+            return None
+
+        return self._make_q(args)
+
+    def _make_q(self, args):
         query_field = self.field_name
 
         if len(self.suffix) > 0:
@@ -207,7 +250,7 @@ class QuerySetFilter(Filter):
 
         complex_filter = [Q(**{query_field: arg}) for arg in args]
 
-        return queryset.filter(reduce(self.connector, complex_filter))
+        return reduce(self.connector, complex_filter)
 
 
 class MultiQuerySetFilter(Filter):
@@ -217,14 +260,26 @@ class MultiQuerySetFilter(Filter):
         self.connector = connector
 
     def filter_queryset(self, queryset, args):
+        return queryset.filter(self._make_q(args))
+
+    def filter_q(self, args, model):
+        if any(spans_multi_valued_relation(model, field)
+               for field in self.fields_names):
+            return None
+
+        return self._make_q(args)
+
+    def _make_q(self, args):
         complex_filter = [Q(**{field: arg}) \
                           for field, arg in zip(self.fields_names, args) \
                           if arg is not None]
 
-        return queryset.filter(reduce(self.connector, complex_filter, Q()))
+        return reduce(self.connector, complex_filter, Q())
 
 
 class FullTextFilter(Filter):
+    cost = 5
+
     def __init__(self, field_name):
         self.field_name = field_name
         super().__init__(field_name)
@@ -243,6 +298,8 @@ class FullTextFilter(Filter):
 
 
 class TrigramFilter(Filter):
+    cost = 5
+
     def __init__(self, field_name, connector=operator.or_):
         self.field_name = field_name
         super().__init__(field_name)
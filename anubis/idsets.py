@@ -0,0 +1,385 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# idsets.py - compact encoding of sets of primary keys.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compact, versioned encoding of sets of integer primary keys, used to store
+search units in the cache. Other primary keys (e.g., UUIDs) can't be encoded.
+
+An encoded set starts with a version byte and a format byte. Sparse sets are
+stored as the varint-encoded gaps between the sorted ids; dense sets are
+stored as the smallest id followed by a bitmap of the ids relative to it.
+Whichever is smaller is chosen.
+
+:class:`IdSet` implements set algebra over ids, mostly as bitmaps, so that
+whole expressions can be evaluated in memory over cached units.
+"""
+
+from itertools import accumulate
+
+VERSION = 1
+
+DELTA = 0
+BITMAP = 1
+
+
+def encode(ids, max_bytes=None):
+    """Encodes a collection of non-negative integers.
+
+    Args:
+        ids (Iterable[int]): The ids. Duplicates are discarded.
+        max_bytes (Optional[int]): The maximum size of the encoded set.
+
+    Returns:
+        Optional[bytes]: The encoded set, or :const:`None` if it would be
+        larger than `max_bytes`.
+
+    Raises:
+        ValueError: If some id isn't a non-negative integer (e.g., UUID
+            primary keys).
+    """
+    ids = set(ids)
+
+    if not all(isinstance(value, int) for value in ids):
+        raise ValueError("Only integer ids can be encoded.")
+
+    ids = sorted(ids)
+
+    if ids and ids[0] < 0:
+        raise ValueError("Only non-negative ids can be encoded.")
+
+    payload = _encode_delta(ids)
+
+    # the bitmap is only built if it is smaller, as sparse ids far from zero
+    # would need a huge one
+    if ids and (ids[-1] - ids[0]) // 8 + 1 < len(payload):
+        bitmap = _encode_bitmap(ids)
+
+        if len(bitmap) < len(payload):
+            payload = bitmap
+
+    if max_bytes is not None and len(payload) > max_bytes:
+        return None
+
+    return payload
+
+
+def decode(data):
+    """Decodes a set encoded by :func:`encode`.
+
+    Args:
+        data (bytes): The encoded set.
+
+    Returns:
+        List[int]: The sorted ids.
+
+    Raises:
+        ValueError: If `data` isn't an encoded set of a known version or
+            is truncated.
+    """
+    if not isinstance(data, bytes) or len(data) < 2 or data[0] != VERSION:
+        raise ValueError("Not an encoded id set.")
+
+    try:
+        if data[1] == DELTA:
+            return _decode_delta(data)
+        elif data[1] == BITMAP:
+            return _decode_bitmap(data)
+    except IndexError:
+        raise ValueError("Truncated id set.")
+
+    raise ValueError("Unknown id set format: {}".format(data[1]))
+
+
+class IdSet:
+    """An immutable set of non-negative integer ids.
+
+    Sets are kept as a bitmap in a Python integer, relative to their smallest
+    id, so that intersection (`&`), union (`|`) and difference (`-`, used for
+    complements against the universe of ids) run over whole machine words.
+    Sets whose bitmap would take more than :attr:`max_bits_per_id` bits per
+    id (e.g., a few ids in the billions) are kept as a frozenset instead.
+
+    Args:
+        bitmap (int): Bit `n` is set if id `base + n` belongs to the set.
+        base (int): The id of the first bit of `bitmap`.
+    """
+
+    __slots__ = ("bitmap", "base", "sparse")
+
+    max_bits_per_id = 64
+
+    def __init__(self, bitmap=0, base=0):
+        self.sparse = None
+
+        if bitmap:
+            # the lowest bit set is the smallest id
+            shift = (bitmap & -bitmap).bit_length() - 1
+            bitmap >>= shift
+            base += shift
+
+            if bitmap.bit_length() > self.max_bits_per_id * _popcount(bitmap):
+                self.sparse = frozenset(_int_ids(bitmap, base))
+                bitmap = base = 0
+        else:
+            base = 0
+
+        self.bitmap = bitmap
+        self.base = base
+
+    @classmethod
+    def from_ids(cls, ids):
+        ids = list(ids)
+
+        if not ids:
+            return cls()
+
+        base = min(ids)
+        span = max(ids) - base + 1
+
+        # duplicates may only make the bitmap seem denser than it is, which
+        # the constructor checks again
+        if span > cls.max_bits_per_id * len(ids):
+            id_set = cls()
+            id_set.sparse = frozenset(ids)
+
+            return id_set
+
+        return cls(_make_bitmap(ids, base, span), base)
+
+    @classmethod
+    def decode(cls, data):
+        """Builds a set from the output of :func:`encode`, without listing
+        its ids if it is stored as a bitmap.
+        """
+        if isinstance(data, bytes) and len(data) > 2 and \
+                data[0] == VERSION and data[1] == BITMAP:
+            try:
+                base, position = _read_varint(data, 2)
+            except IndexError:
+                raise ValueError("Truncated id set.")
+
+            return cls(int.from_bytes(data[position:], "little"), base)
+
+        return cls.from_ids(decode(data))
+
+    def encode(self, max_bytes=None):
+        return encode(self, max_bytes=max_bytes)
+
+    def __and__(self, other):
+        if self.sparse is not None or other.sparse is not None:
+            smaller, larger = sorted((self, other), key=len)
+
+            return IdSet.from_ids(value for value in smaller
+                                  if value in larger)
+
+        base = max(self.base, other.base)
+
+        return IdSet((self.bitmap >> (base - self.base)) &
+                     (other.bitmap >> (base - other.base)), base)
+
+    def __or__(self, other):
+        if self.sparse is None and other.sparse is None:
+            base = min(self.base, other.base)
+            end = max(self.base + self.bitmap.bit_length(),
+                      other.base + other.bitmap.bit_length())
+
+            # shifting both bitmaps to the same base only pays off if the
+            # result isn't too sparse
+            if end - base <= self.max_bits_per_id * (len(self) + len(other)):
+                return IdSet((self.bitmap << (self.base - base)) |
+                             (other.bitmap << (other.base - base)), base)
+
+        return IdSet.from_ids(self._ids() | other._ids())
+
+    def __sub__(self, other):
+        if self.sparse is not None:
+            return IdSet.from_ids(value for value in self.sparse
+                                  if value not in other)
+
+        length = self.bitmap.bit_length()
+        offset = other.base - self.base
+
+        # only the bits of `other` within this set's bitmap matter
+        if other.sparse is not None:
+            mask = _make_bitmap((value for value in other.sparse
+                                 if 0 <= value - self.base < length),
+                                self.base, length)
+        elif offset >= 0:
+            mask = (other.bitmap & ((1 << max(length - offset, 0)) - 1)) \
+                << offset
+        else:
+            mask = other.bitmap >> -offset
+
+        return IdSet(self.bitmap & ~mask, self.base)
+
+    def __contains__(self, value):
+        if self.sparse is not None:
+            return value in self.sparse
+
+        offset = value - self.base
+
+        return self.bitmap != 0 and offset >= 0 and \
+            bool(self.bitmap >> offset & 1)
+
+    def __len__(self):
+        if self.sparse is not None:
+            return len(self.sparse)
+
+        return _popcount(self.bitmap)
+
+    def __iter__(self):
+        if self.sparse is not None:
+            return iter(sorted(self.sparse))
+
+        return iter(_int_ids(self.bitmap, self.base))
+
+    def _ids(self):
+        return self.sparse if self.sparse is not None else frozenset(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, IdSet):
+            return NotImplemented
+
+        return (self.sparse, self.base, self.bitmap) == \
+            (other.sparse, other.base, other.bitmap)
+
+    def __hash__(self):
+        return hash((self.sparse, self.base, self.bitmap))
+
+    def __repr__(self):
+        return "IdSet({})".format(list(self))
+
+
+def _make_bitmap(ids, base, span):
+    bitmap = bytearray((span + 7) // 8)
+
+    for value in ids:
+        offset = value - base
+        bitmap[offset >> 3] |= 1 << (offset & 7)
+
+    return int.from_bytes(bitmap, "little")
+
+
+def _popcount(bitmap):
+    return bin(bitmap).count("1")
+
+
+def _int_ids(bitmap, base):
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+
+    return _bitmap_ids(data, base)
+
+
+def _write_varint(buffer, value):
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    buffer.append(value)
+
+
+def _read_varint(data, position):
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+
+        if byte < 0x80:
+            return value, position
+
+
+def _encode_delta(ids):
+    buffer = bytearray([VERSION, DELTA])
+    _write_varint(buffer, len(ids))
+
+    previous = 0
+
+    for value in ids:
+        _write_varint(buffer, value - previous)
+        previous = value
+
+    return bytes(buffer)
+
+
+def _decode_delta(data):
+    count, position = _read_varint(data, 2)
+    payload = data[position:]
+
+    # every gap fits in a single byte, as in most dense enough sets
+    if len(payload) == count and (count == 0 or max(payload) < 0x80):
+        return list(accumulate(payload))
+
+    ids = []
+    previous = value = shift = 0
+
+    for byte in payload:
+        value |= (byte & 0x7f) << shift
+
+        if byte >= 0x80:
+            shift += 7
+            continue
+
+        previous += value
+        ids.append(previous)
+        value = shift = 0
+
+        if len(ids) == count:
+            return ids
+
+    if len(ids) < count:
+        raise IndexError("Truncated id set.")
+
+    return ids
+
+
+def _encode_bitmap(ids):
+    base = ids[0]
+    bitmap = bytearray((ids[-1] - base) // 8 + 1)
+
+    for value in ids:
+        offset = value - base
+        bitmap[offset >> 3] |= 1 << (offset & 7)
+
+    buffer = bytearray([VERSION, BITMAP])
+    _write_varint(buffer, base)
+    buffer.extend(bitmap)
+
+    return bytes(buffer)
+
+
+def _decode_bitmap(data):
+    base, position = _read_varint(data, 2)
+
+    return _bitmap_ids(data[position:], base)
+
+
+# the positions of the bits set in each byte value
+_BYTE_BITS = [tuple(bit for bit in range(8) if value & (1 << bit))
+              for value in range(256)]
+
+
+def _bitmap_ids(bitmap, base=0):
+    return [base + (index << 3) + bit
+            for index, byte in enumerate(bitmap) if byte
+            for bit in _BYTE_BITS[byte]]
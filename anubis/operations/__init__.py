@@ -35,7 +35,8 @@ from anubis.operations.functions import AddFunction, AddSearchFunction, \
 from anubis.operations.views import AddView, AddMaterializedView
 
 from anubis.operations.triggers import AddTrigger, AddTableTrigger, \
-    AddRefreshMaterializedViewTrigger, AddRefreshMaterializedViewTableTrigger
+    AddRefreshMaterializedViewTrigger, AddRefreshMaterializedViewTableTrigger, \
+    AddGenerationTrigger
 
 __all__ = ["AddCustomIndex",
            "AddCustomViewIndex",
@@ -55,7 +56,8 @@ __all__ = ["AddCustomIndex",
            "AddTrigger",
            "AddTableTrigger",
            "AddRefreshMaterializedViewTrigger",
-           "AddRefreshMaterializedViewTableTrigger"
+           "AddRefreshMaterializedViewTableTrigger",
+           "AddGenerationTrigger"
           ]
 
 
@@ -144,3 +144,38 @@ class AddRefreshMaterializedViewTableTrigger(AddTableTrigger):
 
         super().__init__(trigger_table, "refresh_{}".format(view_name),
                          commands)
+
+
+class AddGenerationTrigger(AddTrigger):
+    """Keeps a generation counter for a model, bumped by every statement that
+    writes to its table (including bulk writes that bypass Django's signals).
+    See :func:`anubis.cache.track_table_generations`.
+    """
+
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model):
+        commands = """
+            update anubis_generation set generation = generation + 1
+                where name = '{table}';
+        """.format(table=model._meta.db_table)
+
+        super().__init__(model, "generation", commands)
+
+    def _sql(self):
+        # the row is seeded here rather than inserted by the trigger, as two
+        # concurrent first writes would both miss it and collide inserting it
+        sql = """
+            create table if not exists anubis_generation (
+                name varchar(255) primary key,
+                generation bigint not null default 0
+            );
+
+            insert into anubis_generation (name, generation)
+                select '{table}', 0
+                where not exists (select 1 from anubis_generation
+                                  where name = '{table}');
+        """.format(table=self.table_name)
+
+        return sql + super()._sql()
@@ -18,6 +18,8 @@
 # Você deve ter recebido uma cópia da Licença Pública Geral GNU junto com
 # este programa. Se não, consulte <http://www.gnu.org/licenses/>.
 
+from django.core.paginator import Paginator
+
 
 class ContextSerializerMixin:
     _original_object_name = "data"
@@ -34,3 +36,19 @@ class ContextSerializerMixin:
             data = original_data
 
         return data
+
+
+class CountedPaginator(Paginator):
+    """A :class:`Paginator` that can be told the number of objects beforehand,
+    sparing a `COUNT(*)` query.
+
+    Args:
+        count (Optional[int]): The number of objects, if known.
+    """
+
+    def __init__(self, *args, count=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if count is not None:
+            # overrides the cached property
+            self.__dict__["count"] = count
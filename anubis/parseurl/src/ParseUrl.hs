@@ -39,6 +39,10 @@ import Control.Monad.Identity (Identity)
 import Control.Monad.IO.Class (MonadIO, liftIO)
 
 import Foreign.C
+import Foreign.Marshal.Alloc (free, mallocBytes)
+import Foreign.Marshal.Utils (copyBytes)
+import Foreign.Ptr (plusPtr)
+import Foreign.Storable (poke)
 import Control.Applicative
 import Text.Parsec.Expr
 
@@ -55,8 +59,37 @@ data BooleanExpr = And { left :: BooleanExpr, right :: BooleanExpr }
                  | BooleanExpr Search
                  deriving (Show, G.Generic)
 
-instance A.FromJSON BooleanExpr
-instance A.ToJSON BooleanExpr
+-- Cadeias de um mesmo operador são achatadas numa lista de operandos, para
+-- que o JSON não aninhe um objeto por operador (o módulo json do Python
+-- decodifica objetos aninhados recursivamente).
+instance A.ToJSON BooleanExpr where
+    toJSON expr@(And _ _) = A.object [ "tag" .= ("And" :: T.Text)
+                                     , "operands" .= flatten splitAnd expr
+                                     ]
+    toJSON expr@(Or _ _) = A.object [ "tag" .= ("Or" :: T.Text)
+                                    , "operands" .= flatten splitOr expr
+                                    ]
+    toJSON (Not expr) = A.object [ "tag" .= ("Not" :: T.Text)
+                                 , "contents" .= expr
+                                 ]
+    toJSON (BooleanExpr expr) = A.object [ "tag" .= ("BooleanExpr" :: T.Text)
+                                         , "contents" .= expr
+                                         ]
+
+flatten :: (BooleanExpr -> Maybe (BooleanExpr, BooleanExpr)) -> BooleanExpr
+                  -> [BooleanExpr]
+flatten split expr = go expr []
+    where go e rest = case split e of
+                           Just (l, r) -> go l (go r rest)
+                           Nothing -> e : rest
+
+splitAnd :: BooleanExpr -> Maybe (BooleanExpr, BooleanExpr)
+splitAnd (And l r) = Just (l, r)
+splitAnd _ = Nothing
+
+splitOr :: BooleanExpr -> Maybe (BooleanExpr, BooleanExpr)
+splitOr (Or l r) = Just (l, r)
+splitOr _ = Nothing
 
 newtype PyException = PyExc T.Text deriving (Show, G.Generic)
 
@@ -135,13 +168,33 @@ prefix :: Parser () -> (BooleanExpr -> BooleanExpr)
 prefix op f = Prefix $ op >> return f
 
 returnObj :: (A.ToJSON a, MonadIO m) => a -> m CString
-returnObj = liftIO . flip B.useAsCString return . BL.toStrict . A.encode
+returnObj obj = liftIO . B.useAsCStringLen json $ \(src, len) -> do
+        dest <- mallocBytes (len + 1)
+        copyBytes dest src len
+        poke (dest `plusPtr` len) (0 :: CChar)
+        return dest
+    where json = BL.toStrict . A.encode $ obj
+
+foreign export ccall freeResult :: CString -> IO ()
+freeResult :: CString -> IO ()
+freeResult = free
+
+parseValue :: T.Text -> A.Value
+parseValue url = case P.parse fullExpr "" url of
+                      Right result -> A.toJSON result
+                      Left err -> A.toJSON . PyExc . T.pack . show $ err
 
 foreign export ccall parseUrl :: CString -> IO CString
 parseUrl :: CString -> IO CString
 parseUrl cUrl = do
     url <- decodeUtf8 <$> B.packCString cUrl
-    case P.parse fullExpr "" url of
-         Right result -> returnObj result
-         Left err -> returnObj . PyExc . T.pack . show $ err
+    returnObj . parseValue $ url
+
+foreign export ccall parseUrls :: CString -> IO CString
+parseUrls :: CString -> IO CString
+parseUrls cUrls = do
+    urls <- A.decodeStrict <$> B.packCString cUrls
+    case urls of
+         Just list -> returnObj . map parseValue $ (list :: [T.Text])
+         Nothing -> returnObj . PyExc $ "Expected a JSON list of expressions."
 
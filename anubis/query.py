@@ -17,14 +17,22 @@
 # Você deve ter recebido uma cópia da Licença Pública Geral GNU junto com este
 # programa. Se não, consulte <http://www.gnu.org/licenses/>.
 
-from collections import OrderedDict
+import itertools
+from collections import OrderedDict, namedtuple
 from operator import itemgetter
 
 from anubis.sql_aggregators import ProcedureOrderingAnnotation
-from django.db import connection as base_connection, connections
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import DatabaseError, connection as base_connection, \
+    connections
 from django.db import models
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
 from django.db.models.query import QuerySet
-from django.db.models.expressions import Ref, F
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import F, RawSQL, Ref
 
 
 class ProcedureQuerySet(QuerySet):
@@ -44,9 +52,31 @@ class ProcedureQuerySet(QuerySet):
                     pass
 
                 objects = QuerySet.as_manager()
+
+    Attributes:
+        inline_procedures (bool): Whether :meth:`procedure` should embed the
+            procedure call as a subquery of the resulting queryset, instead of
+            fetching the matched primary keys and filtering by them. The
+            procedure must then name its primary key column `id`. Defaults
+            to :const:`False`.
+        procedure_chunk_size (int): Default number of rows fetched at a time
+            by :meth:`iter_procedure`.
+        prepare_procedures (bool): Whether procedure calls that run on their
+            own (that is, not inlined into another query) should be prepared
+            once per database connection and then executed, which spares
+            PostgreSQL from planning them again on every call. Don't enable
+            this behind a connection pooler in transaction mode, as prepared
+            statements belong to the server session. Statements whose
+            procedure changed its result type since they were prepared are
+            prepared again, and the call retried once (unless it ran inside
+            a transaction, which the error aborts). Defaults to
+            :const:`False`.
     """
 
     order_by_procedure_column = "anubis_index"
+    inline_procedures = False
+    procedure_chunk_size = 2000
+    prepare_procedures = False
 
     def _get_connection(self):
         if self.db is not None:
@@ -68,12 +98,34 @@ class ProcedureQuerySet(QuerySet):
         return source, dest
 
     def order_by_procedure(self, procname, *args, field='id', extra_fields=None,
-                           **kwargs):
+                           join=False, **kwargs):
         aggregate = self.procedure_aggregate(procname, *args, **kwargs)
         return self.order_by_aggregates(aggregate, field=field,
-                                        extra_fields=extra_fields)
+                                        extra_fields=extra_fields, join=join)
+
+    def order_by_aggregates(self, *aggregates, field="id", extra_fields=None,
+                            join=False):
+        """Orders the queryset by ranking procedures.
+
+        Args:
+            *aggregates (anubis.sql_aggregators.ProcedureOrderingAnnotation):
+                The ranking annotations, in order of precedence.
+            field (str): A field to break ties. Ignored if `extra_fields` is
+                given.
+            extra_fields (Optional[List[str]]): Fields to break ties.
+            join (bool): Whether to join the results of each ranking procedure
+                once, instead of running a correlated subquery per row. Records
+                the procedure doesn't rank are kept, with a null rank.
+
+        Returns:
+            ProcedureQuerySet: The ordered queryset.
+        """
+        queryset = self
+
+        if join:
+            queryset = self._clone()
+            aggregates = [agg.join_to(queryset.query) for agg in aggregates]
 
-    def order_by_aggregates(self, *aggregates, field="id", extra_fields=None):
         annotation = OrderedDict([
             ("{}_{}".format(agg.default_alias, i), agg)
             for i, agg in enumerate(aggregates)
@@ -87,7 +139,7 @@ class ProcedureQuerySet(QuerySet):
         else:
             fields.append(F(field))
 
-        return self.annotate(**annotation).order_by(*fields)
+        return queryset.annotate(**annotation).order_by(*fields)
 
     def procedure_aggregate(self, procname, *args, **kwargs):
         """Helper method for generating ordering annotations.
@@ -101,6 +153,82 @@ class ProcedureQuerySet(QuerySet):
 
         return ProcedureOrderingAnnotation(procname, *args, **kwargs)
 
+    def _procedure_name(self, connection, procname):
+        procname = "{}_{}".format(self.model._meta.db_table, procname)
+
+        return connection.ops.quote_name(procname)
+
+    def _procedure_call(self, connection, procname, args):
+        procname = self._procedure_name(connection, procname)
+
+        args = list(args)
+
+        arg_marks = ["%s"] * len(args)
+        arg_marks = ", ".join(arg_marks)
+
+        return "{}({})".format(procname, arg_marks), args
+
+    def _execute_procedure(self, connection, cursor, procname, args):
+        if not self.prepare_procedures:
+            call, args = self._procedure_call(connection, procname, args)
+            cursor.execute("select * from {};".format(call), args)
+            return
+
+        self._execute_prepared(connection, cursor,
+                               self._procedure_name(connection, procname),
+                               list(args))
+
+    def _execute_prepared(self, connection, cursor, procname, args,
+                          retry=True):
+        statements = prepared_statements(connection)
+        key = (procname, len(args))
+        statement = statements.get(key)
+
+        if statement is None:
+            statement = "anubis_procedure_{}".format(next(_statement_numbers))
+            placeholders = ", ".join(["${}".format(i + 1)
+                                      for i in range(len(args))])
+
+            cursor.execute("prepare {} as select * from {}({});".format(
+                statement, procname, placeholders))
+            statements[key] = statement
+
+        try:
+            if len(args) > 0:
+                cursor.execute("execute {}({});".format(
+                    statement, ", ".join(["%s"] * len(args))), args)
+            else:
+                cursor.execute("execute {};".format(statement))
+        except DatabaseError as error:
+            if "cached plan must not change result type" not in str(error):
+                raise
+
+            # the procedure was replaced (e.g., by a migration run elsewhere)
+            # since it was prepared
+            del statements[key]
+
+            # the failed statement aborted the transaction, if there's one
+            if not retry or connection.in_atomic_block:
+                raise
+
+            cursor.execute("deallocate {};".format(statement))
+            self._execute_prepared(connection, cursor, procname, args,
+                                   retry=False)
+
+    def _inline_procedure(self, procname, args):
+        connection = self._get_connection()
+        call, args = self._procedure_call(connection, procname, args)
+
+        qn = connection.ops.quote_name
+        alias = qn("anubis_procedure")
+
+        # the id column is selected by name, so that procedures returning
+        # more columns (e.g., a rank) can be inlined as well
+        subquery = "select {alias}.{id} from {call} as {alias}".format(
+            id=qn("id"), alias=alias, call=call)
+
+        return self.filter(pk__in=RawSQL(subquery, args))
+
     def procedure(self, procname, *args):
         """This method calls a procedure from the database.
 
@@ -129,24 +257,22 @@ class ProcedureQuerySet(QuerySet):
         Returns:
             ProcedureQuerySet: A queryset containing the records whose primary
             keys match the ones in the array returned by the database stored
-            procedure.
+            procedure. If :attr:`inline_procedures` is set, the procedure
+            is called from within the resulting query instead, so its results
+            never leave the database.
         """
+        if self.inline_procedures:
+            return self._inline_procedure(procname, args)
+
         connection = self._get_connection()
         cursor = connection.cursor()
 
-        procname = "{}_{}".format(self.model._meta.db_table, procname)
-        procname = connection.ops.quote_name(procname)
-
-        args = list(args)
-
-        arg_marks = ["%s"] * len(args)
-        arg_marks = ", ".join(arg_marks)
-
-        query = "select * from {}({});".format(procname, arg_marks)
-
-        cursor.execute(query, args)
+        self._execute_procedure(connection, cursor, procname, args)
         ids = [i[0] for i in cursor.fetchall()]
 
+        if len(ids) == 0:
+            return self.none()
+
         return self.filter(id__in=ids)
 
     def unchainable_procedure(self, procname, *args):
@@ -154,41 +280,224 @@ class ProcedureQuerySet(QuerySet):
         connection = self._get_connection()
         cursor = connection.cursor()
 
-        procname = "{}_{}".format(self.model._meta.db_table, procname)
-        procname = connection.ops.quote_name(procname)
+        self._execute_procedure(connection, cursor, procname, args)
 
-        args = list(args)
+        result = [{k: v for k, v in zip(map(itemgetter(0), cursor.description),
+                                        row)} for row in cursor.fetchall()]
 
-        arg_marks = ["%s"] * len(args)
-        arg_marks = ", ".join(arg_marks)
+        return result
 
-        query = "select * from {}({});".format(procname, arg_marks)
+    def iter_procedure(self, procname, *args, chunk_size=None,
+                       row_type=dict):
+        """Streams the results of a procedure that are not records.
 
-        cursor.execute(query, args)
+        Like :meth:`unchainable_procedure`, but rows are read from a
+        server-side cursor in chunks and yielded as they arrive, so memory use
+        doesn't grow with the size of the result.
 
-        result = [{k: v for k, v in zip(map(itemgetter(0), cursor.description),
-                                        row)} for row in cursor.fetchall()]
+        Args:
+            procname (str): The name of the procedure, minus the starting
+                "[table_name]_" prefix. See the note on :meth:`procedure`.
+            *args: Arguments to be passed to the procedure.
+            chunk_size (Optional[int]): Number of rows fetched at a time.
+                Defaults to :attr:`procedure_chunk_size`.
+            row_type (type): Either :class:`tuple`, :class:`dict` or
+                :class:`collections.namedtuple`, the type of each yielded row.
+
+        Yields:
+            The rows returned by the procedure.
+        """
+        if chunk_size is None:
+            chunk_size = self.procedure_chunk_size
 
-        return result
+        connection = self._get_connection()
+        cursor = connection.chunked_cursor()
+
+        try:
+            call, args = self._procedure_call(connection, procname, args)
+            cursor.execute("select * from {};".format(call), args)
+
+            make_row = None
+
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+
+                if not rows:
+                    break
+
+                if make_row is None:
+                    columns = [column[0] for column in cursor.description]
+                    make_row = self._row_factory(row_type, columns)
+
+                for row in rows:
+                    yield make_row(row)
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _row_factory(row_type, columns):
+        if row_type is tuple:
+            return tuple
+        elif row_type is dict:
+            return lambda row: dict(zip(columns, row))
+        elif row_type is namedtuple:
+            return namedtuple("ProcedureRow", columns, rename=True)._make
+
+        raise ValueError("Unsupported row type: {}".format(row_type))
 
     def single_valued_procedure(self, procname, *args):
         """Returns a single valued result."""
         connection = self._get_connection()
         cursor = connection.cursor()
 
-        procname = "{}_{}".format(self.model._meta.db_table, procname)
-        procname = connection.ops.quote_name(procname)
+        self._execute_procedure(connection, cursor, procname, args)
 
-        args = list(args)
+        return cursor.fetchone()[0]
 
-        arg_marks = ["%s"] * len(args)
-        arg_marks = ", ".join(arg_marks)
 
-        query = "select * from {}({});".format(procname, arg_marks)
+_statement_numbers = itertools.count(1)
 
-        cursor.execute(query, args)
 
-        return cursor.fetchone()[0]
+def prepared_statements(connection):
+    """Returns the procedure statements prepared on the current session of
+    `connection`, mapping `(procedure name, arity)` to statement names.
+    """
+    raw_connection = connection.connection
+    prepared = getattr(connection, "_anubis_prepared", None)
+
+    if prepared is None or prepared[0] is not raw_connection:
+        prepared = (raw_connection, {})
+        connection._anubis_prepared = prepared
+
+    return prepared[1]
+
+
+@receiver(connection_created)
+def forget_prepared_statements(sender, connection, **kwargs):
+    connection._anubis_prepared = None
+
+
+@receiver(post_migrate)
+def deallocate_prepared_statements(sender, **kwargs):
+    # migrations may change the procedures' signatures and result types
+    for connection in connections.all():
+        prepared = getattr(connection, "_anubis_prepared", None)
+
+        if prepared is not None and prepared[1] and \
+                prepared[0] is connection.connection:
+            with connection.cursor() as cursor:
+                cursor.execute("deallocate all;")
+
+        connection._anubis_prepared = None
+
+
+def filter_by_ids(queryset, ids, exclude=False):
+    """Filters a queryset by a set of primary keys already in Python.
+
+    The lookup used depends on the size of the set: a plain `IN` list for
+    small sets, a single array parameter (`= any(%s)`) for medium sets and an
+    `unnest` of that array for large sets, which PostgreSQL can plan as a
+    join instead of checking each row against the whole array. Thresholds are
+    taken from the `ANUBIS_ID_LIST_MAX_SIZE` (default: 1000) and
+    `ANUBIS_ID_ARRAY_MAX_SIZE` (default: 100000) settings. The array
+    strategies are lookups (:class:`IdArrayLookup` and
+    :class:`IdUnnestLookup`), so the result can be nested in other queries.
+
+    Args:
+        queryset (django.db.models.QuerySet): The queryset to be filtered.
+        ids (Iterable): The primary keys.
+        exclude (bool): Whether to exclude the given records instead.
+
+    Returns:
+        django.db.models.QuerySet: The filtered queryset.
+    """
+    pk = queryset.model._meta.pk
+    ids = [pk.to_python(i) for i in ids]
+
+    if len(ids) == 0:
+        return queryset if exclude else queryset.none()
+
+    list_max = getattr(settings, "ANUBIS_ID_LIST_MAX_SIZE", 1000)
+    array_max = getattr(settings, "ANUBIS_ID_ARRAY_MAX_SIZE", 100000)
+
+    if len(ids) <= list_max:
+        if exclude:
+            return queryset.exclude(pk__in=ids)
+
+        return queryset.filter(pk__in=ids)
+
+    if len(ids) <= array_max:
+        lookup = "pk__{}".format(IdArrayLookup.lookup_name)
+    else:
+        lookup = "pk__{}".format(IdUnnestLookup.lookup_name)
+
+    if exclude:
+        return queryset.exclude(**{lookup: ids})
+
+    return queryset.filter(**{lookup: ids})
+
+
+class IdArrayLookup(models.Lookup):
+    """Matches the values in a list passed as a single array parameter
+    (`= any(%s)`). Used by :func:`filter_by_ids`.
+    """
+
+    lookup_name = "anubis_any"
+    prepare_rhs = False
+    template = "{lhs} = any({array})"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        array = "%s::{}[]".format(
+            self.lhs.output_field.rel_db_type(connection))
+
+        return self.template.format(lhs=lhs, array=array), \
+            list(lhs_params) + [list(self.rhs)]
+
+
+class IdUnnestLookup(IdArrayLookup):
+    """Like :class:`IdArrayLookup`, but through an `unnest` of the array,
+    which PostgreSQL can plan as a join for large lists.
+    """
+
+    lookup_name = "anubis_unnest"
+    template = "{lhs} in (select unnest({array}))"
+
+
+models.Field.register_lookup(IdArrayLookup)
+models.Field.register_lookup(IdUnnestLookup)
+
+
+def spans_multi_valued_relation(model, lookup):
+    """Tells whether a lookup goes through a many-to-many or reverse foreign
+    key relation, in which case conditions combined in a single `.filter()`
+    call must be matched by the same related row.
+
+    Args:
+        model: The Django model the lookup starts from.
+        lookup (str): The lookup, e.g. `"groups__name__icontains"`.
+
+    Returns:
+        bool: Whether a multi-valued relation is spanned.
+    """
+    opts = model._meta
+
+    for part in lookup.split(LOOKUP_SEP):
+        try:
+            field = opts.get_field(part)
+        except FieldDoesNotExist:
+            # the rest is a transform or lookup, or the pk alias
+            return False
+
+        if field.many_to_many or field.one_to_many:
+            return True
+
+        if not field.is_relation or field.related_model is None:
+            return False
+
+        opts = field.related_model._meta
+
+    return False
 
 
 def call_procedure(procname):
@@ -201,9 +510,9 @@ def call_procedure(procname):
 
 
 def call_order_by_procedure(procname):
-    def wrapper(self, *args, field='id', extra_fields=None):
+    def wrapper(self, *args, field='id', extra_fields=None, join=False):
         return self.order_by_procedure(procname, *args, field=field,
-                                       extra_fields=extra_fields)
+                                       extra_fields=extra_fields, join=join)
 
     wrapper.__name__ = procname
 
@@ -219,6 +528,16 @@ def call_unchainable_procedure(procname):
     return wrapper
 
 
+def call_iter_procedure(procname):
+    def wrapper(self, *args, chunk_size=None, row_type=dict):
+        return self.iter_procedure(procname, *args, chunk_size=chunk_size,
+                                   row_type=row_type)
+
+    wrapper.__name__ = procname
+
+    return wrapper
+
+
 def call_single_valued_procedure(procname):
     def wrapper(self, *args):
         return self.single_valued_procedure(procname, *args)
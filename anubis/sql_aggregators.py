@@ -19,6 +19,7 @@
 # este programa. Se não, consulte <http://www.gnu.org/licenses/>.
 
 from django.db.models.expressions import RawSQL
+from django.db.models.sql.constants import LOUTER
 
 
 class ProcedureOrderingAnnotation(RawSQL):
@@ -60,6 +61,114 @@ class ProcedureOrderingAnnotation(RawSQL):
 
         return super().as_sql(compiler, connection)
 
+    def join_to(self, query):
+        """Joins the results of the ranking function to `query` once, instead
+        of looking up the rank of every row with a correlated subquery.
+
+        Only lookups on local fields are supported.
+
+        Args:
+            query (django.db.models.sql.Query): The query the function is
+                joined to. It is changed in place.
+
+        Returns:
+            ProcedureRank: An expression for the joined rank, to be used in
+            place of this annotation.
+        """
+        parent_alias = query.get_initial_alias()
+        column = query.model._meta.get_field(self.col_name).column
+        join = ProcedureJoin(self.name, self.params, parent_alias, column)
+        alias = query.join(join)
+
+        return ProcedureRank(alias, self.default_alias,
+                             output_field=getattr(self, "_output_field",
+                                                  None))
+
+
+class ProcedureJoin:
+    """A `LEFT OUTER JOIN` against the results of a ranking function, usable
+    as an entry of Django's `Query.alias_map`.
+    """
+
+    join_field = None
+    nullable = True
+
+    def __init__(self, function, params, parent_alias, parent_column,
+                 table_alias=None):
+        self.function = function
+        self.params = tuple(params)
+        self.parent_alias = parent_alias
+        self.parent_column = parent_column
+        self.table_name = "{}_res".format(function)
+        self.table_alias = table_alias
+        self.join_type = LOUTER
+
+    def as_sql(self, compiler, connection):
+        qn = connection.ops.quote_name
+        arg_marks = ", ".join(["%s"] * len(self.params))
+
+        sql = "{join_type} {function}({args}) {alias} " \
+            "ON ({alias}.id = {parent}.{column})".format(
+                join_type=self.join_type, function=self.function,
+                args=arg_marks, alias=qn(self.table_alias),
+                parent=qn(self.parent_alias), column=qn(self.parent_column))
+
+        return sql, list(self.params)
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(self.function, self.params,
+                              change_map.get(self.parent_alias,
+                                             self.parent_alias),
+                              self.parent_column,
+                              change_map.get(self.table_alias,
+                                             self.table_alias))
+
+    def equals(self, other, *args):
+        return self == other
+
+    def __eq__(self, other):
+        if not isinstance(other, ProcedureJoin):
+            return NotImplemented
+
+        return (self.function, self.params, self.parent_alias,
+                self.parent_column) == \
+            (other.function, other.params, other.parent_alias,
+             other.parent_column)
+
+    def __hash__(self):
+        return hash((self.function, self.params, self.parent_alias,
+                     self.parent_column))
+
+    def promote(self):
+        return self
+
+    def demote(self):
+        # rows without a rank must not be dropped
+        return self
+
+
+class ProcedureRank(RawSQL):
+    """The rank column of a :class:`ProcedureJoin`."""
+
+    def __init__(self, alias, name, output_field=None):
+        self.alias = alias
+        self.name = name
+
+        super().__init__("", (), output_field=output_field)
+
+    @property
+    def default_alias(self):
+        return self.name
+
+    def relabeled_clone(self, change_map):
+        clone = self.copy()
+        clone.alias = change_map.get(self.alias, self.alias)
+
+        return clone
+
+    def as_sql(self, compiler, connection):
+        return "{}.rank".format(connection.ops.quote_name(self.alias)), []
+
 ProcedureAggregate = ProcedureOrderingAnnotation
 # backwards compatibility
 
@@ -0,0 +1,30 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# __init__.py - Anubis test suite.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Anubis test suite. Run it with::
+
+    DJANGO_SETTINGS_MODULE=anubis.tests.settings python -m django test \\
+        anubis.tests
+
+The suite runs against an in-memory SQLite database, using the models of
+:mod:`django.contrib.auth`; tests that need PostgreSQL only inspect the SQL
+they generate.
+"""
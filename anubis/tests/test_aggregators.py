@@ -0,0 +1,307 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# test_aggregators.py - tests for the queryset aggregators.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import mock
+
+from django.contrib.auth.models import Group, User
+from django.test import SimpleTestCase, TestCase
+
+from anubis.aggregators import QuerySetAggregator
+from anubis.cache import LRUCache
+from anubis.filters import Filter, MultiQuerySetFilter, QuerySetFilter
+from anubis.query import spans_multi_valued_relation
+from anubis.url import Boolean
+
+
+class NoneFilter(Filter):
+    def filter_queryset(self, queryset, args):
+        return queryset.none()
+
+
+class IdInFilter(Filter):
+    def filter_queryset(self, queryset, args):
+        return queryset.filter(id__in=[])
+
+
+class AllFilter(Filter):
+    def filter_queryset(self, queryset, args):
+        return queryset
+
+
+class ExpensiveFilter(QuerySetFilter):
+    cost = 10
+
+    def __init__(self, field_name):
+        super().__init__(field_name)
+        self.calls = []
+
+    def filter_queryset(self, queryset, args):
+        self.calls.append(args)
+
+        return super().filter_queryset(queryset, args)
+
+
+def make_filters():
+    return {
+        "username": QuerySetFilter("username").field("username"),
+        "group": QuerySetFilter("groups__name").field("group"),
+        "group_staff": MultiQuerySetFilter("group_staff", "groups__name",
+                                           "is_staff")
+                       .field("group").field("is_staff"),
+        "staff": QuerySetFilter("is_staff").field("is_staff"),
+        "none": NoneFilter("none").field("none"),
+        "empty": IdInFilter("empty").field("empty"),
+        "all": AllFilter("all").field("all"),
+        "expensive": ExpensiveFilter("username").field("username"),
+    }
+
+
+class QuerySetAggregatorTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for name in ("ana", "bia", "caio"):
+            User.objects.create(username=name, is_staff=(name == "ana"))
+
+        editors = Group.objects.create(name="editors")
+        reviewers = Group.objects.create(name="reviewers")
+
+        editors.user_set.add(*User.objects.filter(username__in=["ana",
+                                                                "bia"]))
+        reviewers.user_set.add(User.objects.get(username="ana"))
+
+    def aggregate(self, expression, **kwargs):
+        aggregator = QuerySetAggregator(User.objects.all(), make_filters(),
+                                        **kwargs)
+
+        return aggregator.aggregate(expression)
+
+    def usernames(self, queryset):
+        return sorted(queryset.values_list("username", flat=True))
+
+    def test_not(self):
+        expression = Boolean.negation(Boolean.unit("username", ["ana"]))
+
+        for compile_q in (False, True):
+            self.assertEqual(
+                self.usernames(self.aggregate(expression,
+                                              compile_q=compile_q)),
+                ["bia", "caio"])
+
+    def test_not_empty_queryset(self):
+        for field in ("none", "empty"):
+            expression = Boolean.negation(Boolean.unit(field, ["x"]))
+
+            for plan in (False, True):
+                self.assertEqual(
+                    self.usernames(self.aggregate(expression, plan=plan)),
+                    ["ana", "bia", "caio"])
+
+    def test_not_empty_queryset_in_conjunction(self):
+        expression = Boolean.conjunction(
+            Boolean.unit("username", ["bia"]),
+            Boolean.negation(Boolean.unit("none", ["x"])))
+
+        self.assertEqual(self.usernames(self.aggregate(expression)), ["bia"])
+
+    def test_not_in_subquery(self):
+        expression = Boolean.negation(Boolean.unit("username", ["bia"]))
+
+        for compile_q in (False, True):
+            negated = self.aggregate(expression, compile_q=compile_q)
+            groups = Group.objects.filter(user__in=negated).distinct()
+            users = User.objects.filter(username__in=["ana", "bia"],
+                                        id__in=negated.values("id"))
+
+            self.assertEqual(sorted(groups.values_list("name", flat=True)),
+                             ["editors", "reviewers"])
+            self.assertEqual(self.usernames(users), ["ana"])
+
+    def test_not_combined(self):
+        expression = Boolean.disjunction(
+            Boolean.negation(Boolean.unit("username", ["ana"])),
+            Boolean.negation(Boolean.unit("none", ["x"])),
+            Boolean.negation(Boolean.unit("group", ["editors"])))
+
+        self.assertEqual(self.usernames(self.aggregate(expression)),
+                         ["ana", "bia", "caio"])
+
+        expression = Boolean.conjunction(
+            Boolean.negation(Boolean.unit("username", ["ana"])),
+            Boolean.negation(Boolean.unit("group", ["editors"])))
+
+        self.assertEqual(self.usernames(self.aggregate(expression)),
+                         ["caio"])
+
+    def test_multi_valued_relation_and(self):
+        expression = Boolean.conjunction(
+            Boolean.unit("group", ["editors"]),
+            Boolean.unit("group", ["reviewers"]),
+            Boolean.negation(Boolean.unit("username", ["caio"])))
+
+        for compile_q in (False, True):
+            self.assertEqual(
+                self.usernames(self.aggregate(expression,
+                                              compile_q=compile_q)),
+                ["ana"])
+
+    def test_repeated_units_evaluated_once(self):
+        expression = Boolean.disjunction(
+            Boolean.conjunction(Boolean.unit("username", ["ana"]),
+                                Boolean.unit("staff", ["True"])),
+            Boolean.conjunction(Boolean.unit("username", ["ana"]),
+                                Boolean.unit("staff", ["False"])))
+        aggregator = QuerySetAggregator(User.objects.all(), make_filters())
+
+        self.assertEqual(self.usernames(aggregator.aggregate(expression)),
+                         ["ana"])
+        self.assertEqual(aggregator.unit_evaluations, 3)
+        self.assertEqual(aggregator.saved_evaluations, 1)
+
+    def plan(self, expression, estimates):
+        """Aggregates `expression` top-down, estimating the rows of each unit
+        from `estimates` (keyed by the unit's first SQL parameter, or by
+        :const:`None` for units without any) instead of asking the database.
+        """
+        def estimate_rows(queryset):
+            if queryset.query.is_empty():
+                return 0
+
+            params = queryset.query.sql_with_params()[1]
+
+            return estimates[params[0] if params else None]
+
+        aggregator = QuerySetAggregator(User.objects.all(), make_filters(),
+                                        plan=True)
+
+        with mock.patch.object(QuerySetAggregator, "estimate_rows",
+                               side_effect=estimate_rows), \
+                mock.patch.object(QuerySetAggregator, "estimate_cache",
+                                  LRUCache(16)):
+            return aggregator, aggregator.aggregate(expression)
+
+    def test_plan_without_estimates(self):
+        # only PostgreSQL's EXPLAIN is understood, so the operands keep
+        # their original order elsewhere
+        self.assertEqual(
+            QuerySetAggregator.estimate_rows(User.objects.all()),
+            float("inf"))
+        self.assertEqual(
+            QuerySetAggregator.estimate_rows(User.objects.none()), 0)
+
+        expression = Boolean.conjunction(
+            Boolean.unit("group", ["editors"]),
+            Boolean.negation(Boolean.unit("username", ["bia"])))
+        queryset = self.aggregate(expression, plan=True)
+
+        self.assertEqual(self.usernames(queryset), ["ana"])
+        self.assertEqual(queryset.query.sql_with_params()[1][0], "editors")
+
+        expression = Boolean.disjunction(Boolean.unit("username", ["caio"]),
+                                         Boolean.unit("username", ["bia"]))
+        queryset = self.aggregate(expression, plan=True)
+
+        self.assertEqual(self.usernames(queryset), ["bia", "caio"])
+        self.assertEqual(queryset.query.sql_with_params()[1], ("caio", "bia"))
+
+    def test_plan_orders_by_estimate(self):
+        estimates = {"ana": 5, "bia": 1, "caio": 3}
+        units = [Boolean.unit("username", [name])
+                 for name in ("ana", "bia", "caio")]
+
+        # ANDs start with the smallest operands...
+        _, queryset = self.plan(Boolean.conjunction(*units), estimates)
+
+        self.assertEqual(queryset.query.sql_with_params()[1],
+                         ("bia", "caio", "ana"))
+
+        # ...and ORs with the largest ones
+        _, queryset = self.plan(Boolean.disjunction(*units), estimates)
+
+        self.assertEqual(queryset.query.sql_with_params()[1],
+                         ("ana", "caio", "bia"))
+
+    def test_plan_and_short_circuits(self):
+        estimates = {"ana": 1, False: 2, True: 2}
+
+        # the partial result is empty, so the expensive unit isn't run
+        aggregator, queryset = self.plan(Boolean.conjunction(
+            Boolean.unit("expensive", ["ana"]),
+            Boolean.unit("username", ["ana"]),
+            Boolean.unit("staff", ["False"])), estimates)
+
+        self.assertEqual(self.usernames(queryset), [])
+        self.assertEqual(aggregator.allowed_filters["expensive"].calls, [])
+
+        aggregator, queryset = self.plan(Boolean.conjunction(
+            Boolean.unit("expensive", ["ana"]),
+            Boolean.unit("username", ["ana"]),
+            Boolean.unit("staff", ["True"])), estimates)
+
+        self.assertEqual(self.usernames(queryset), ["ana"])
+        self.assertEqual(aggregator.allowed_filters["expensive"].calls,
+                         [["ana"]])
+
+        # an empty operand ends the AND before any other is combined
+        aggregator, queryset = self.plan(Boolean.conjunction(
+            Boolean.unit("expensive", ["ana"]),
+            Boolean.unit("none", ["x"])), estimates)
+
+        self.assertTrue(queryset.query.is_empty())
+        self.assertEqual(aggregator.allowed_filters["expensive"].calls, [])
+
+    def test_plan_or_short_circuits(self):
+        estimates = {"ana": 1, None: 3}
+
+        # an operand matching everything ends the OR
+        aggregator, queryset = self.plan(Boolean.disjunction(
+            Boolean.unit("expensive", ["ana"]),
+            Boolean.unit("username", ["ana"]),
+            Boolean.unit("all", ["x"])), estimates)
+
+        self.assertIs(queryset, aggregator.base_queryset)
+        self.assertEqual(aggregator.allowed_filters["expensive"].calls, [])
+
+        # empty operands are skipped
+        aggregator, queryset = self.plan(Boolean.disjunction(
+            Boolean.unit("none", ["x"]),
+            Boolean.unit("username", ["ana"])), estimates)
+
+        self.assertEqual(queryset.query.sql_with_params()[1], ("ana",))
+
+    def test_filter_q(self):
+        filters = make_filters()
+
+        self.assertIsNotNone(filters["username"].filter_q(["ana"], User))
+        self.assertIsNone(filters["group"].filter_q(["editors"], User))
+        self.assertIsNone(filters["group_staff"].filter_q(["editors", True],
+                                                          User))
+
+
+class SpansMultiValuedRelationTestCase(SimpleTestCase):
+    def test_lookups(self):
+        self.assertFalse(spans_multi_valued_relation(User, "username"))
+        self.assertFalse(spans_multi_valued_relation(User,
+                                                     "username__icontains"))
+        self.assertFalse(spans_multi_valued_relation(User, "pk"))
+        self.assertTrue(spans_multi_valued_relation(User, "groups"))
+        self.assertTrue(spans_multi_valued_relation(User, "groups__name"))
+        self.assertTrue(spans_multi_valued_relation(Group, "user__username"))
+        self.assertFalse(spans_multi_valued_relation(
+            Group.user_set.through, "group__name"))
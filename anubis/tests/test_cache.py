@@ -0,0 +1,162 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# test_cache.py - tests for the cache helpers.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import mock
+
+from django.contrib.auth.models import Group
+from django.core.cache import caches
+from django.db import transaction
+from django.test import SimpleTestCase, TransactionTestCase
+
+from anubis.cache import LRUCache, NearCache, _table_generations, \
+    bump_generation, get_generation, get_last_modified, get_near_cache, \
+    track_table_generations
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_info(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("b", 0), 0)
+        self.assertEqual(tuple(cache.info()), (1, 2, 2, 1))
+
+        cache.clear()
+
+        self.assertEqual(tuple(cache.info()), (0, 0, 2, 0))
+
+    @mock.patch("anubis.cache.time.time")
+    def test_ttl(self, now):
+        cache = LRUCache(2, ttl=10)
+        now.return_value = 100
+        cache.set("a", 1)
+
+        now.return_value = 109
+        self.assertEqual(cache.get("a"), 1)
+
+        now.return_value = 110
+        self.assertIsNone(cache.get("a"))
+        self.assertNotIn("a", cache)
+
+
+class NearCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.cache = NearCache("default", 2, 60)
+
+    def test_shared_values_kept_near(self):
+        caches["default"].set("a", b"1")
+
+        self.assertEqual(self.cache.get("a"), b"1")
+
+        caches["default"].delete("a")
+
+        self.assertEqual(self.cache.get("a"), b"1")
+        self.assertIsNone(self.cache.get("b"))
+
+        info = self.cache.info()
+
+        self.assertEqual(info["shared"], {"hits": 1, "misses": 1})
+        self.assertEqual(info["near"]["hits"], 1)
+        self.assertEqual(info["near_bytes"], 1)
+
+    def test_both_tiers_written(self):
+        self.cache.set("a", b"1")
+
+        self.assertEqual(caches["default"].get("a"), b"1")
+        self.assertIn("a", self.cache.near)
+
+        self.cache.delete("a")
+
+        self.assertIsNone(caches["default"].get("a"))
+        self.assertNotIn("a", self.cache.near)
+
+    def test_add_only_shared(self):
+        self.assertTrue(self.cache.add("lock", 1))
+        self.assertFalse(self.cache.add("lock", 1))
+        self.assertNotIn("lock", self.cache.near)
+
+    def test_shared_per_process(self):
+        self.assertIs(get_near_cache("default", 2, 60),
+                      get_near_cache("default", 2, 60))
+        self.assertIsNot(get_near_cache("default", 2, 60),
+                         get_near_cache("default", 2, 30))
+
+
+class GenerationTestCase(TransactionTestCase):
+    def setUp(self):
+        caches["default"].clear()
+
+    def test_bumped_on_write(self):
+        # every model is tracked once the app is ready, without registering
+        generation = get_generation(Group)
+        group = Group.objects.create(name="staff")
+
+        self.assertNotEqual(get_generation(Group), generation)
+
+        generation = get_generation(Group)
+        group.delete()
+
+        self.assertNotEqual(get_generation(Group), generation)
+
+    def test_bumped_on_commit(self):
+        generation = get_generation(Group)
+
+        with transaction.atomic():
+            Group.objects.create(name="staff")
+            self.assertEqual(get_generation(Group), generation)
+
+        self.assertNotEqual(get_generation(Group), generation)
+
+    def test_not_bumped_on_rollback(self):
+        generation = get_generation(Group)
+
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Group.objects.create(name="staff")
+                raise RuntimeError()
+
+        self.assertEqual(get_generation(Group), generation)
+
+    def test_last_modified(self):
+        bump_generation(Group)
+
+        self.assertIsNotNone(get_last_modified(Group))
+
+        track_table_generations(Group)
+
+        try:
+            self.assertIsNone(get_last_modified(Group))
+        finally:
+            _table_generations.discard(Group)
@@ -0,0 +1,224 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# test_idsets.py - tests for the id set encoding and the unit caches.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import uuid
+from random import Random
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase
+
+from anubis import idsets
+from anubis.aggregators import CachedQuerySetAggregator, IdSetAggregator
+from anubis.tests.test_aggregators import make_filters
+from anubis.url import Boolean
+
+
+class EncodingTestCase(SimpleTestCase):
+    def test_round_trip(self):
+        for ids in ([], [0], [5, 3, 3, 1], [1, 1000000],
+                    list(range(100, 400)), list(range(0, 3000, 7))):
+            with self.subTest(ids=ids):
+                self.assertEqual(idsets.decode(idsets.encode(ids)),
+                                 sorted(set(ids)))
+
+    def test_formats(self):
+        self.assertEqual(idsets.encode([1, 1000000])[1], idsets.DELTA)
+        self.assertEqual(idsets.encode(range(100, 400))[1], idsets.BITMAP)
+
+    def test_max_bytes(self):
+        self.assertIsNone(idsets.encode([1, 1000000], max_bytes=2))
+        self.assertIsNotNone(idsets.encode([1, 2], max_bytes=8))
+
+    def test_not_integers(self):
+        for ids in ([uuid.uuid4(), uuid.uuid4()], ["a", "b"], [-1, 2]):
+            with self.subTest(ids=ids):
+                with self.assertRaises(ValueError):
+                    idsets.encode(ids)
+
+    def test_invalid(self):
+        for data in (None, b"", b"\x00\x00", [1, 2], b"\x01\x09\x00"):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    idsets.decode(data)
+
+    def test_truncated(self):
+        data = idsets.encode([1, 1000000])
+
+        for size in range(2, len(data)):
+            with self.subTest(size=size):
+                with self.assertRaises(ValueError):
+                    idsets.decode(data[:size])
+
+        # a bitmap cut inside its base
+        data = idsets.encode(range(1000, 1300))
+
+        with self.assertRaises(ValueError):
+            idsets.decode(data[:3])
+
+        with self.assertRaises(ValueError):
+            idsets.IdSet.decode(data[:3])
+
+
+class IdSetTestCase(SimpleTestCase):
+    def test_algebra(self):
+        a = idsets.IdSet.from_ids([1, 2, 3, 70])
+        b = idsets.IdSet.from_ids([2, 70, 200])
+
+        self.assertEqual(list(a & b), [2, 70])
+        self.assertEqual(list(a | b), [1, 2, 3, 70, 200])
+        self.assertEqual(list(a - b), [1, 3])
+        self.assertIn(70, a)
+        self.assertNotIn(200, a)
+        self.assertEqual(len(a | b), 5)
+
+    def test_large_ids(self):
+        # dense ids far from zero are kept relative to the smallest one
+        start = 2 ** 40
+        dense = idsets.IdSet.from_ids(range(start, start + 1000))
+
+        self.assertIsNone(dense.sparse)
+        self.assertEqual(dense.base, start)
+        self.assertEqual(dense.bitmap.bit_length(), 1000)
+
+        # sparse ids aren't kept as a bitmap at all
+        ids = [5, start + 3, start + 2000, 2 ** 62]
+        sparse = idsets.IdSet.from_ids(ids)
+
+        self.assertIsNotNone(sparse.sparse)
+        self.assertEqual(list(sparse), ids)
+        self.assertEqual(len(sparse), 4)
+        self.assertIn(2 ** 62, sparse)
+        self.assertNotIn(start, sparse)
+
+        universe = dense | sparse
+
+        self.assertEqual(len(universe), 1003)
+        self.assertEqual(list(universe - dense), [5, start + 2000, 2 ** 62])
+        self.assertEqual(list(universe - sparse),
+                         [value for value in range(start, start + 1000)
+                          if value != start + 3])
+        self.assertEqual(list(dense & sparse), [start + 3])
+        self.assertEqual(idsets.IdSet.decode(idsets.encode(sparse)), sparse)
+
+    def test_algebra_matches_sets(self):
+        random = Random(0)
+        sets = [set(), {0}, set(range(10, 200)), {3, 7, 2 ** 33},
+                set(range(2 ** 33, 2 ** 33 + 50))]
+        sets += [{random.randrange(start, start + span)
+                  for _ in range(count)}
+                 for start, span, count in ((0, 300, 100), (150, 300, 50),
+                                            (0, 10 ** 9, 20))]
+
+        for a in sets:
+            for b in sets:
+                left, right = idsets.IdSet.from_ids(a), \
+                    idsets.IdSet.from_ids(b)
+
+                with self.subTest(a=sorted(a)[:5], b=sorted(b)[:5]):
+                    # results are equal to the sets built from their ids,
+                    # whichever way they are kept
+                    self.assertEqual(left & right, idsets.IdSet.from_ids(a & b))
+                    self.assertEqual(left | right, idsets.IdSet.from_ids(a | b))
+                    self.assertEqual(left - right, idsets.IdSet.from_ids(a - b))
+                    self.assertEqual(list(left | right), sorted(a | b))
+
+    def test_decode(self):
+        for ids in ([], [1, 1000000], list(range(100, 400))):
+            with self.subTest(ids=ids):
+                self.assertEqual(
+                    idsets.IdSet.decode(idsets.encode(ids)),
+                    idsets.IdSet.from_ids(ids))
+
+
+class ListIdsAggregator(CachedQuerySetAggregator):
+    # as for models with UUID primary keys
+    integer_ids = False
+
+
+class CachedQuerySetAggregatorTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for name in ("ana", "bia", "caio"):
+            User.objects.create(username=name, is_staff=(name == "ana"))
+
+    def setUp(self):
+        self.cache = caches["default"]
+        self.cache.clear()
+
+    def aggregator(self, cls=CachedQuerySetAggregator, **kwargs):
+        return cls(self.cache, User.objects.all(), make_filters(),
+                   generation="1", **kwargs)
+
+    def usernames(self, queryset):
+        return sorted(queryset.values_list("username", flat=True))
+
+    def ids(self, *names):
+        return sorted(User.objects.filter(username__in=names)
+                      .values_list("id", flat=True))
+
+    def test_cached_encoded(self):
+        expression = Boolean.unit("staff", ["False"])
+        aggregator = self.aggregator()
+
+        self.assertEqual(self.usernames(aggregator.aggregate(expression)),
+                         ["bia", "caio"])
+
+        cached = self.cache.get(aggregator.make_cache_key(expression))
+
+        self.assertEqual(idsets.decode(cached), self.ids("bia", "caio"))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.usernames(self.aggregator().aggregate(expression)),
+                ["bia", "caio"])
+
+    def test_not_integer_ids(self):
+        expression = Boolean.unit("staff", ["False"])
+        aggregator = self.aggregator(ListIdsAggregator)
+
+        self.assertEqual(self.usernames(aggregator.aggregate(expression)),
+                         ["bia", "caio"])
+        self.assertEqual(
+            sorted(self.cache.get(aggregator.make_cache_key(expression))),
+            self.ids("bia", "caio"))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.usernames(self.aggregator(ListIdsAggregator)
+                               .aggregate(expression)),
+                ["bia", "caio"])
+
+    def test_integer_ids(self):
+        self.assertTrue(self.aggregator().integer_ids)
+
+    def test_in_memory(self):
+        expression = Boolean.disjunction(
+            Boolean.unit("username", ["caio"]),
+            Boolean.negation(Boolean.unit("staff", ["False"])))
+        expected = self.ids("ana", "caio")
+        ids = expression.traverse(IdSetAggregator(self.aggregator()))
+
+        self.assertEqual(list(ids), expected)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                list(expression.traverse(IdSetAggregator(self.aggregator()))),
+                expected)
@@ -0,0 +1,36 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# test_operations.py - tests for the migration operations.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase
+
+from anubis.operations import AddGenerationTrigger
+
+
+class AddGenerationTriggerTestCase(SimpleTestCase):
+    def test_row_seeded_by_migration(self):
+        operation = AddGenerationTrigger(User)
+        sql = " ".join(operation._sql().split())
+
+        self.assertIn("insert into anubis_generation (name, generation) "
+                      "select 'auth_user', 0 where not exists", sql)
+        self.assertNotIn("insert", " ".join(operation.commands.split()))
+        self.assertLess(sql.index("insert into anubis_generation"),
+                        sql.index("create trigger"))
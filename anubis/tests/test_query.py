@@ -0,0 +1,281 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# test_query.py - tests for the procedure aware querysets.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+from unittest import mock
+
+from django.contrib.auth.models import Group, User
+from django.db import connection
+from django.db.utils import NotSupportedError
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from anubis.query import ProcedureQuerySet, filter_by_ids, \
+    prepared_statements
+
+
+@override_settings(ANUBIS_ID_LIST_MAX_SIZE=2, ANUBIS_ID_ARRAY_MAX_SIZE=4)
+class FilterByIdsTestCase(TestCase):
+    def where(self, ids, exclude=False):
+        queryset = filter_by_ids(User.objects.all(), ids, exclude=exclude)
+        sql, params = queryset.query.sql_with_params()
+
+        return sql[sql.index(" WHERE ") + 7:], params
+
+    def test_strategies(self):
+        self.assertEqual(self.where(["1", 2]),
+                         ('"auth_user"."id" IN (%s, %s)', (1, 2)))
+        self.assertEqual(self.where([1, 2, 3]),
+                         ('"auth_user"."id" = any(%s::integer[])',
+                          ([1, 2, 3],)))
+        self.assertEqual(self.where(range(5)),
+                         ('"auth_user"."id" in '
+                          '(select unnest(%s::integer[]))',
+                          ([0, 1, 2, 3, 4],)))
+
+    def test_exclude(self):
+        self.assertEqual(self.where([1, 2, 3], exclude=True),
+                         ('NOT ("auth_user"."id" = any(%s::integer[]))',
+                          ([1, 2, 3],)))
+
+    def test_in_subquery(self):
+        # arrays only run on PostgreSQL, but their columns must follow the
+        # aliases of the enclosing query
+        for ids, exclude in (([1, 2, 3], False), (range(5), False),
+                             ([1, 2, 3], True)):
+            with self.subTest(ids=ids, exclude=exclude):
+                users = filter_by_ids(User.objects.all(), ids,
+                                      exclude=exclude)
+                groups = Group.objects.filter(user__in=users)
+                sql, params = groups.query.sql_with_params()
+
+                inner_where = sql[sql.index('"auth_user" U0 WHERE'):]
+
+                self.assertIn('U0."id" ', inner_where)
+                self.assertNotIn('"auth_user"."id"', sql)
+                self.assertEqual(params, (list(ids),))
+
+    def test_small_sets_in_subquery(self):
+        ana = User.objects.create(username="ana")
+        bia = User.objects.create(username="bia")
+        group = Group.objects.create(name="editors")
+        group.user_set.add(ana)
+
+        for exclude, expected in ((False, [group]), (True, [])):
+            with self.subTest(exclude=exclude):
+                users = filter_by_ids(User.objects.all(), [ana.id],
+                                      exclude=exclude)
+
+                self.assertEqual(list(Group.objects.filter(user__in=users)),
+                                 expected)
+
+        self.assertEqual(
+            list(User.objects.filter(id__in=filter_by_ids(
+                User.objects.filter(username="bia"), [ana.id, bia.id]))),
+            [bia])
+
+    def test_small_sets(self):
+        ana = User.objects.create(username="ana")
+        bia = User.objects.create(username="bia")
+
+        self.assertEqual(list(filter_by_ids(User.objects.all(), [ana.id])),
+                         [ana])
+        self.assertEqual(list(filter_by_ids(User.objects.all(), [ana.id],
+                                            exclude=True)), [bia])
+        self.assertEqual(list(filter_by_ids(User.objects.all(), [])), [])
+        self.assertEqual(
+            filter_by_ids(User.objects.all(), [], exclude=True).count(), 2)
+
+
+class InlineProcedureQuerySet(ProcedureQuerySet):
+    inline_procedures = True
+
+
+class InlineProcedureTestCase(SimpleTestCase):
+    def test_opt_in(self):
+        self.assertFalse(ProcedureQuerySet.inline_procedures)
+
+    def test_selects_id_column(self):
+        queryset = InlineProcedureQuerySet(model=User) \
+            .procedure("search", "foo", 2).filter(is_staff=True)
+        sql, params = queryset.query.sql_with_params()
+
+        self.assertIn('"auth_user"."id" IN ((select "anubis_procedure"."id" '
+                      'from "auth_user_search"(%s, %s) as "anubis_procedure"))',
+                      sql)
+        self.assertNotIn("select *", sql)
+        self.assertEqual(params, ("foo", 2, True))
+
+    def test_in_subquery(self):
+        users = InlineProcedureQuerySet(model=User) \
+            .procedure("search", "foo", 2).filter(is_staff=True)
+        queryset = Group.objects.filter(user__in=users).filter(name="bar")
+        sql, params = queryset.query.sql_with_params()
+
+        # the procedure is bound to the subquery's alias rather than to the
+        # outer query's user table
+        self.assertIn('U0."id" IN ((select "anubis_procedure"."id" '
+                      'from "auth_user_search"(%s, %s) as "anubis_procedure"))',
+                      sql)
+        self.assertEqual(params, ("foo", 2, True, "bar"))
+
+
+class IterProcedureTestCase(SimpleTestCase):
+    rows = [(1, "ana", 0.5), (2, "bia", 0.25), (3, "caio", 0.125)]
+
+    def setUp(self):
+        self.cursor = mock.Mock()
+        self.cursor.description = [("id",), ("username",), ("rank",)]
+        self.cursor.fetchmany.side_effect = self.fetchmany
+        self.position = 0
+
+        chunked_cursor = mock.Mock(return_value=self.cursor)
+        self.connection = mock.Mock(ops=connection.ops,
+                                    chunked_cursor=chunked_cursor)
+
+        patcher = mock.patch.object(ProcedureQuerySet, "_get_connection",
+                                    return_value=self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+
+        return rows
+
+    def iter_procedure(self, *args, **kwargs):
+        return ProcedureQuerySet(model=User).iter_procedure("search", "foo",
+                                                            *args, **kwargs)
+
+    def test_row_types(self):
+        self.assertEqual(list(self.iter_procedure(row_type=tuple)),
+                         self.rows)
+
+        self.position = 0
+
+        self.assertEqual(list(self.iter_procedure())[0],
+                         {"id": 1, "username": "ana", "rank": 0.5})
+
+        self.position = 0
+        rows = list(self.iter_procedure(row_type=namedtuple))
+
+        self.assertEqual(rows, self.rows)
+        self.assertEqual((rows[1].id, rows[1].username, rows[1].rank),
+                         (2, "bia", 0.25))
+
+    def test_unsupported_row_type(self):
+        with self.assertRaises(ValueError):
+            list(self.iter_procedure(row_type=list))
+
+        self.cursor.close.assert_called_once_with()
+
+    def test_chunks(self):
+        rows = self.iter_procedure(chunk_size=2, row_type=tuple)
+
+        # nothing runs until the first row is asked for, and then only the
+        # first chunk is fetched
+        self.cursor.execute.assert_not_called()
+        self.assertEqual(next(rows), (1, "ana", 0.5))
+        self.cursor.execute.assert_called_once_with(
+            'select * from "auth_user_search"(%s);', ["foo"])
+        self.assertEqual(self.cursor.fetchmany.call_args_list,
+                         [mock.call(2)])
+
+        self.assertEqual(list(rows), self.rows[1:])
+        self.assertEqual(self.cursor.fetchmany.call_args_list,
+                         [mock.call(2)] * 3)
+        self.cursor.close.assert_called_once_with()
+
+    def test_default_chunk_size(self):
+        list(self.iter_procedure())
+
+        self.assertEqual(self.cursor.fetchmany.call_args_list,
+                         [mock.call(ProcedureQuerySet.procedure_chunk_size)] *
+                         2)
+
+    def test_closed_when_abandoned(self):
+        rows = self.iter_procedure(chunk_size=1)
+        next(rows)
+        rows.close()
+
+        self.cursor.close.assert_called_once_with()
+        self.assertEqual(self.cursor.fetchmany.call_count, 1)
+
+
+class FakeConnection:
+    def __init__(self, in_atomic_block=False):
+        self.connection = object()
+        self.ops = connection.ops
+        self.in_atomic_block = in_atomic_block
+
+
+class FakeCursor:
+    """Fails the first execution of a prepared statement as if its procedure
+    had changed its result type.
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.failed = False
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+
+        if sql.startswith("execute ") and not self.failed:
+            self.failed = True
+            raise NotSupportedError("cached plan must not change result type")
+
+
+class PreparedProcedureQuerySet(ProcedureQuerySet):
+    prepare_procedures = True
+
+
+class PreparedProcedureTestCase(SimpleTestCase):
+    def execute(self, connection, cursor):
+        PreparedProcedureQuerySet(model=User)._execute_procedure(
+            connection, cursor, "search", ["foo"])
+
+    def test_prepared_again(self):
+        connection, cursor = FakeConnection(), FakeCursor()
+
+        self.execute(connection, cursor)
+
+        commands = [sql.split()[0] for sql in cursor.statements]
+        first, second = [sql.split()[1] for sql in cursor.statements
+                         if sql.startswith("prepare")]
+
+        self.assertEqual(commands, ["prepare", "execute", "deallocate",
+                                    "prepare", "execute"])
+        self.assertNotEqual(first, second)
+        self.assertEqual(list(prepared_statements(connection).values()),
+                         [second])
+
+        self.execute(connection, cursor)
+
+        self.assertEqual(cursor.statements[-1].split()[0], "execute")
+        self.assertEqual(len(cursor.statements), 6)
+
+    def test_not_retried_in_transaction(self):
+        connection, cursor = FakeConnection(True), FakeCursor()
+
+        with self.assertRaises(NotSupportedError):
+            self.execute(connection, cursor)
+
+        self.assertEqual(prepared_statements(connection), {})
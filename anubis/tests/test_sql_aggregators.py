@@ -0,0 +1,79 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# test_sql_aggregators.py - tests for the procedure ordering annotations.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase
+
+from anubis.query import ProcedureQuerySet
+
+
+class ProcedureJoinTestCase(SimpleTestCase):
+    def queryset(self):
+        return ProcedureQuerySet(model=User)
+
+    def from_clause(self, sql):
+        start = sql.index(" FROM ")
+        end = min(sql.index(keyword) for keyword in (" WHERE ", " ORDER BY ")
+                  if keyword in sql)
+
+        return sql[start:end]
+
+    def test_single_call_in_from(self):
+        queryset = self.queryset().filter(is_staff=True) \
+            .order_by_procedure("rank", "foo", join=True) \
+            .filter(username="ana")
+        sql, params = queryset.query.sql_with_params()
+
+        self.assertEqual(sql.count("auth_user_rank("), 1)
+        self.assertIn("LEFT OUTER JOIN auth_user_rank(%s)",
+                      self.from_clause(sql))
+        self.assertEqual(params, ("foo", True, "ana"))
+
+    def test_correlated_subquery_without_join(self):
+        queryset = self.queryset().order_by_procedure("rank", "foo")
+        sql, _ = queryset.query.sql_with_params()
+
+        self.assertNotIn("auth_user_rank(", self.from_clause(sql))
+        self.assertIn("from auth_user_rank(%s) as auth_user_rank_res where",
+                      sql)
+
+    def test_many_procedures(self):
+        queryset = self.queryset()
+        queryset = queryset.order_by_aggregates(
+            queryset.procedure_aggregate("first", 1),
+            queryset.procedure_aggregate("second", 2), join=True)
+        sql, params = queryset.query.sql_with_params()
+        from_clause = self.from_clause(sql)
+
+        self.assertEqual(from_clause.count("auth_user_first("), 1)
+        self.assertEqual(from_clause.count("auth_user_second("), 1)
+        self.assertEqual(sql.count("auth_user_first("), 1)
+        self.assertEqual(sql.count("auth_user_second("), 1)
+        self.assertEqual(params, (1, 2))
+
+    def test_relabeled_in_subquery(self):
+        ranked = self.queryset().filter(is_staff=True) \
+            .order_by_procedure("rank", "foo", join=True)
+        queryset = User.objects.filter(id__in=ranked.values("id"))
+        sql, params = queryset.query.sql_with_params()
+
+        self.assertEqual(sql.count("auth_user_rank("), 1)
+        self.assertIn('ON ("U1".id = "U0"."id")', sql)
+        self.assertEqual(params, ("foo", True))
@@ -0,0 +1,529 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# test_url.py - tests for the search expression parsers.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A differential corpus for the search expression grammar.
+
+Each entry pairs an expression with either the tree both parser engines must
+build or the error the Python engine must raise, whose column the Haskell
+engine (when its library is built) must agree on.
+"""
+
+import ctypes
+import json
+import os
+import re
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from anubis.url import Boolean, BooleanBuilder, ExpressionLimitError, \
+    ExpressionLimits, ExpressionParser, ForkedRuntimeError, HaskellLibrary
+
+unit = Boolean.unit
+not_ = Boolean.negation
+and_ = Boolean.conjunction
+or_ = Boolean.disjunction
+
+
+def error(column, unexpected, expecting):
+    return "(column {}): unexpected {}; expecting {}".format(
+        column, unexpected, expecting)
+
+
+CORPUS = [
+    # units and arguments
+    ("a,b", unit("a", ["b"])),
+    ("a,b,c", unit("a", ["b", "c"])),
+    ("1,2", unit("1", ["2"])),
+    ("a_1-2,b_3-4", unit("a_1-2", ["b_3-4"])),
+    ("é,ção", unit("é", ["ção"])),
+    ("a", error(2, "end of input", "','")),
+    ("a,", error(3, "end of input", "argument")),
+    ("a b", error(2, "' '", "','")),
+    ("a.b,c", error(2, "'.'", "','")),
+    ("a,b,,c", error(5, "','", "argument")),
+    ("a,$", error(3, "'$'", "argument")),
+    ("", error(1, "end of input", "field name")),
+
+    # quoted arguments, with $" and $$ escapes
+    ('a,"x y"', unit("a", ["x y"])),
+    ('a,"x,y"', unit("a", ["x,y"])),
+    ('a,""', unit("a", [""])),
+    ('a,"x$"y"', unit("a", ['x"y'])),
+    ('a,"x$$y"', unit("a", ["x$y"])),
+    ('a,"$$$""', unit("a", ['$"'])),
+    ('a,"(x)"/b,c', and_(unit("a", ["(x)"]), unit("b", ["c"]))),
+    ('a,"x$y"', error(3, "'\"'", "argument")),
+    ('a,"unterminated', error(3, "'\"'", "argument")),
+
+    # operators and precedence
+    ("a,b/c,d", and_(unit("a", ["b"]), unit("c", ["d"]))),
+    ("a,b+c,d", or_(unit("a", ["b"]), unit("c", ["d"]))),
+    ("a,b c,d", or_(unit("a", ["b"]), unit("c", ["d"]))),
+    ("a,b   c,d", or_(unit("a", ["b"]), unit("c", ["d"]))),
+    ("a,b/c,d+e,f", or_(and_(unit("a", ["b"]), unit("c", ["d"])),
+                        unit("e", ["f"]))),
+    ("a,b+c,d/e,f", or_(unit("a", ["b"]),
+                        and_(unit("c", ["d"]), unit("e", ["f"])))),
+    ("a,b/c,d/e,f", and_(unit("a", ["b"]), unit("c", ["d"]),
+                         unit("e", ["f"]))),
+    ("a,b+c,d+e,f", or_(unit("a", ["b"]), unit("c", ["d"]),
+                        unit("e", ["f"]))),
+
+    # operators must be followed by a term
+    ("a,b/", error(5, "end of input", "field name")),
+    ("a,b+", error(5, "end of input", "field name")),
+    ("a,b ", error(5, "end of input", "field name")),
+    ("a,b/ c,d", error(5, "' '", "field name")),
+    ("a,b+ c,d", error(5, "' '", "field name")),
+    ("a,b++c,d", error(5, "'+'", "field name")),
+    ("a,b c", error(6, "end of input", "','")),
+
+    # a single ! per term
+    ("!a,b", not_(unit("a", ["b"]))),
+    ("!a,b/c,d", and_(not_(unit("a", ["b"])), unit("c", ["d"]))),
+    ("a,b/!c,d", and_(unit("a", ["b"]), not_(unit("c", ["d"])))),
+    ("!(a,b+c,d)", not_(or_(unit("a", ["b"]), unit("c", ["d"])))),
+    ("!(!a,b)", not_(not_(unit("a", ["b"])))),
+    ("!!a,b", error(2, "'!'", "field name")),
+    ("a,b/!!c,d", error(6, "'!'", "field name")),
+
+    # parentheses
+    ("(a,b)", unit("a", ["b"])),
+    ("((a,b))", unit("a", ["b"])),
+    ("(!a,b)", not_(unit("a", ["b"]))),
+    ("a,b/(c,d+e,f)", and_(unit("a", ["b"]),
+                          or_(unit("c", ["d"]), unit("e", ["f"])))),
+    ("(a,b", error(5, "end of input", "')'")),
+    ("()", error(2, "')'", "field name")),
+
+    # no end of input check: whatever can't continue the expression is
+    # ignored
+    ("a,b)", unit("a", ["b"])),
+    ("a,b.c", unit("a", ["b"])),
+    ("a,b!c,d", unit("a", ["b"])),
+    ("a,b junk", error(9, "end of input", "','")),
+]
+
+
+def normalized_corpus():
+    # the builder strips whitespace and trailing slashes off expressions
+    return [(text, expected) for text, expected in CORPUS
+            if BooleanBuilder.normalize(text) == text]
+
+
+class ExpressionParserTestCase(SimpleTestCase):
+    def test_corpus(self):
+        for text, expected in CORPUS:
+            with self.subTest(text=text):
+                if isinstance(expected, str):
+                    with self.assertRaises(ValueError) as context:
+                        ExpressionParser(text).parse()
+
+                    self.assertEqual(str(context.exception), expected)
+                else:
+                    self.assertEqual(ExpressionParser(text).parse(), expected)
+
+    def test_build_many(self):
+        corpus = normalized_corpus()
+        results = BooleanBuilder.build_many([text for text, _ in corpus],
+                                            engine="python")
+
+        for (text, expected), result in zip(corpus, results):
+            with self.subTest(text=text):
+                if isinstance(expected, str):
+                    self.assertIsInstance(result, ValueError)
+                else:
+                    self.assertEqual(result, expected)
+
+    def test_deep_nesting(self):
+        text = "(" * 5000 + "a,b" + ")" * 5000
+
+        self.assertEqual(ExpressionParser(text).parse(), unit("a", ["b"]))
+
+
+def render(base_expression=None, not_expression=None, and_expression=None,
+           or_expression=None, **kwargs):
+    if base_expression is not None:
+        return base_expression["field"]
+    elif not_expression is not None:
+        return "!{}".format(not_expression)
+    elif and_expression is not None:
+        return "({}/{})".format(*and_expression)
+
+    return "({}+{})".format(*or_expression)
+
+
+class BooleanTestCase(SimpleTestCase):
+    def test_flattened(self):
+        a, b, c = unit("a", ["1"]), unit("b", ["2"]), unit("c", ["3"])
+
+        self.assertEqual(and_(and_(a, b), c).operands, (a, b, c))
+        self.assertEqual(and_(a, or_(b, c)).operands, (a, or_(b, c)))
+        self.assertEqual(and_(a, b), and_(a, b))
+        self.assertNotEqual(and_(a, b), or_(a, b))
+
+    def test_immutable(self):
+        expression = unit("a", ["1"])
+
+        with self.assertRaises(AttributeError):
+            expression.field = "b"
+
+        self.assertEqual(expression.args, ("1",))
+
+    def test_items(self):
+        expression = not_(unit("a", ["1"]))
+
+        self.assertEqual(expression["type"], "Not")
+        self.assertEqual(expression["expr"]["field"], "a")
+        self.assertEqual(expression.keys(), ["expr", "type"])
+
+        with self.assertRaises(KeyError):
+            expression["_hash"]
+
+    def test_traverse_folds_from_the_left(self):
+        expression = or_(and_(unit("a", []), unit("b", []), unit("c", [])),
+                         not_(unit("d", [])))
+
+        self.assertEqual(expression.traverse(render), "(((a/b)/c)+!d)")
+
+    def test_traverse_types(self):
+        calls = []
+
+        def record(**kwargs):
+            calls.append({key: value for key, value in kwargs.items()
+                          if key.endswith("_type") and value is not None})
+            return render(**kwargs)
+
+        or_(unit("a", []), unit("b", []), and_(unit("c", []),
+                                              unit("d", []))).traverse(record)
+
+        self.assertEqual(calls[-2:], [
+            {"left_type": Boolean.Expr, "right_type": Boolean.Expr},
+            {"left_type": Boolean.Or, "right_type": Boolean.And},
+        ])
+
+    def test_deep_trees(self):
+        units = [unit("id", [str(index)]) for index in range(5000)]
+        chain = or_(*units)
+        nested = units[0]
+
+        for operand in units[1:]:
+            nested = not_(and_(nested, not_(operand)))
+
+        self.assertEqual(len(chain.operands), 5000)
+        self.assertEqual(chain.traverse(render).count("+"), 4999)
+        self.assertEqual(nested.traverse(render).count("/"), 4999)
+
+    def test_build_from_json(self):
+        # the binary, left-associated output of the Haskell parser
+        text = json.dumps({
+            "tag": "Or",
+            "left": {"tag": "Or",
+                     "left": {"tag": "BooleanExpr",
+                              "contents": {"field": "a", "args": ["1"]}},
+                     "right": {"tag": "BooleanExpr",
+                               "contents": {"field": "b", "args": ["2"]}}},
+            "right": {"tag": "Not",
+                      "contents": {"tag": "BooleanExpr",
+                                   "contents": {"field": "c",
+                                                "args": ["3"]}}},
+        })
+
+        self.assertEqual(json.loads(text, object_hook=Boolean.build),
+                         or_(unit("a", ["1"]), unit("b", ["2"]),
+                             not_(unit("c", ["3"]))))
+
+    def test_build_from_flat_json(self):
+        text = json.dumps({
+            "tag": "And",
+            "operands": [{"tag": "BooleanExpr",
+                          "contents": {"field": "a", "args": ["1"]}},
+                         {"tag": "BooleanExpr",
+                          "contents": {"field": "b", "args": ["2"]}},
+                         {"tag": "BooleanExpr",
+                          "contents": {"field": "c", "args": ["3"]}}],
+        })
+
+        self.assertEqual(json.loads(text, object_hook=Boolean.build),
+                         and_(unit("a", ["1"]), unit("b", ["2"]),
+                              unit("c", ["3"])))
+
+
+class NormalizeTestCase(SimpleTestCase):
+    def test_equivalent_expressions(self):
+        a, b, c = unit("a", ["1"]), unit("b", ["2"]), unit("c", ["3"])
+        variants = [
+            or_(a, and_(b, c)),
+            or_(and_(c, b), a),
+            or_(a, a, and_(b, not_(not_(c)))),
+            or_(or_(a, and_(b, c)), a),
+        ]
+
+        for variant in variants:
+            with self.subTest(variant=variant):
+                self.assertEqual(variant.normalize(), variants[0].normalize())
+
+    def test_sorted_operands(self):
+        a, b = unit("a", ["1"]), unit("b", ["2"])
+
+        self.assertEqual(and_(not_(b), b, a).normalize().operands,
+                         (a, b, not_(b)))
+
+    def test_collapsed(self):
+        a = unit("a", ["1"])
+
+        self.assertEqual(and_(a, a).normalize(), a)
+        self.assertEqual(not_(not_(a)).normalize(), a)
+
+
+class FactorTestCase(SimpleTestCase):
+    def setUp(self):
+        self.a, self.b, self.c = (unit("a", ["1"]), unit("b", ["2"]),
+                                  unit("c", ["3"]))
+
+    def test_shared_operands(self):
+        a, b, c = self.a, self.b, self.c
+
+        self.assertEqual(or_(and_(a, b), and_(a, c)).factor(),
+                         and_(a, or_(b, c)).normalize())
+        self.assertEqual(and_(or_(a, b), or_(c, a)).factor(),
+                         or_(a, and_(b, c)).normalize())
+
+    def test_absorption(self):
+        a, b = self.a, self.b
+
+        self.assertEqual(or_(a, and_(a, b)).factor(), a)
+        self.assertEqual(and_(a, or_(a, b)).factor(), a)
+
+    def test_nothing_shared(self):
+        a, b, c = self.a, self.b, self.c
+        expression = or_(and_(a, b), c).normalize()
+
+        self.assertEqual(expression.factor(), expression)
+
+
+class ExpressionLimitsTestCase(SimpleTestCase):
+    def build(self, text, **limits):
+        return BooleanBuilder(text, engine="python",
+                              limits=ExpressionLimits(**limits)).build()
+
+    def assertExceeds(self, text, description, **limits):
+        with self.assertRaisesRegex(ExpressionLimitError, description):
+            self.build(text, **limits)
+
+    def test_length(self):
+        self.assertExceeds("a,1+b,2", "maximum length", max_length=6)
+        self.assertEqual(self.build("a,1+b,2", max_length=7),
+                         or_(unit("a", ["1"]), unit("b", ["2"])))
+
+    def test_depth(self):
+        # both the parentheses in the text...
+        self.assertExceeds("(((a,1)))", "maximum nesting depth", max_depth=2)
+        self.assertEqual(self.build("((a,1))", max_depth=2),
+                         unit("a", ["1"]))
+
+        # ...and of the resulting tree
+        self.assertExceeds("a,1/!b,2", "maximum nesting depth", max_depth=2)
+        self.assertEqual(self.build("a,1/!b,2", max_depth=3),
+                         and_(unit("a", ["1"]), not_(unit("b", ["2"]))))
+
+    def test_units(self):
+        self.assertExceeds("a,1+b,2+c,3", "maximum number of units",
+                           max_units=2)
+        self.assertEqual(len(self.build("a,1+b,2", max_units=2).operands), 2)
+
+    def test_args(self):
+        self.assertExceeds("a,1,2,3", "maximum number of arguments",
+                           max_args=2)
+        self.assertEqual(self.build("a,1,2", max_args=2),
+                         unit("a", ["1", "2"]))
+
+    def test_cached_trees_checked(self):
+        self.build("cached,1+cached,2")
+
+        self.assertExceeds("cached,1+cached,2", "maximum number of units",
+                           max_units=1)
+
+    def test_disabled(self):
+        text = "+".join("a,{}".format(index) for index in range(1000))
+
+        self.assertEqual(len(BooleanBuilder(text, engine="python").build()
+                             .operands), 1000)
+
+
+class BuilderCacheTestCase(SimpleTestCase):
+    def test_trees_shared(self):
+        hits = BooleanBuilder.cache_info().hits
+        first = BooleanBuilder("cached,tree/", engine="python").build()
+        second = BooleanBuilder(" cached,tree", engine="python").build()
+
+        self.assertIs(first, second)
+        self.assertEqual(BooleanBuilder.cache_info().hits, hits + 1)
+
+
+class FakeParserLibrary:
+    """Returns its results in buffers it owns, as the Haskell library does."""
+
+    def __init__(self, result):
+        self.buffer = ctypes.create_string_buffer(result)
+        self.freed = []
+
+    def parseUrl(self, url):
+        return ctypes.cast(self.buffer, ctypes.c_void_p).value
+
+    def freeResult(self, result):
+        self.freed.append(result)
+
+
+class CallParserTestCase(SimpleTestCase):
+    def test_result_copied_and_freed(self):
+        library = FakeParserLibrary(b'{"tag": "PyExc", "contents": "x"}')
+        result = BooleanBuilder._call_parser(library, "parseUrl", b"a,b")
+
+        self.assertEqual(result, b'{"tag": "PyExc", "contents": "x"}')
+        self.assertEqual(library.freed,
+                         [ctypes.cast(library.buffer, ctypes.c_void_p).value])
+
+
+def nested_json(depth):
+    """The output of the Haskell parser for `depth` nested negations."""
+    unit_json = '{"tag": "BooleanExpr", "contents": {"field": "a", ' \
+        '"args": ["1"]}}'
+
+    return '{"tag": "Not", "contents": ' * depth + unit_json + "}" * depth
+
+
+class FakeBatchParserLibrary:
+    """Parses each expression into the JSON it's mapped to."""
+
+    def __init__(self, results):
+        self.results = results
+        self.buffers = []
+
+    def buffer(self, result):
+        self.buffers.append(ctypes.create_string_buffer(result.encode()))
+
+        return ctypes.cast(self.buffers[-1], ctypes.c_void_p).value
+
+    def parseUrl(self, url):
+        return self.buffer(self.results[url.decode()])
+
+    def parseUrls(self, urls):
+        return self.buffer("[{}]".format(", ".join(
+            self.results[url] for url in json.loads(urls.decode()))))
+
+
+class HaskellDecodingTestCase(SimpleTestCase):
+    def setUp(self):
+        library = FakeBatchParserLibrary({"deep": nested_json(100000),
+                                          "shallow": nested_json(2)})
+        patcher = mock.patch.object(HaskellLibrary, "resident",
+                                    return_value=library)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_too_deep(self):
+        builder = BooleanBuilder("", engine="haskell")
+
+        with self.assertRaises(ExpressionLimitError):
+            builder.parse_haskell("deep")
+
+        self.assertEqual(builder.parse_haskell("shallow"),
+                         not_(not_(unit("a", ["1"]))))
+
+    def test_too_deep_in_batch(self):
+        deep, shallow = BooleanBuilder("", engine="haskell") \
+            .parse_many_haskell(["deep", "shallow"])
+
+        self.assertIsInstance(deep, ExpressionLimitError)
+        self.assertEqual(shallow, not_(not_(unit("a", ["1"]))))
+
+
+@mock.patch("anubis.url.ctypes.cdll.LoadLibrary")
+class HaskellLibraryTestCase(SimpleTestCase):
+    def test_initialized_once(self, load_library):
+        library = HaskellLibrary("libfake.so")
+
+        self.assertIs(library.load(), library.load())
+        self.assertEqual(load_library.call_count, 1)
+        load_library.return_value.hs_init.assert_called_once_with(0, 0)
+
+    def test_not_initialized_after_fork(self, load_library):
+        library = HaskellLibrary("libfake.so")
+        library.load()
+
+        with mock.patch("anubis.url.os.getpid", return_value=-1):
+            with self.assertRaises(ForkedRuntimeError):
+                library.load()
+
+        self.assertEqual(load_library.call_count, 1)
+        load_library.return_value.hs_init.assert_called_once_with(0, 0)
+
+    def test_python_fallback_after_fork(self, load_library):
+        builder = BooleanBuilder("", engine="haskell")
+
+        with mock.patch.object(HaskellLibrary, "resident",
+                               side_effect=ForkedRuntimeError):
+            self.assertEqual(builder.parse("a,1+b,2"),
+                             or_(unit("a", ["1"]), unit("b", ["2"])))
+            first, second = builder.parse_many(["a,1", "a,1+"])
+
+        self.assertEqual(first, unit("a", ["1"]))
+        self.assertIsInstance(second, ValueError)
+
+        load_library.assert_not_called()
+
+
+@unittest.skipUnless(
+    os.path.exists(BooleanBuilder("").parser_lib_path),
+    "The Haskell parser library isn't built.")
+class HaskellEngineTestCase(SimpleTestCase):
+    column = re.compile(r"column (\d+)")
+
+    def parse(self, text):
+        return BooleanBuilder(text, engine="haskell").parse(text)
+
+    def test_corpus(self):
+        for text, expected in CORPUS:
+            with self.subTest(text=text):
+                if isinstance(expected, str):
+                    with self.assertRaises(ValueError) as context:
+                        self.parse(text)
+
+                    self.assertEqual(
+                        self.column.search(str(context.exception)).group(1),
+                        self.column.search(expected).group(1))
+                else:
+                    self.assertEqual(self.parse(text), expected)
+
+    def test_build_many(self):
+        corpus = normalized_corpus()
+        results = BooleanBuilder.build_many([text for text, _ in corpus],
+                                            engine="haskell")
+
+        for (text, expected), result in zip(corpus, results):
+            with self.subTest(text=text):
+                if isinstance(expected, str):
+                    self.assertIsInstance(result, ValueError)
+                else:
+                    self.assertEqual(result, expected)
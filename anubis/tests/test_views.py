@@ -0,0 +1,460 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# test_views.py - tests for the search views and their caches.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser, Group, User
+from django.core.cache import caches
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.views.generic import ListView
+from rest_framework import generics, serializers
+from rest_framework.test import APIRequestFactory
+
+from anubis import cache as anubis_cache
+from anubis.cache import GENERATION_TABLE, bump_generation
+from anubis.filters import QuerySetFilter
+from anubis.url import Boolean
+from anubis.views import AppViewMixin, CachedSearchMixin, CachedUnitMixin, \
+    StateViewMixin
+
+
+class UserSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ("id", "username")
+
+
+class UserSearchView(StateViewMixin, generics.ListAPIView):
+    model = User
+    serializers = (UserSerializer, UserSerializer)
+    filters = {
+        "username": QuerySetFilter("username").field("username"),
+        "staff": QuerySetFilter("is_staff").field("is_staff"),
+    }
+
+
+class CachedUserSearchView(CachedSearchMixin, UserSearchView):
+    pass
+
+
+class PaginatedUserSearchView(CachedSearchMixin, UserSearchView):
+    queryset = User.objects.order_by("username")
+    objects_per_page = 1
+
+
+class UnitCachedUserSearchView(CachedUnitMixin, UserSearchView):
+    unit_cache = "default"
+    generation_models = [User, Group]
+
+
+class FullyCachedUserSearchView(CachedSearchMixin, CachedUnitMixin,
+                                UserSearchView):
+    unit_cache = "default"
+    generation_models = [User, Group]
+
+
+class AppUserSearchView(CachedSearchMixin, AppViewMixin,
+                        generics.ListAPIView):
+    model = User
+    serializers = (UserSerializer, UserSerializer)
+    filters = UserSearchView.filters
+    default_filter = "username"
+    user_serializer = UserSerializer
+    share_cache_with_users = True
+    actions = {
+        "promote": {"models": [], "fields": {},
+                    "permissions": ["auth.change_user"]},
+    }
+
+    # the application data and templates need the admin and compiled
+    # templates, and don't depend on the user anyway
+    def get_application_data(self):
+        return {}
+
+    def get_templates(self):
+        return {}
+
+
+class HtmlUserSearchView(AppUserSearchView, ListView):
+    template_name = "anubis/search.html"
+    conditional_requests = True
+
+
+class ViewTestCase(TestCase):
+    view_class = UserSearchView
+
+    @classmethod
+    def setUpTestData(cls):
+        for name in ("ana", "bia", "caio"):
+            User.objects.create(username=name, is_staff=(name == "ana"))
+
+    def setUp(self):
+        caches["default"].clear()
+
+    def make_request(self, user=None):
+        request = APIRequestFactory().get("/")
+        request.user = AnonymousUser() if user is None else user
+
+        return request
+
+    def search(self, expression, user=None, **attributes):
+        view = self.view_class.as_view(**attributes)
+
+        return view(self.make_request(user), search=expression).data
+
+    def make_view(self, expression, user=None):
+        view = self.view_class()
+        view.request = self.make_request(user)
+        view.args = ()
+        view.kwargs = {"search": expression}
+        view.format_kwarg = None
+        view.is_api = True
+        view._prepare_attributes()
+
+        return view
+
+    def usernames(self, state):
+        return sorted(record["username"] for record
+                      in state["searchResults"]["results"])
+
+    def args(self, state):
+        return [list(unit["args"]) for unit in state["searchResults"]["expression"]
+                if "args" in unit]
+
+
+class StateViewMixinTestCase(ViewTestCase):
+    def test_search(self):
+        state = self.search("username,ana+username,caio")
+        results = state["searchResults"]
+
+        self.assertEqual(self.usernames(state), ["ana", "caio"])
+        self.assertEqual(results["textExpression"],
+                         "username,ana+username,caio")
+        self.assertEqual(results["position"], len(results["expression"]))
+
+    @override_settings(REST_FRAMEWORK={
+        "EXCEPTION_HANDLER": "anubis.views.exception_handler"})
+    def test_expression_too_complex(self):
+        view = self.view_class.as_view(expression_max_units=2)
+        expression = "username,ana+username,bia+username,caio"
+
+        response = view(self.make_request(), search=expression)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data["name"], "Expression Too Complex")
+        self.assertIn("maximum number of units (2)", response.data["detail"])
+
+        response = view(self.make_request(), search="username,ana+bia,")
+
+        self.assertEqual(response.data["name"], "Syntax Error")
+
+    def test_default_expression_limits(self):
+        limits = self.make_view("username,ana").get_expression_limits()
+
+        self.assertEqual((limits.max_length, limits.max_depth,
+                          limits.max_units, limits.max_args),
+                         (4096, 32, 256, 16))
+        self.assertEqual(
+            self.usernames(self.search("username,ana",
+                                       expression_max_length=None)),
+            ["ana"])
+
+
+class CachedSearchMixinTestCase(ViewTestCase):
+    view_class = CachedUserSearchView
+
+    def test_equivalent_expressions_keep_their_text(self):
+        first = self.search("username,ana+username,caio/")
+        second = self.search("username,caio username,ana")
+
+        self.assertEqual(self.usernames(first), self.usernames(second))
+        self.assertEqual(first["searchResults"]["textExpression"],
+                         "username,ana+username,caio")
+        self.assertEqual(second["searchResults"]["textExpression"],
+                         "username,caio username,ana")
+
+        self.assertEqual(self.args(first), [["ana"], ["caio"]])
+        self.assertEqual(self.args(second), [["caio"], ["ana"]])
+
+    def test_authenticated_users_not_cached_by_default(self):
+        user = User.objects.get(username="ana")
+
+        self.assertTrue(self.make_view("username,ana").is_cacheable)
+        self.assertFalse(self.make_view("username,ana", user).is_cacheable)
+
+    def test_cached_state_has_no_expression(self):
+        self.search("username,ana")
+
+        view = self.make_view("username,ana")
+        state, fresh = view._get_cached_state(view.get_search_cache(),
+                                              view.get_cache_key())
+
+        self.assertTrue(fresh)
+
+        for key in ("expression", "textExpression", "position"):
+            self.assertNotIn(key, state["searchResults"])
+
+
+class CachedCountTestCase(ViewTestCase):
+    view_class = PaginatedUserSearchView
+
+    def page(self, number):
+        view = self.view_class.as_view()
+        response = view(self.make_request(), search="staff,False",
+                        page=str(number))
+
+        return response.data["searchResults"]
+
+    def test_other_pages_not_counted_again(self):
+        # the count and the first page
+        with self.assertNumQueries(2):
+            first = self.page(1)
+
+        # only the second page, as the count is cached apart from the pages
+        with self.assertNumQueries(1):
+            second = self.page(2)
+
+        self.assertEqual([record["username"] for record in first["results"]],
+                         ["bia"])
+        self.assertEqual([record["username"] for record in second["results"]],
+                         ["caio"])
+        self.assertEqual(first["pagination"]["recordCount"], 2)
+        self.assertEqual(second["pagination"]["recordCount"], 2)
+
+
+class CacheStampedeTestCase(ViewTestCase):
+    """Only one request at a time builds a missing or expired search."""
+
+    view_class = CachedUserSearchView
+
+    def setUp(self):
+        super().setUp()
+
+        self.view_class.cache_metrics.clear()
+
+        patcher = mock.patch.object(StateViewMixin, "get_shared_state",
+                                    return_value={"built": True})
+        self.build_state = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.view = self.make_view("username,ana")
+        self.cache = self.view.get_search_cache()
+        self.key = self.view.get_cache_key()
+        self.lock_key = "lock:" + self.key
+
+    def metrics(self):
+        return dict(self.view_class.cache_metrics.snapshot())
+
+    def expire(self, state):
+        self.cache.set(self.key, (time.time() - 1, state), None)
+
+    def test_hit_and_miss(self):
+        self.assertEqual(self.view.get_shared_state(), {"built": True})
+        self.assertEqual(self.make_view("username,ana").get_shared_state(),
+                         {"built": True})
+
+        self.assertEqual(self.build_state.call_count, 1)
+        self.assertIsNone(self.cache.get(self.lock_key))
+        self.assertEqual(self.metrics(), {"hits": 1, "misses": 1,
+                                          "stale": 0, "lock_waits": 0})
+
+    def test_stale_served_while_rebuilding(self):
+        self.expire({"stale": True})
+        self.cache.add(self.lock_key, True)
+
+        self.assertEqual(self.view.get_shared_state(), {"stale": True})
+        self.assertEqual(self.build_state.call_count, 0)
+        self.assertEqual(self.metrics()["stale"], 1)
+
+    def test_expired_state_rebuilt(self):
+        self.expire({"stale": True})
+
+        self.assertEqual(self.view.get_shared_state(), {"built": True})
+        self.assertEqual(self.build_state.call_count, 1)
+        self.assertIsNone(self.cache.get(self.lock_key))
+
+        _, fresh = self.view._get_cached_state(self.cache, self.key)
+
+        self.assertTrue(fresh)
+        self.assertEqual(self.metrics()["misses"], 1)
+
+    def test_waits_on_lock(self):
+        self.cache.add(self.lock_key, True)
+
+        def build_elsewhere(seconds):
+            # the request holding the lock finishes while this one waits
+            self.view._set_cached_state(self.cache, self.key,
+                                        {"built": "elsewhere"})
+
+        with mock.patch("anubis.views.caching.time.sleep",
+                        side_effect=build_elsewhere):
+            state = self.view.get_shared_state()
+
+        self.assertEqual(state, {"built": "elsewhere"})
+        self.assertEqual(self.build_state.call_count, 0)
+        self.assertEqual(self.metrics()["lock_waits"], 1)
+
+    def test_wait_times_out(self):
+        self.cache.add(self.lock_key, "other")
+        self.view.cache_lock_wait = 0.01
+        self.view.cache_lock_poll = 0.001
+
+        self.assertEqual(self.view.get_shared_state(), {"built": True})
+        self.assertEqual(self.build_state.call_count, 1)
+        self.assertEqual(self.metrics()["misses"], 1)
+
+        # the lock belongs to the request still building the state
+        self.assertEqual(self.cache.get(self.lock_key), "other")
+
+    def test_lock_released_on_error(self):
+        self.build_state.side_effect = RuntimeError("database is gone")
+
+        with self.assertRaises(RuntimeError):
+            self.view.get_shared_state()
+
+        self.assertIsNone(self.cache.get(self.lock_key))
+        self.assertIsNone(self.cache.get(self.key))
+
+        self.build_state.side_effect = None
+
+        self.assertEqual(self.make_view("username,ana").get_shared_state(),
+                         {"built": True})
+
+
+class TableGenerationTestCase(ViewTestCase):
+    view_class = FullyCachedUserSearchView
+
+    def setUp(self):
+        super().setUp()
+
+        # as created by anubis.operations.AddGenerationTrigger
+        with connection.cursor() as cursor:
+            cursor.execute("create table {} (name varchar(255) primary key, "
+                           "generation integer)".format(
+                               connection.ops.quote_name(GENERATION_TABLE)))
+
+        patcher = mock.patch.object(anubis_cache, "_table_generations",
+                                    {User, Group})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read_once_per_request(self):
+        view = self.make_view("username,ana")
+
+        with self.assertNumQueries(0):
+            generation = view.get_data_generation()
+
+        self.assertEqual(generation, view.get_cache_key().split(":")[1])
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.usernames(self.search("username,ana")),
+                             ["ana"])
+
+        queries = [query["sql"] for query in context.captured_queries
+                   if GENERATION_TABLE in query["sql"]]
+
+        # one per generation model, although both the search and its units
+        # are cached by generation
+        self.assertEqual(len(queries), 2)
+
+
+class SharedCacheTestCase(ViewTestCase):
+    view_class = AppUserSearchView
+
+    def test_users_get_their_own_data(self):
+        admin = User.objects.create(username="admin", is_superuser=True)
+        user = User.objects.get(username="bia")
+
+        admin_state = self.make_view("username,ana", admin).get_full_state()
+        view = self.make_view("username,ana", user)
+        _, fresh = view._get_cached_state(view.get_search_cache(),
+                                          view.get_cache_key())
+        user_state = view.get_full_state()
+
+        self.assertTrue(fresh)
+        self.assertEqual(admin_state["user"]["username"], "admin")
+        self.assertEqual(user_state["user"]["username"], "bia")
+        self.assertIn("promote", admin_state["searchResults"]["actions"])
+        self.assertNotIn("promote", user_state["searchResults"]["actions"])
+        self.assertEqual(self.usernames(user_state), ["ana"])
+
+    def test_cached_state_has_no_user_data(self):
+        user = User.objects.create(username="admin", is_superuser=True)
+        view = self.make_view("username,ana", user)
+        view.action_result = {"success": True, "result": None, "error": None}
+        view.get_full_state()
+
+        state, _ = view._get_cached_state(view.get_search_cache(),
+                                          view.get_cache_key())
+
+        self.assertNotIn("user", state)
+        self.assertNotIn("actions", state["searchResults"])
+        self.assertNotIn("actionResult", state["searchResults"])
+
+
+class CachedUnitMixinTestCase(ViewTestCase):
+    view_class = UnitCachedUserSearchView
+
+    def test_search(self):
+        for _ in range(2):
+            state = self.search("username,ana+username,caio")
+            self.assertEqual(self.usernames(state), ["ana", "caio"])
+
+    def test_units_follow_data_generation(self):
+        unit = Boolean.unit("username", ["ana"])
+        view = self.make_view("username,ana")
+        key = view.get_unit_aggregator(User.objects.all()).make_cache_key(unit)
+
+        bump_generation(Group)
+
+        view = self.make_view("username,ana")
+
+        self.assertNotEqual(
+            view.get_unit_aggregator(User.objects.all()).make_cache_key(unit),
+            key)
+
+
+class ConditionalRequestTestCase(ViewTestCase):
+    def get(self, **headers):
+        request = RequestFactory().get("/", **headers)
+        request.user = AnonymousUser()
+
+        return HtmlUserSearchView.as_view()(request, search="username,ana")
+
+    def assertRevalidated(self, response):
+        cache_control = {part.strip() for part
+                         in response["Cache-Control"].split(",")}
+
+        self.assertEqual(cache_control,
+                         {"private", "no-cache", "must-revalidate"})
+
+    def test_full_and_not_modified_responses(self):
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertRevalidated(response)
+
+        response = self.get(HTTP_IF_NONE_MATCH=response["ETag"])
+
+        self.assertEqual(response.status_code, 304)
+        self.assertRevalidated(response)
@@ -0,0 +1,87 @@
+# Copyright © 2016, Ugo Pozo
+#             2016, Câmara Municipal de São Paulo
+
+# test_warmcache.py - tests for the warmcache command.
+
+# This file is part of Anubis.
+
+# Anubis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Anubis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf.urls import url
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from anubis.app.management.commands.warmcache import Command
+from anubis.tests.test_views import UserSearchView
+from anubis.views import CachedSearchMixin, CachedUnitMixin
+
+
+class WarmedUserSearchView(CachedSearchMixin, CachedUnitMixin,
+                           UserSearchView):
+    unit_cache = "default"
+
+
+urlpatterns = [
+    url(r"^users/(?P<search>.+)/$", WarmedUserSearchView.as_view()),
+    url(r"^others/(?P<search>.+)/$", UserSearchView.as_view()),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class WarmCacheTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for name in ("ana", "bia", "caio"):
+            User.objects.create(username=name, is_staff=(name == "ana"))
+
+    def setUp(self):
+        caches["default"].clear()
+        self.command = Command()
+
+    def test_searches_from_log_of_the_view(self):
+        lines = [
+            '"GET /users/username,ana/ HTTP/1.1" 200',
+            '"GET /others/username,bia/ HTTP/1.1" 200',
+            '"GET /users/username,caio/ HTTP/1.1" 200',
+            '"GET /users/username,ana/ HTTP/1.1" 200',
+            '"GET /missing/ HTTP/1.1" 404',
+        ]
+
+        self.assertEqual(
+            self.command.searches_from_log(WarmedUserSearchView, lines),
+            [{"search": "username,ana"}, {"search": "username,caio"}])
+
+    def test_units_warmed_with_fresh_state(self):
+        search = {"search": "username,ana+staff,False"}
+        report = self.command.warm(WarmedUserSearchView, search, True)
+
+        self.assertIsNone(report["error"])
+        self.assertFalse(report["cached"])
+        self.assertEqual(report["units"], 2)
+
+        view = self.command.make_view(WarmedUserSearchView, search, True)
+        aggregator = view.get_unit_aggregator(User.objects.all())
+
+        for unit in view.canonical_expression.children():
+            caches["default"].delete(aggregator.make_cache_key(unit))
+
+        report = self.command.warm(WarmedUserSearchView, search, True)
+
+        self.assertTrue(report["cached"])
+        self.assertGreater(report["units_size"], 0)
+
+        for unit in view.canonical_expression.children():
+            self.assertIsNotNone(
+                caches["default"].get(aggregator.make_cache_key(unit)))
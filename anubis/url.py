@@ -18,190 +18,1060 @@
 # Você deve ter recebido uma cópia da Licença Pública Geral GNU junto com
 # este programa. Se não, consulte <http://www.gnu.org/licenses/>.
 
+import atexit
 import ctypes
-import pkg_resources
 import json
+import os
+import pkg_resources
+from collections import OrderedDict
 from threading import Lock
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from anubis.cache import LRUCache
+
 
 class Boolean:
+    """Base class for the nodes of a boolean search expression.
 
-    class Type:
-        fields = ()
+    Nodes are compact (`__slots__`-based) and immutable. Conjunctions and
+    disjunctions are n-ary: nesting the same operator is flattened on
+    construction, so a long chain of units is a single shallow node instead of
+    a deep left-associated tree.
 
-        @staticmethod
-        def set_contents(expr, dictionary):
-            expr.contents = dictionary
+    :meth:`traverse` keeps the binary contract expected by
+    :class:`anubis.aggregators.Aggregator` - n-ary nodes are folded from the
+    left - but walks the tree with an explicit stack instead of recursion.
+    """
 
-    class Expr(Type):
-        fields = ("field", "args")
+    __slots__ = ()
 
-        @staticmethod
-        def repr(expr):
-            return "{}: {}".format(repr(expr["field"]), expr["args"])
+    type_name = None
+    fields = ()
 
-        @staticmethod
-        def set_contents(expr, dictionary):
-            expr.contents = dictionary["contents"]
+    # set up after the node classes are defined
+    Expr = Not = And = Or = None
+    types = {}
+    precedence = []
 
-        @staticmethod
-        def traverse(expr, func):
-            return func(base_expression=expr)
+    @classmethod
+    def build(cls, dictionary):
+        """Object hook for decoding the JSON output of the Haskell parser.
 
-    class Not(Type):
-        fields = ("expr",)
+        Chains of ANDs and ORs come flattened into a list of `operands`;
+        the binary `left`/`right` form of older builds is accepted as well.
+        """
+        if "tag" not in dictionary.keys():
+            return dictionary
 
-        @staticmethod
-        def repr(expr):
-            return "NOT ({})".format(str(expr["expr"]))
+        tag = dictionary["tag"]
 
-        @staticmethod
-        def set_contents(expr, dictionary):
-            expr.contents = dict(expr=dictionary["contents"])
+        if tag == "BooleanExpr":
+            contents = dictionary["contents"]
+            return cls.unit(contents["field"], contents["args"])
+        elif tag == "Not":
+            return cls.negation(dictionary["contents"])
+        elif tag in ("And", "Or"):
+            operator = cls.conjunction if tag == "And" else cls.disjunction
+            operands = dictionary.get("operands", None)
 
-        @staticmethod
-        def traverse(expr, func):
-            return func(not_expression=expr["expr"].traverse(func),
-                        inside_type=expr["expr"].type_.__class__)
+            if operands is None:
+                operands = (dictionary["left"], dictionary["right"])
 
-    class And(Type):
-        fields = ("left", "right")
+            return operator(*operands)
 
-        @staticmethod
-        def repr(expr):
-            return "({}) AND ({})".format(
-                str(expr["left"]), str(expr["right"]))
+        raise ValueError(dictionary["contents"])
 
-        @staticmethod
-        def traverse(expr, func):
-            return func(and_expression=(expr["left"].traverse(func),
-                                        expr["right"].traverse(func)),
-                        left_type=expr["left"].type_.__class__,
-                        right_type=expr["right"].type_.__class__)
+    @classmethod
+    def unit(cls, field, args):
+        return BooleanExpr(field, args)
 
-    class Or(Type):
-        fields = ("left", "right")
+    @classmethod
+    def negation(cls, expr):
+        return BooleanNot(expr)
 
-        @staticmethod
-        def repr(expr):
-            return "({}) OR ({})".format(str(expr["left"]), str(expr["right"]))
+    @classmethod
+    def conjunction(cls, *operands):
+        return BooleanAnd(operands)
 
-        @staticmethod
-        def traverse(expr, func):
-            return func(or_expression=(expr["left"].traverse(func),
-                                       expr["right"].traverse(func)),
-                        left_type=expr["left"].type_.__class__,
-                        right_type=expr["right"].type_.__class__)
+    @classmethod
+    def disjunction(cls, *operands):
+        return BooleanOr(operands)
 
-    types = {"BooleanExpr": Expr(),
-             "Not": Not(),
-             "And": And(),
-             "Or": Or()
-            }
+    def children(self):
+        return ()
 
-    precedence = [Expr, Not, And, Or]
+    def keys(self):
+        return list(self.fields) + ["type"]
 
-    def __init__(self, contents, type_):
-        assert isinstance(type_, self.Type)
+    def traverse(self, func):
+        results = []
+        stack = [(self, False)]
 
-        self.type_ = type_
-        self.type_.set_contents(self, contents)
+        while stack:
+            node, visited = stack.pop()
 
-    @classmethod
-    def build(cls, dictionary):
-        if "tag" in dictionary.keys():
-            if dictionary["tag"] in cls.types.keys():
-                return Boolean(dictionary, cls.types[dictionary["tag"]])
+            if visited:
+                node._aggregate(func, results)
             else:
-                raise ValueError(dictionary["contents"])
+                stack.append((node, True))
+                stack.extend((child, False)
+                             for child in reversed(node.children()))
 
-        return dictionary
+        return results.pop()
 
-    def keys(self):
-        return list(self.type_.fields) + ["type"]
+    def transform(self, func):
+        """Rebuilds the tree bottom-up.
 
-    def traverse(self, func):
-        return self.type_.traverse(self, func)
+        Args:
+            func (Callable[[Boolean, List[Boolean]], Boolean]): Called for
+                every node with the node itself and its already transformed
+                children. Its return value replaces the node.
+
+        Returns:
+            Boolean: The transformed tree.
+        """
+        results = []
+        stack = [(self, False)]
+
+        while stack:
+            node, visited = stack.pop()
+
+            if visited:
+                count = len(node.children())
+                children = results[len(results) - count:]
+                del results[len(results) - count:]
+                results.append(func(node, children))
+            else:
+                stack.append((node, True))
+                stack.extend((child, False)
+                             for child in reversed(node.children()))
+
+        return results.pop()
+
+    def normalize(self):
+        """Returns the canonical form of this expression.
+
+        Associative operators are flattened, the operands of commutative
+        operators are deduplicated and sorted, and double negations are
+        removed, so that equivalent expressions written differently share the
+        same tree.
+
+        Returns:
+            Boolean: The normalized tree.
+        """
+        return self.transform(lambda node, children:
+                              node._normalized(children))
+
+    def factor(self):
+        """Factors operands shared by every branch of a conjunction or
+        disjunction, e.g. `(a AND b) OR (a AND c)` becomes `a AND (b OR c)`,
+        and absorbs redundant branches, e.g. `a OR (a AND b)` becomes `a`.
+
+        Both rewrites are valid in boolean algebra, so the factored tree
+        matches the same records while evaluating each shared unit once.
+
+        Returns:
+            Boolean: The factored tree, normalized.
+        """
+        return self.transform(lambda node, children:
+                              node._factored(children))
+
+    def _normalized(self, children):
+        raise NotImplementedError()
+
+    def _factored(self, children):
+        return self._normalized(children)
+
+    def _sort_key(self):
+        raise NotImplementedError()
+
+    def _aggregate(self, func, results):
+        raise NotImplementedError()
+
+    def _key(self):
+        raise NotImplementedError()
 
     def __getitem__(self, key):
         if key == "type":
-            return self.type_.__class__.__name__
+            return self.type_name
+
+        if key.startswith("_"):
+            raise KeyError(key)
+
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
 
-        return self.contents[key]
+    def __setattr__(self, name, value):
+        # trees are shared through BooleanBuilder's cache, so they must not
+        # change after being built
+        raise AttributeError("Boolean expressions are immutable.")
 
-    # def __iter__(self):
-    #     # For dict() conversion
-    #     for key in self.keys() + ["tag"]:
-    #         yield (key, self.contents[key])
+    def __delattr__(self, name):
+        raise AttributeError("Boolean expressions are immutable.")
 
     def __eq__(self, other):
-        return self.contents == other.contents
+        if not isinstance(other, Boolean):
+            return NotImplemented
 
-    def __str__(self):
-        return self.type_.repr(self)
+        return self._hash == other._hash and self._key() == other._key()
+
+    def __hash__(self):
+        return self._hash
 
     def __repr__(self):
         return str(self)
 
 
+class BooleanExpr(Boolean):
+    __slots__ = ("field", "args", "_hash")
+
+    type_name = "Expr"
+    fields = ("field", "args")
+
+    def __init__(self, field, args):
+        object.__setattr__(self, "field", field)
+        object.__setattr__(self, "args", tuple(args))
+        object.__setattr__(self, "_hash", hash(self._key()))
+
+    def _key(self):
+        return (self.type_name, self.field, self.args)
+
+    def _sort_key(self):
+        return (0, self.field, self.args)
+
+    def _normalized(self, children):
+        return self
+
+    def _aggregate(self, func, results):
+        results.append(func(base_expression=self))
+
+    def __str__(self):
+        return "{}: {}".format(repr(self.field), list(self.args))
+
+
+class BooleanNot(Boolean):
+    __slots__ = ("expr", "_hash")
+
+    type_name = "Not"
+    fields = ("expr",)
+
+    def __init__(self, expr):
+        object.__setattr__(self, "expr", expr)
+        object.__setattr__(self, "_hash", hash(self._key()))
+
+    def children(self):
+        return (self.expr,)
+
+    def _key(self):
+        return (self.type_name, self.expr)
+
+    def _sort_key(self):
+        return (1, self.expr._sort_key())
+
+    def _normalized(self, children):
+        expr, = children
+
+        if isinstance(expr, BooleanNot):
+            return expr.expr
+
+        return self if expr is self.expr else BooleanNot(expr)
+
+    def _aggregate(self, func, results):
+        results.append(func(not_expression=results.pop(),
+                            inside_type=self.expr.__class__))
+
+    def __str__(self):
+        return "NOT ({})".format(str(self.expr))
+
+
+class BooleanOperator(Boolean):
+    __slots__ = ("operands", "_hash")
+
+    fields = ("operands",)
+    keyword = None
+    connective = None
+    sort_rank = None
+    dual = None
+
+    def __init__(self, operands):
+        flattened = []
+
+        for operand in operands:
+            if operand.__class__ is self.__class__:
+                flattened.extend(operand.operands)
+            else:
+                flattened.append(operand)
+
+        assert len(flattened) > 1, "Operators need at least two operands."
+
+        object.__setattr__(self, "operands", tuple(flattened))
+        object.__setattr__(self, "_hash", hash(self._key()))
+
+    @property
+    def left(self):
+        if len(self.operands) == 2:
+            return self.operands[0]
+
+        return self.__class__(self.operands[:-1])
+
+    @property
+    def right(self):
+        return self.operands[-1]
+
+    def children(self):
+        return self.operands
+
+    def _key(self):
+        return (self.type_name, self.operands)
+
+    def _sort_key(self):
+        return (self.sort_rank,
+                tuple(operand._sort_key() for operand in self.operands))
+
+    @classmethod
+    def _combine(cls, operands):
+        unique = set()
+
+        for operand in operands:
+            if operand.__class__ is cls:
+                unique.update(operand.operands)
+            else:
+                unique.add(operand)
+
+        unique = sorted(unique, key=lambda operand: operand._sort_key())
+
+        if len(unique) == 1:
+            return unique[0]
+
+        return cls(unique)
+
+    def _normalized(self, children):
+        return self._combine(children)
+
+    def _factored(self, children):
+        node = self._combine(children)
+
+        if node.__class__ is not self.__class__:
+            return node
+
+        dual = self.dual
+        groups = [set(operand.operands) if operand.__class__ is dual
+                  else {operand} for operand in node.operands]
+        shared = set.intersection(*groups)
+
+        if not shared:
+            return node
+
+        rests = [group - shared for group in groups]
+
+        # a OR (a AND b) == a
+        if not all(rests):
+            return dual._combine(shared)
+
+        branches = [dual._combine(rest) for rest in rests]
+
+        return dual._combine(list(shared) + [self._combine(branches)])
+
+    def _aggregate(self, func, results):
+        count = len(self.operands)
+        values = results[-count:]
+        del results[-count:]
+
+        value = values[0]
+        value_type = self.operands[0].__class__
+
+        for operand, operand_value in zip(self.operands[1:], values[1:]):
+            value = func(**{
+                self.keyword: (value, operand_value),
+                "left_type": value_type,
+                "right_type": operand.__class__,
+            })
+            value_type = self.__class__
+
+        results.append(value)
+
+    def __str__(self):
+        return " {} ".format(self.connective).join(
+            "({})".format(str(operand)) for operand in self.operands)
+
+
+class BooleanAnd(BooleanOperator):
+    __slots__ = ()
+
+    type_name = "And"
+    keyword = "and_expression"
+    connective = "AND"
+    sort_rank = 2
+
+
+class BooleanOr(BooleanOperator):
+    __slots__ = ()
+
+    type_name = "Or"
+    keyword = "or_expression"
+    connective = "OR"
+    sort_rank = 3
+
+
+BooleanAnd.dual = BooleanOr
+BooleanOr.dual = BooleanAnd
+
+Boolean.Expr = BooleanExpr
+Boolean.Not = BooleanNot
+Boolean.And = BooleanAnd
+Boolean.Or = BooleanOr
+
+Boolean.types = {"BooleanExpr": BooleanExpr,
+                 "Not": BooleanNot,
+                 "And": BooleanAnd,
+                 "Or": BooleanOr
+                }
+
+Boolean.precedence = [BooleanExpr, BooleanNot, BooleanAnd, BooleanOr]
+
+
+class ExpressionLimitError(ValueError):
+    """Raised when an expression exceeds the configured
+    :class:`ExpressionLimits`."""
+
+    def name(self):
+        return "Expression Too Complex"
+
+
+class ExpressionLimits:
+    """Resource limits for parsing an expression.
+
+    Every limit is optional; :const:`None` disables it.
+
+    Args:
+        max_length (Optional[int]): Maximum length of the expression text.
+        max_depth (Optional[int]): Maximum nesting depth, both of the
+            parentheses in the text and of the resulting tree.
+        max_units (Optional[int]): Maximum number of search units.
+        max_args (Optional[int]): Maximum number of arguments per unit.
+    """
+
+    def __init__(self, max_length=None, max_depth=None, max_units=None,
+                 max_args=None):
+        self.max_length = max_length
+        self.max_depth = max_depth
+        self.max_units = max_units
+        self.max_args = max_args
+
+    @staticmethod
+    def _check(value, limit, description):
+        if limit is not None and value > limit:
+            raise ExpressionLimitError(
+                "The expression exceeds the maximum {} ({}).".format(
+                    description, limit))
+
+    def check_length(self, length):
+        self._check(length, self.max_length, "length")
+
+    def check_depth(self, depth):
+        self._check(depth, self.max_depth, "nesting depth")
+
+    def check_units(self, units):
+        self._check(units, self.max_units, "number of units")
+
+    def check_args(self, args):
+        self._check(args, self.max_args, "number of arguments per unit")
+
+    def check(self, boolean):
+        """Checks an already built tree against the limits.
+
+        Raises:
+            ExpressionLimitError: If any limit is exceeded.
+        """
+        units = 0
+        stack = [(boolean, 1)]
+
+        while stack:
+            node, depth = stack.pop()
+            self.check_depth(depth)
+
+            if isinstance(node, BooleanExpr):
+                units += 1
+                self.check_units(units)
+                self.check_args(len(node.args))
+
+            stack.extend((child, depth + 1) for child in node.children())
+
+
+class ExpressionParser:
+    """A pure Python implementation of the grammar in `parseurl/ParseUrl.hs`.
+
+    It follows the Parsec parser step by step, quirks included: a single `!`
+    per term, operators that must be followed by a term once consumed, and
+    trailing input that is silently ignored. The result is the same
+    :class:`Boolean` tree the Haskell library produces, built directly.
+    """
+
+    and_operator = "/"
+    or_operator = "+"
+    or_separator = " "
+    not_operator = "!"
+    open_parens = "("
+    close_parens = ")"
+    arg_separator = ","
+    quote = "\""
+    escape = "$"
+
+    def __init__(self, text, limits=None):
+        self.text = text
+        self.position = 0
+        self.limits = limits if limits is not None else ExpressionLimits()
+        self.units = 0
+
+    @staticmethod
+    def is_word_char(char):
+        return char.isalpha() or char in "0123456789_-"
+
+    def parse(self):
+        self.limits.check_length(len(self.text))
+
+        return self.full_expr()
+
+    def peek(self, offset=0):
+        index = self.position + offset
+
+        return self.text[index] if index < len(self.text) else None
+
+    def fail(self, expecting):
+        found = self.peek()
+        found = "end of input" if found is None else repr(found)
+
+        raise ValueError("(column {}): unexpected {}; expecting {}"
+                         .format(self.position + 1, found, expecting))
+
+    def expect(self, char):
+        if self.peek() != char:
+            self.fail(repr(char))
+
+        self.position += 1
+
+    def consume(self, char):
+        if self.peek() == char:
+            self.position += 1
+            return True
+
+        return False
+
+    def consume_or_operator(self):
+        if self.consume(self.or_operator):
+            return True
+
+        start = self.position
+
+        while self.peek() == self.or_separator:
+            self.position += 1
+
+        return self.position > start
+
+    @staticmethod
+    def combine(operator, operands):
+        if len(operands) == 1:
+            return operands[0]
+
+        return operator(*operands)
+
+    def full_expr(self):
+        # Parenthesized groups are handled with an explicit stack of the
+        # enclosing groups' state, so nesting depth never hits the recursion
+        # limit.
+        groups = []
+        or_operands = []
+        and_operands = []
+
+        while True:
+            negated = self.consume(self.not_operator)
+
+            if self.consume(self.open_parens):
+                groups.append((or_operands, and_operands, negated))
+                self.limits.check_depth(len(groups))
+                or_operands = []
+                and_operands = []
+                continue
+
+            expr = self.search()
+
+            while True:
+                if negated:
+                    expr = Boolean.negation(expr)
+
+                and_operands.append(expr)
+
+                if self.consume(self.and_operator):
+                    break
+
+                or_operands.append(self.combine(Boolean.conjunction,
+                                                and_operands))
+                and_operands = []
+
+                if self.consume_or_operator():
+                    break
+
+                expr = self.combine(Boolean.disjunction, or_operands)
+
+                if len(groups) == 0:
+                    return expr
+
+                self.expect(self.close_parens)
+                or_operands, and_operands, negated = groups.pop()
+
+    def word(self, expecting):
+        start = self.position
+
+        while self.peek() is not None and self.is_word_char(self.peek()):
+            self.position += 1
+
+        if self.position == start:
+            self.fail(expecting)
+
+        return self.text[start:self.position]
+
+    def search(self):
+        self.units += 1
+        self.limits.check_units(self.units)
+
+        field = self.word("field name")
+        self.expect(self.arg_separator)
+        args = [self.arg()]
+
+        while self.peek() == self.arg_separator:
+            self.position += 1
+            args.append(self.arg())
+            self.limits.check_args(len(args))
+
+        return Boolean.unit(field, args)
+
+    def arg(self):
+        if self.peek() == self.quote:
+            start = self.position
+            arg = self.quoted_arg()
+
+            if arg is not None:
+                return arg
+
+            self.position = start
+
+        return self.word("argument")
+
+    def quoted_arg(self):
+        self.position += 1
+        chars = []
+
+        while True:
+            char = self.peek()
+
+            if char is None:
+                return None
+            elif char == self.quote:
+                self.position += 1
+                return "".join(chars)
+            elif char == self.escape:
+                escaped = self.peek(1)
+
+                if escaped not in (self.quote, self.escape):
+                    return None
+
+                chars.append(escaped)
+                self.position += 2
+            else:
+                chars.append(char)
+                self.position += 1
+
+
 class BooleanBuilder:
+    """Builds a :class:`Boolean` tree out of a search expression.
+
+    The parser engine is chosen by the `ANUBIS_PARSER_ENGINE` setting: either
+    `"haskell"` (the default), which calls into the compiled `libParseUrl.so`,
+    or `"python"`, which uses :class:`ExpressionParser` and needs no compiled
+    library at all.
+
+    If :class:`ExpressionLimits` are given, they are checked before any
+    parsing happens (for the text length), while parsing (with the Python
+    engine) and on every built or cached tree.
+
+    Built trees are kept in a process-local LRU cache keyed by the normalized
+    expression, whose size is set by `ANUBIS_EXPRESSION_CACHE_SIZE` (`0`
+    disables it). Since they are shared, the trees are immutable.
+    """
+
     parser_lib_name = "libParseUrl.so"
+    parser_exports = {
+        "parseUrl": ([ctypes.c_char_p], ctypes.c_void_p),
+        "parseUrls": ([ctypes.c_char_p], ctypes.c_void_p),
+        "freeResult": ([ctypes.c_void_p], None),
+    }
+    engines = ("haskell", "python")
+    default_engine = "haskell"
+    default_cache_size = 1024
 
-    def __init__(self, url):
+    _cache = None
+    _cache_configured = False
+    _cache_lock = Lock()
+
+    def __init__(self, url, engine=None, limits=None):
         self.url = url
+        self.engine = engine
+        self.limits = limits
+
+    def get_engine(self):
+        engine = self.engine
+
+        if engine is None:
+            engine = getattr(settings, "ANUBIS_PARSER_ENGINE",
+                             self.default_engine)
+
+        if engine not in self.engines:
+            raise ImproperlyConfigured("Unknown parser engine: {}."
+                                       .format(engine))
+
+        return engine
+
+    @staticmethod
+    def normalize(url):
+        return url.strip().rstrip("/")
+
+    @classmethod
+    def get_cache(cls):
+        if not cls._cache_configured:
+            with cls._cache_lock:
+                if not cls._cache_configured:
+                    size = getattr(settings, "ANUBIS_EXPRESSION_CACHE_SIZE",
+                                   cls.default_cache_size)
+                    cls._cache = LRUCache(size) if size else None
+                    cls._cache_configured = True
+
+        return cls._cache
+
+    @classmethod
+    def cache_info(cls):
+        """Returns the hit and miss counters of the expression cache.
+
+        Returns:
+            Optional[anubis.cache.CacheInfo]: The cache statistics, or
+            :const:`None` if the cache is disabled.
+        """
+        cache = cls.get_cache()
+
+        return cache.info() if cache is not None else None
 
     def build(self):
-        url_bytestr = self.url.encode("utf-8")
+        url = self.normalize(self.url)
+        cache = self.get_cache()
+
+        if self.limits is not None:
+            self.limits.check_length(len(url))
+
+        if cache is not None:
+            boolean = cache.get(url, None)
+
+            if boolean is not None:
+                self.check_limits(boolean)
+
+                return boolean
+
+        boolean = self.parse(url)
+        self.check_limits(boolean)
+
+        if cache is not None:
+            cache.set(url, boolean)
+
+        return boolean
 
-        with HaskellLibrary(self.parser_lib_path) as parser_lib:
-            parser_lib.parseUrl.argtypes = [ctypes.c_char_p]
-            parser_lib.parseUrl.restype = ctypes.c_char_p
-            json_bytestr = parser_lib.parseUrl(url_bytestr)
+    def check_limits(self, boolean):
+        if self.limits is not None:
+            self.limits.check(boolean)
+
+    @classmethod
+    def build_many(cls, urls, engine=None, limits=None):
+        """Builds many expressions at once.
+
+        Expressions missing from the cache are parsed together, in a single
+        call to the parser library when using the Haskell engine. A syntax
+        error in one expression doesn't affect the others.
+
+        Args:
+            urls (Iterable[str]): The expressions to build.
+            engine (Optional[str]): The parser engine, overriding the
+                `ANUBIS_PARSER_ENGINE` setting.
+            limits (Optional[ExpressionLimits]): Limits each expression
+                must respect.
+
+        Returns:
+            List[Union[Boolean, ValueError]]: For each expression, in order,
+            either its tree or the error raised while parsing it.
+        """
+        builder = cls("", engine, limits)
+        urls = [builder.normalize(url) for url in urls]
+        cache = builder.get_cache()
+        results = {}
+
+        for url in urls:
+            if url in results:
+                continue
+
+            try:
+                if limits is not None:
+                    limits.check_length(len(url))
+
+                boolean = cache.get(url, None) if cache is not None else None
+
+                if boolean is not None:
+                    builder.check_limits(boolean)
+                    results[url] = boolean
+            except ExpressionLimitError as error:
+                results[url] = error
+
+        missing = list(OrderedDict.fromkeys(url for url in urls
+                                            if url not in results))
+
+        if len(missing) > 0:
+            parsed = builder.parse_many(missing)
+
+            for url, boolean in zip(missing, parsed):
+                if isinstance(boolean, Boolean):
+                    try:
+                        builder.check_limits(boolean)
+                    except ExpressionLimitError as error:
+                        results[url] = error
+                        continue
+
+                    if cache is not None:
+                        cache.set(url, boolean)
+
+                results[url] = boolean
+
+        return [results[url] for url in urls]
+
+    def parse(self, url):
+        try:
+            return getattr(self, "parse_{}".format(self.get_engine()))(url)
+        except ForkedRuntimeError:
+            # both engines implement the same grammar
+            return self.parse_python(url)
+
+    def parse_many(self, urls):
+        try:
+            return getattr(self, "parse_many_{}".format(self.get_engine()))(
+                urls)
+        except ForkedRuntimeError:
+            return self.parse_many_python(urls)
+
+    def parse_many_python(self, urls):
+        results = []
+
+        for url in urls:
+            try:
+                results.append(self.parse_python(url))
+            except ValueError as error:
+                results.append(error)
+
+        return results
+
+    def parse_many_haskell(self, urls):
+        parser_lib = HaskellLibrary.resident(self.parser_lib_path,
+                                             self.parser_exports)
+
+        if not hasattr(parser_lib, "parseUrls"):
+            return self._parse_each_haskell(urls)
+
+        urls_bytestr = json.dumps(urls).encode("utf-8")
+        json_bytestr = self._call_parser(parser_lib, "parseUrls", urls_bytestr)
 
         json_str = json_bytestr.decode("utf-8")
-        json_obj = json.loads(json_str, object_hook=Boolean.build)
+
+        try:
+            json_obj = json.loads(json_str, object_hook=self._build_or_error)
+        except RecursionError:
+            # only the deeply nested expressions should fail
+            return self._parse_each_haskell(urls)
+
+        if isinstance(json_obj, ValueError):
+            raise json_obj
 
         return json_obj
 
+    def _parse_each_haskell(self, urls):
+        results = []
+
+        for url in urls:
+            try:
+                results.append(self.parse_haskell(url))
+            except ValueError as error:
+                results.append(error)
+
+        return results
+
+    @staticmethod
+    def _build_or_error(dictionary):
+        if dictionary.get("tag", None) == "PyExc":
+            return ValueError(dictionary["contents"])
+
+        return Boolean.build(dictionary)
+
+    def parse_python(self, url):
+        return ExpressionParser(url, self.limits).parse()
+
+    def parse_haskell(self, url):
+        url_bytestr = url.encode("utf-8")
+
+        parser_lib = HaskellLibrary.resident(self.parser_lib_path,
+                                             self.parser_exports)
+        json_bytestr = self._call_parser(parser_lib, "parseUrl", url_bytestr)
+
+        json_str = json_bytestr.decode("utf-8")
+
+        try:
+            json_obj = json.loads(json_str, object_hook=Boolean.build)
+        except RecursionError:
+            # the json module decodes nested objects recursively
+            raise ExpressionLimitError(
+                "The expression is nested too deeply to be decoded.")
+
+        return json_obj
+
+    @staticmethod
+    def _call_parser(parser_lib, name, argument):
+        # the result is allocated by the library, which must free it once
+        # copied
+        result = getattr(parser_lib, name)(argument)
+
+        try:
+            return ctypes.string_at(result)
+        finally:
+            if hasattr(parser_lib, "freeResult"):
+                parser_lib.freeResult(result)
+
     @property
     def parser_lib_path(self):
         return pkg_resources.resource_filename("anubis", self.parser_lib_name)
 
 
+class ForkedRuntimeError(RuntimeError):
+    """Raised when loading a Haskell library whose runtime was initialized
+    by the parent of a forked process."""
+
+
 class HaskellLibrary:
-    libdl = "libdl.so"
-    _locks = {}
+    """A Haskell shared library that stays resident in the process.
+
+    The library is loaded and the GHC runtime is initialized lazily, on the
+    first call to :meth:`load`, and the runtime is only shut down at
+    interpreter exit. Exported functions can then be called concurrently from
+    any thread, as the library is built against the threaded runtime.
+
+    The runtime can't be used by a forked child if its parent had already
+    initialized it, since the runtime's threads don't survive a fork, and
+    calling `hs_init` again would only bump the reference count of the
+    inherited runtime. :meth:`load` raises :exc:`ForkedRuntimeError` in that
+    case, and :class:`BooleanBuilder` falls back to the Python engine. A
+    pre-forking server should therefore not parse anything in its master
+    process. Children forked before the library was loaded initialize their
+    own runtime as usual.
+    """
+
+    _instances = {}
     _master_lock = Lock()
 
-    def __init__(self, lib_path):
+    def __init__(self, lib_path, exports=None):
         self.lib_path = lib_path
+        self.exports = dict(exports or {})
         self.library = None
+        self.pid = None
+        self.lock = Lock()
 
-        with self._master_lock:
-            if self.lib_path not in self._locks.keys():
-                self._locks[self.lib_path] = Lock()
+    @classmethod
+    def resident(cls, lib_path, exports=None):
+        """Returns the loaded library for `lib_path`, loading it if needed.
 
-            self.lock = self._locks[self.lib_path]
+        Args:
+            lib_path (str): Path to the shared library.
+            exports (Optional[Dict[str, Tuple[list, type]]]): Argument and
+                return types for the exported functions, keyed by name. They
+                are set only once, when the library is loaded.
 
-    def __enter__(self):
-        self.lock.acquire()
-        self.library = ctypes.cdll.LoadLibrary(self.lib_path)
+        Returns:
+            ctypes.CDLL: The loaded library.
+        """
+        instance = cls._instances.get(lib_path, None)
+
+        if instance is None:
+            with cls._master_lock:
+                instance = cls._instances.setdefault(lib_path,
+                                                     cls(lib_path, exports))
+
+        return instance.load()
+
+    def load(self):
+        library = self.library
+
+        if library is not None and self.pid == os.getpid():
+            return library
 
-        self.library.hs_init(0, 0)
+        with self.lock:
+            if self.library is not None and self.pid != os.getpid():
+                raise ForkedRuntimeError(
+                    "The Haskell runtime of {} was initialized by process {} "
+                    "and can't be used after a fork.".format(self.lib_path,
+                                                             self.pid))
+
+            if self.library is None:
+                library = ctypes.cdll.LoadLibrary(self.lib_path)
+
+                for name, (argtypes, restype) in self.exports.items():
+                    function = getattr(library, name, None)
+
+                    # libraries built before an export was added just lack
+                    # it, which callers check for
+                    if function is None:
+                        continue
+
+                    function.argtypes = argtypes
+                    function.restype = restype
+
+                library.hs_init(0, 0)
+
+                self.library = library
+                self.pid = os.getpid()
 
         return self.library
 
+    def unload(self):
+        with self.lock:
+            if self.library is not None and self.pid == os.getpid():
+                self.library.hs_exit()
+
+            self.library = None
+            self.pid = None
+
+    def __enter__(self):
+        return self.resident(self.lib_path, self.exports)
+
     def __exit__(self, type_, value, traceback):
-        self.library.hs_exit()
-        self._dlclose()
+        pass
+
+    @classmethod
+    def _shutdown(cls):
+        for instance in list(cls._instances.values()):
+            instance.unload()
+
+    @classmethod
+    def _after_fork(cls):
+        cls._master_lock = Lock()
+
+        for instance in cls._instances.values():
+            instance.lock = Lock()
 
-        del self.library
-        self.library = None
 
-        self.lock.release()
+atexit.register(HaskellLibrary._shutdown)
 
-    def _dlclose(self):
-        libdl = ctypes.cdll.LoadLibrary(self.libdl)
-        libdl.dlclose.argtypes = [ctypes.c_void_p]
-        libdl.dlclose.restype = ctypes.c_int
-        libdl.dlclose(self.library._handle)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=HaskellLibrary._after_fork)
@@ -101,9 +101,16 @@ class AppViewMixin(StateViewMixin):
     def get(self, request, *args, **kwargs):
         self._prepare_attributes()
 
-        context = self.get_context_data()
+        response = self.get_not_modified_response()
 
-        return self.render_to_response(context)
+        if response is None:
+            context = self.get_context_data()
+            response = self.render_to_response(context)
+
+        if self.conditional_requests:
+            self.set_validators(response)
+
+        return response
 
     def get_state(self):
         base_state = dict(super().get_state())
@@ -112,7 +119,6 @@ class AppViewMixin(StateViewMixin):
             "tokenEditor": self.get_token_state(),
             "applicationData": self.get_application_data(),
             "models": self.get_models_meta(),
-            "user": self.get_user_data(),
             "templates": self.get_templates(),
        })
 
@@ -121,6 +127,12 @@ class AppViewMixin(StateViewMixin):
 
         return base_state
 
+    def add_user_state(self, state):
+        state = super().add_user_state(state)
+        state["user"] = self.get_user_data()
+
+        return state
+
     def get_serializer(self, *args, **kwargs):
         kwargs["context"] = self.get_serializer_context()
         return self.get_serializer_class()(*args, **kwargs)
@@ -18,9 +18,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import time
+
 from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 
-from anubis.aggregators import CachedQuerySetAggregator
+from anubis.aggregators import CachedQuerySetAggregator, IdSetAggregator
+from anubis.cache import CacheMetrics, get_near_cache
+from anubis.query import filter_by_ids
 
 class NoCacheMixin:
     def get(self, *args, **kwargs):
@@ -35,13 +40,55 @@ class NoCacheMixin:
 class CachedSearchMixin:
     """Caches searches.
 
+    Cache keys include the generation of the searched model (see
+    :meth:`StateViewMixin.get_data_generation`), so cached searches become
+    unreachable as soon as the model is written to through the ORM (see
+    :func:`anubis.cache.track_generations`).
 
     Attributes:
         cache (str): Which cache to use. Set to :const:`None` to disable caching
             even if the view inherits from this class. Defaults to `"default"`.
+        cache_timeout (Optional[int]): How long, in seconds, cached searches
+            are kept. Defaults to the cache's own default timeout.
+        share_cache_with_users (bool): Whether authenticated users are served
+            from (and populate) the cache too. Only the user independent part
+            of the state is cached (see
+            :meth:`StateViewMixin.get_shared_state`), and the user's actions
+            and data are added on each request. Only turn this on if your
+            serializers, details and templates don't depend on the current
+            user. Defaults to :const:`False`, in which case only anonymous
+            searches are cached.
+        cache_stale_timeout (int): For how many seconds after
+            :attr:`cache_timeout` an expired search is still served, while a
+            single request recomputes it. Defaults to 60.
+        cache_lock_timeout (int): Lease, in seconds, of the lock taken by the
+            request recomputing a search. Defaults to 30.
+        cache_lock_wait (float): How long, in seconds, requests missing the
+            cache wait for another request already computing the same search
+            before computing it themselves. Defaults to 1.
+        near_cache_ttl (Optional[float]): If set, searches are also kept in
+            process for this many seconds, in front of :attr:`cache` (see
+            :class:`anubis.cache.NearCache`). Defaults to :const:`None`.
+        near_cache_size (int): Maximum number of searches kept in process.
+            Defaults to 256.
+
+    Cache events are counted in :attr:`cache_metrics` (hits, misses, stale
+    states served and waits for another request's lock).
+
+    Record counts are cached apart from the pages, so moving to another page
+    of a search doesn't count its records again.
     """
 
     cache = "default"
+    cache_timeout = DEFAULT_TIMEOUT
+    cache_stale_timeout = 60
+    cache_lock_timeout = 30
+    cache_lock_wait = 1
+    cache_lock_poll = 0.05
+    cache_metrics = CacheMetrics("hits", "misses", "stale", "lock_waits")
+    near_cache_ttl = None
+    near_cache_size = 256
+    share_cache_with_users = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -49,19 +96,22 @@ class CachedSearchMixin:
         self.is_cacheable = not self.cache is None
         self.is_api = False
         self.cache_key = None
+        self.count_cache_key = None
 
     def _prepare_attributes(self):
         super()._prepare_attributes()
 
+        # states built after performing an action are never cached
         self.is_cacheable = self.is_cacheable \
             and self.boolean_expression is not None \
-            and not self.request.user.is_authenticated() # never cache auth'ed
-                                                         # results
+            and self.request.method != "POST" \
+            and (self.share_cache_with_users or
+                 not self.request.user.is_authenticated())
 
         if not self.is_cacheable:
             return
 
-        key_builder = [self.expression_parameter]
+        key_builder = []
 
         if self.is_paginated:
             key_builder.append(self.page_parameter)
@@ -72,48 +122,184 @@ class CachedSearchMixin:
         if self.is_sortable:
             key_builder.append(self.sorting_parameter)
 
-        self.cache_key = ":".join([self.kwargs.get(k, "") for k in key_builder])
+        key_builder.append(self.details_parameter)
+
+        # equivalent expressions share the same canonical text, and so the
+        # same cache entry
+        expression = self.get_expression_text(self.canonical_expression)
+
+        generation = self.get_data_generation()
+
+        self.cache_key = ":".join([generation, expression] +
+                                  [self.kwargs.get(k, "") for k in key_builder])
+
+        # the count doesn't depend on the page, sorting or details
+        self.count_cache_key = ":".join(["count", generation, expression,
+                                         self.kwargs.get(self.model_parameter,
+                                                         "")])
+
+    def get_record_count(self, queryset):
+        if not self.is_cacheable:
+            return super().get_record_count(queryset)
+
+        cache = self.get_search_cache()
+        count = cache.get(self.count_cache_key, None)
+
+        if count is None:
+            count = queryset.count()
+            cache.set(self.count_cache_key, count, self.cache_timeout)
+
+        return count
 
     def list(self, request, *args, **kwargs):
         self.is_api = True
 
         return super().list(request, *args, **kwargs)
 
-    def get_full_state(self):
+    def get_shared_state(self):
         if not self.is_cacheable:
-            return super().get_full_state()
+            return super().get_shared_state()
+
+        key = self.get_cache_key()
+        cache = self.get_search_cache()
+
+        state, fresh = self._get_cached_state(cache, key)
+
+        if fresh:
+            self.cache_metrics.incr("hits")
+            return state
+
+        lock_key = "lock:" + key
+        locked = cache.add(lock_key, True, self.cache_lock_timeout)
+
+        if not locked:
+            if state is not None:
+                # someone else is refreshing it
+                self.cache_metrics.incr("stale")
+                return state
+
+            state = self._wait_cached_state(cache, key)
+
+            if state is not None:
+                self.cache_metrics.incr("lock_waits")
+                return state
+
+        self.cache_metrics.incr("misses")
+
+        try:
+            state = super().get_shared_state()
+            self._set_cached_state(cache, key, state)
+        finally:
+            if locked:
+                cache.delete(lock_key)
 
-        key = "api:" + self.cache_key if self.is_api else self.cache_key
+        return state
+
+    def get_cache_key(self):
+        return "api:" + self.cache_key if self.is_api else self.cache_key
+
+    def get_search_cache(self):
+        if self.near_cache_ttl is not None:
+            return get_near_cache(self.cache, self.near_cache_size,
+                                  self.near_cache_ttl)
 
-        cache = caches[self.cache]
+        return caches[self.cache]
 
+    def _get_cached_state(self, cache, key):
         cached_value = cache.get(key, None)
 
-        if cached_value is None:
-            state = super().get_full_state()
+        if not isinstance(cached_value, tuple) or len(cached_value) != 2:
+            return None, False
+
+        expires, state = cached_value
+        fresh = expires is None or expires > time.time()
+
+        return dict(state), fresh
 
-            cache.set(key, dict(state))
+    def _set_cached_state(self, cache, key, state):
+        timeout = self.cache_timeout
+
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = cache.default_timeout
+
+        if timeout is None:
+            expires = None
         else:
-            state = dict(cached_value)
+            expires = time.time() + timeout
+            timeout += self.cache_stale_timeout
 
-        return state
+        cache.set(key, (expires, dict(state)), timeout)
+
+    def _wait_cached_state(self, cache, key):
+        deadline = time.time() + self.cache_lock_wait
+
+        while time.time() < deadline:
+            time.sleep(self.cache_lock_poll)
+
+            state, fresh = self._get_cached_state(cache, key)
+
+            if fresh:
+                return state
+
+        return None
 
 class CachedUnitMixin:
     """Caches individual units.
+
+    Attributes:
+        unit_cache (Optional[str]): Which cache to use. Defaults to
+            :const:`None`, which disables unit caching.
+        unit_cache_in_memory (bool): Whether to evaluate the whole expression
+            in memory over the cached id sets of its units (and of the whole
+            model, for negations), so that the database is only queried once
+            for the final set of ids. Ignored for models whose primary key
+            isn't an integer. Defaults to :const:`False`.
+        unit_cache_timeout (Optional[int]): How long, in seconds, cached units
+            are kept. Defaults to the cache's own default timeout.
+        unit_near_cache_ttl (Optional[float]): If set, units are also kept in
+            process for this many seconds, in front of :attr:`unit_cache`.
+            Defaults to :const:`None`.
+        unit_near_cache_size (int): Maximum number of units kept in process.
+            Defaults to 1024.
+
+    As with :class:`CachedSearchMixin`, cache keys include the generation of
+    the data shown by the view (see
+    :meth:`StateViewMixin.get_data_generation`), so units filtering on
+    related models are invalidated along with them.
     """
 
     unit_cache = None
+    unit_cache_in_memory = False
+    unit_cache_timeout = DEFAULT_TIMEOUT
+    unit_near_cache_ttl = None
+    unit_near_cache_size = 1024
 
     def get_queryset_filter(self, queryset):
         if self.unit_cache is None:
             return super().get_queryset_filter(queryset)
 
-        cache = caches[self.unit_cache]
+        aggregator = self.get_unit_aggregator(queryset)
 
-        aggregator = CachedQuerySetAggregator(cache, queryset,
-                                              self.get_filters())
+        if self.unit_cache_in_memory and aggregator.integer_ids:
+            ids = self.canonical_expression.traverse(
+                IdSetAggregator(aggregator))
+
+            return filter_by_ids(queryset, ids)
+
+        return aggregator.aggregate(self.canonical_expression)
+
+    def get_unit_aggregator(self, queryset):
+        if self.unit_near_cache_ttl is not None:
+            cache = get_near_cache(self.unit_cache, self.unit_near_cache_size,
+                                   self.unit_near_cache_ttl)
+        else:
+            cache = caches[self.unit_cache]
 
-        return self.boolean_expression.traverse(aggregator)
+        return CachedQuerySetAggregator(cache, queryset, self.get_filters(),
+                                        compile_q=self.compile_q,
+                                        plan=self.plan_expression,
+                                        generation=self.get_data_generation(),
+                                        timeout=self.unit_cache_timeout)
 
 
 
@@ -23,6 +23,7 @@ This module contains the StateViewMixin, a mixin designed for creating API views
 that perform searches on the database.
 """
 
+import hashlib
 from collections import OrderedDict
 from functools import reduce
 
@@ -33,17 +34,21 @@ from rest_framework.renderers import JSONRenderer
 
 from django.conf.urls import url
 from django.contrib.auth.models import User
-from django.core.paginator import Paginator
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
-from django.utils.cache import add_never_cache_headers
+from django.utils.cache import add_never_cache_headers, \
+    get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django import forms
 
-from anubis.aggregators import QuerySetAggregator, ListAggregator
+from anubis.aggregators import QuerySetAggregator, ListAggregator, \
+    ExpressionAggregator
 from anubis.filters import ConversionFilter
-from anubis.url import BooleanBuilder
+from anubis.url import BooleanBuilder, ExpressionLimits, ExpressionLimitError
 from anubis.forms import FieldSerializer
+from anubis.cache import get_generations, get_last_modified
+from anubis.pagination import CountedPaginator
 
 class StateViewMixin:
     """A mixin that performs a search and adds the result to the view context.
@@ -73,6 +78,11 @@ class StateViewMixin:
     :ivar boolean_expression: Represents the requested search, if there is one.
     :vartype Optional[rest_framework.serializers.ModelSerializer]:
 
+    :ivar canonical_expression: The normalized and factored form of
+        :attr:`boolean_expression`, which is the one actually used for
+        searching and caching.
+    :vartype Optional[anubis.url.Boolean]:
+
 
     Attributes:
         base_url (str): Base URL for the application. Should either start with
@@ -128,6 +138,35 @@ class StateViewMixin:
             If :const:`None`, defaults to the first key of the first model.
         allow_client_cache (boolean): Whether the answer should allow
             client-side caching. Defaults to :const:`False`.
+        expression_max_length (Optional[int]): Maximum length of the search
+            expression. Longer expressions are rejected before parsing.
+        expression_max_depth (Optional[int]): Maximum nesting depth of the
+            search expression.
+        expression_max_units (Optional[int]): Maximum number of search units
+            in an expression.
+        expression_max_unit_args (Optional[int]): Maximum number of arguments
+            for a single search unit. Set any of these limits to :const:`None`
+            to disable it.
+        compile_q (bool): Whether to combine the units whose filters can be
+            expressed as :class:`Q` objects into a single `.filter()` call,
+            instead of combining one queryset per unit. Filters on
+            multi-valued relations are still combined as querysets. Defaults
+            to :const:`False`.
+        plan_expression (bool): Whether to plan the evaluation of the
+            expression, running cheap and selective units first and skipping
+            the remaining operands of an AND as soon as it is known to be
+            empty (or of an OR that matches everything). Defaults to
+            :const:`False`.
+        generation_models (Optional[list]): Models whose writes change the
+            results of this view, used for cache keys and validators (see
+            :meth:`get_data_generation`). Defaults to :const:`None`, which
+            means the model being searched.
+        conditional_requests (bool): Whether to send `ETag` and
+            `Last-Modified` headers and answer matching conditional `GET`
+            requests with a 304 response, before running any filter or
+            serializer. Responses are then marked as private and to be
+            revalidated on every use instead of never cached. Defaults to
+            :const:`False`.
     """
 
     base_url = ""
@@ -144,6 +183,15 @@ class StateViewMixin:
     default_filter = None
     allow_client_cache = False
 
+    expression_max_length = 4096
+    expression_max_depth = 32
+    expression_max_units = 256
+    expression_max_unit_args = 16
+    compile_q = False
+    plan_expression = False
+    generation_models = None
+    conditional_requests = False
+
     objects_per_page = None
     page_parameter = "page"
 
@@ -307,8 +355,11 @@ class StateViewMixin:
         self.is_multi_modeled = self._is_multi_modeled()
         self.is_sortable = self._is_sortable()
         self.boolean_expression = None
+        self.canonical_expression = None
         self.action_result = None
         self.pagination_data = None
+        self._validators = None
+        self._data_generation = None
 
         self._sorting = {
             "by": None,
@@ -330,7 +381,10 @@ class StateViewMixin:
     def get(self, request, *args, **kwargs):
         self._prepare_attributes()
 
-        response = super().get(request, *args, **kwargs)
+        response = self.get_not_modified_response()
+
+        if response is None:
+            response = super().get(request, *args, **kwargs)
 
         return self.set_headers(response)
 
@@ -339,16 +393,107 @@ class StateViewMixin:
 
         self.perform_actions()
 
+        # the action may have written to the models shown
+        self._data_generation = None
+
         response = super().get(*args, **kwargs)
 
         return self.set_headers(response)
 
     def set_headers(self, response):
-        if not self.allow_client_cache:
+        if self.conditional_requests and self.request.method == "GET":
+            self.set_validators(response)
+        elif not self.allow_client_cache:
             add_never_cache_headers(response)
 
         return response
 
+    def get_data_generation(self):
+        """Gets the generation of the data shown by this view (see
+        :func:`anubis.cache.get_generation`), which changes whenever the
+        models in :attr:`generation_models` are written to.
+
+        It is read only once per request, as models with a generation table
+        (see :func:`anubis.cache.track_table_generations`) query the
+        database for it.
+
+        Returns:
+            str: The generation.
+        """
+        if self._data_generation is None:
+            self._data_generation = get_generations(
+                self.get_generation_models())
+
+        return self._data_generation
+
+    def get_generation_models(self):
+        if self.generation_models is None:
+            return [self.model]
+
+        return list(self.generation_models)
+
+    def get_validators(self):
+        """Computes the validators for conditional requests, without running
+        the search.
+
+        Returns:
+            Tuple[str, Optional[int]]: The quoted `ETag` and the
+            `Last-Modified` timestamp, if known.
+        """
+        if self._validators is not None:
+            return self._validators
+
+        user = self.request.user
+        parts = [self.__class__.__module__, self.__class__.__name__,
+                 self.get_expression_text(self.canonical_expression),
+                 self.get_requested_expression_text(),
+                 self.get_data_generation(),
+                 str(user.pk) if user.is_authenticated() else ""]
+        parts += [str(self.kwargs.get(key, "")) for key in
+                  (self.model_parameter, self.page_parameter,
+                   self.sorting_parameter, self.details_parameter)]
+
+        etag = hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+        modified = [get_last_modified(model)
+                    for model in self.get_generation_models()]
+        last_modified = None if None in modified else max(modified)
+
+        self._validators = (quote_etag(etag), last_modified)
+
+        return self._validators
+
+    def get_not_modified_response(self):
+        """Answers a conditional request if the client's copy is current.
+
+        Returns:
+            Optional[django.http.HttpResponse]: The 304 (or 412) response, or
+            :const:`None` if the state must be built.
+        """
+        if not self.conditional_requests:
+            return None
+
+        etag, last_modified = self.get_validators()
+
+        return get_conditional_response(self.request, etag=etag,
+                                        last_modified=last_modified)
+
+    def set_validators(self, response):
+        """Sets the validators of a conditional request's response (either the
+        full one or a 304), which must be revalidated before being reused.
+        """
+        patch_cache_control(response, private=True, no_cache=True,
+                            must_revalidate=True)
+
+        etag, last_modified = self.get_validators()
+
+        response["ETag"] = etag
+
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+
+        return response
+
     def perform_actions(self):
         action_name = self.request.POST.get('action_name', None)
         action = self.actions.get(action_name, None)
@@ -424,7 +569,8 @@ class StateViewMixin:
             ValueError: If you can't bother configure your URL pattern to only
                 accept \\d+ in your "page" argument, you deserve an error.
         """
-        paginator = Paginator(queryset, self.objects_per_page)
+        paginator = CountedPaginator(queryset, self.objects_per_page,
+                                     count=self.get_record_count(queryset))
         page = int(self.kwargs.get(self.page_parameter, 1))
 
         return paginator.page(page)
@@ -454,11 +600,95 @@ class StateViewMixin:
         return Response(self.get_full_state())
 
     def get_full_state(self):
+        state = self.add_expression_state(self.get_shared_state())
+
+        return self.add_user_state(state)
+
+    def get_shared_state(self):
+        """Builds the part of the state that doesn't depend on the current
+        user, which may be shared between users (see
+        :class:`anubis.views.CachedSearchMixin`).
+
+        Returns:
+            dict: The state, without any user data.
+        """
         self.object_list = self.get_queryset()
         state = self.get_state()
 
         return state
 
+    def add_expression_state(self, state):
+        """Adds the expression as requested to the state.
+
+        The shared state is built (and cached) for the canonical form of the
+        expression, which many different requests may have in common, so the
+        tokens and the text shown to the user are taken from this request's
+        own expression instead.
+
+        Args:
+            state (dict): The shared state, which is left untouched.
+
+        Returns:
+            dict: A copy of `state` with the expression.
+        """
+        state = dict(state)
+        results = dict(state["searchResults"])
+        results.update(self.get_expression_state())
+        state["searchResults"] = results
+
+        return state
+
+    def get_expression_state(self):
+        aggregator = ListAggregator(self.get_filters())
+
+        expression = self.boolean_expression.traverse(aggregator) \
+            if self.boolean_expression is not None else []
+
+        for i, unit in enumerate(expression):
+            unit.update({"index": i})
+
+        return {
+            "position": len(expression),
+            "expression": expression,
+            "textExpression": self.get_requested_expression_text(),
+        }
+
+    def get_requested_expression_text(self):
+        """Gets the expression exactly as it was requested, which is also the
+        key the search interface uses to look searches up.
+
+        Returns:
+            str: The expression text, or an empty string if there's no
+            expression.
+        """
+        expression = self.kwargs.get(self.expression_parameter, None)
+
+        if expression is None:
+            return ""
+
+        return BooleanBuilder.normalize(expression)
+
+    def add_user_state(self, state):
+        """Adds the parts of the state that depend on the current user.
+
+        Args:
+            state (dict): The shared state, which is left untouched.
+
+        Returns:
+            dict: A copy of `state` with the user data.
+        """
+        state = dict(state)
+        results = dict(state["searchResults"])
+
+        results["actions"] = self.get_actions() if results["visible"] else {}
+
+        if self.action_result is not None:
+            results["actionResult"] = self.action_result
+
+        state["searchResults"] = results
+
+        return state
+
     def get_serialized_queryset(self, queryset):
         if self.group_by is None:
             return self.get_serializer(queryset, many=True).data
@@ -547,6 +777,19 @@ class StateViewMixin:
 
         return getattr(self, sort_method)(queryset, ascending)
 
+    def get_record_count(self, queryset):
+        """Gets the number of records matched by the search, if it can be
+        known without counting them.
+
+        Args:
+            queryset (django.db.models.QuerySet): The filtered queryset.
+
+        Returns:
+            Optional[int]: The number of records, or :const:`None` to have the
+            paginator count them.
+        """
+        return None
+
     def paginate_queryset(self, queryset):
         if not self.is_paginated or self.boolean_expression is None:
             return queryset
@@ -594,6 +837,7 @@ class StateViewMixin:
         self.model = self.get_model()
         self.serializers = self.get_serializers()
         self.boolean_expression = self.get_boolean_expression()
+        self.canonical_expression = self.get_canonical_expression()
 
     def get_model(self):
         if not self.is_multi_modeled:
@@ -618,10 +862,15 @@ class StateViewMixin:
         if expression is None or expression == "":
             return None
 
-        expression = expression.strip().rstrip("/")
-
         try:
-            boolean = BooleanBuilder(expression).build()
+            boolean = BooleanBuilder(expression,
+                                     limits=self.get_expression_limits()) \
+                .build()
+        except ExpressionLimitError as exc:
+            error = ValueError(_("The search expression is too complex: {}")
+                               .format(exc))
+            error.name = lambda: _("Expression Too Complex")
+            raise error
         except ValueError:
             error = ValueError(_(("Check your expression for a missing "
                                   "connector, for instance.")))
@@ -630,6 +879,33 @@ class StateViewMixin:
 
         return boolean
 
+    def get_expression_limits(self):
+        return ExpressionLimits(max_length=self.expression_max_length,
+                                max_depth=self.expression_max_depth,
+                                max_units=self.expression_max_units,
+                                max_args=self.expression_max_unit_args)
+
+    def get_canonical_expression(self):
+        if self.boolean_expression is None:
+            return None
+
+        return self.boolean_expression.normalize().factor()
+
+    def get_expression_text(self, expression):
+        """Writes an expression back in the syntax used in search URLs.
+
+        Args:
+            expression (Optional[anubis.url.Boolean]): The expression.
+
+        Returns:
+            str: The expression text, or an empty string if there's no
+            expression.
+        """
+        if expression is None:
+            return ""
+
+        return expression.traverse(ExpressionAggregator())
+
     def get_filters(self):
         if not self.is_multi_modeled:
             return self.filters
@@ -675,9 +951,11 @@ class StateViewMixin:
         Returns:
             django.db.models.QuerySet: The filtered queryset.
         """
-        aggregator = QuerySetAggregator(queryset, self.get_filters())
+        aggregator = QuerySetAggregator(queryset, self.get_filters(),
+                                        compile_q=self.compile_q,
+                                        plan=self.plan_expression)
 
-        return self.boolean_expression.traverse(aggregator)
+        return aggregator.aggregate(self.canonical_expression)
 
     def get_state(self):
         anubis_state = {
@@ -709,25 +987,10 @@ class StateViewMixin:
             return None
 
     def get_search_results(self):
-        # TODO: textExpression should be computed from the parsed
-        # boolean_expression.
-
-        aggregator = ListAggregator(self.get_filters())
         visible = self.boolean_expression is not None
 
-        expression = self.boolean_expression.traverse(aggregator) \
-            if visible else []
-
-        for i, unit in enumerate(expression):
-            unit.update({"index": i})
-
-
         results = {
-            "position": len(expression),
-            "expression": expression,
-            "textExpression": self.kwargs.get(self.expression_parameter, ""),
             "pagination": self.get_pagination(),
-            "actions": self.get_actions() if visible else {},
             "visible": visible,
             "model": self._model_key,
             "results": self.get_serialized_queryset(self.object_list),
@@ -735,9 +998,6 @@ class StateViewMixin:
             "selection": []
         }
 
-        if self.action_result is not None:
-            results["actionResult"] = self.action_result
-
         return results
 
     def get_pagination(self):